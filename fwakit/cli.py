@@ -7,12 +7,15 @@ except ImportError:
 
 import os
 import multiprocessing
+import time
 from functools import partial
+from multiprocessing.pool import ThreadPool
 
 import click
 
 import pgdata
 import fwakit as fwa
+from . import pgcopy
 from . import settings
 
 
@@ -36,6 +39,100 @@ def validate_format(ctx, param, value):
         raise click.BadParameter("Format '{}' is not supported".format(value))
 
 
+def report_group_timings(table, timings, elapsed):
+    """
+    Echo elapsed (wall clock) load time, the sum of the group load times
+    (larger than elapsed when groups are loaded in parallel) and the slowest
+    groups loaded to table
+    """
+    total = sum([t[1] for t in timings])
+    click.echo('{t}: loaded {n} groups in {e:.1f}s '
+               '(sum of group load times {s:.1f}s)'.format(t=table,
+                                                           n=len(timings),
+                                                           e=elapsed,
+                                                           s=total))
+    for group, elapsed in sorted(timings, key=lambda t: t[1], reverse=True)[:5]:
+        click.echo('  {g}: {s:.1f}s'.format(g=group, s=elapsed))
+
+
+def load_layer(db, in_file, in_layer, out_layer, dim=3, engine='ogr',
+               unlogged=False):
+    """Load layer to whse_basemapping schema with ogr2ogr or binary COPY
+    """
+    if engine == 'copy':
+        db['whse_basemapping.'+out_layer].drop()
+        pgcopy.copy_layer(in_file, in_layer, 'whse_basemapping.'+out_layer, db,
+                          dim=dim, unlogged=unlogged)
+    else:
+        db.ogr2pg(in_file,
+                  in_layer=in_layer,
+                  out_layer=out_layer,
+                  schema='whse_basemapping',
+                  dim=dim)
+
+
+def load_groups_parallel(gdb, table, groups, db_url, jobs, engine='ogr'):
+    """
+    Load grouped layer to a single table, appending the groups in parallel.
+    The first group creates the table, the remaining groups are appended
+    directly by a pool of ogr2ogr (or COPY) processes (one connection per
+    worker) - no staging tables are created and no rows are copied a second
+    time.
+    """
+    db = fwa.util.connect(db_url)
+    timings = []
+    load_start = time.time()
+    # load the first group to create the output table
+    click.echo(groups[0])
+    start_time = time.time()
+    load_layer(db, gdb, groups[0], table, engine=engine)
+    timings.append((groups[0], time.time() - start_time))
+    # append the rest
+    func = partial(fwa.util.load_group,
+                   in_file=gdb,
+                   out_table='whse_basemapping.' + table,
+                   db_url=db_url,
+                   engine=engine)
+    pool = multiprocessing.Pool(processes=jobs)
+    for group, elapsed in pool.imap_unordered(func, groups[1:]):
+        click.echo('{g}: {s:.1f}s'.format(g=group, s=elapsed))
+        timings.append((group, elapsed))
+    pool.close()
+    pool.join()
+    report_group_timings(table, timings, time.time() - load_start)
+
+
+def load_groups_partitioned(gdb, table, groups, db_url, jobs, engine='ogr'):
+    """
+    Load grouped layer to a table partitioned by watershed group. Each group
+    is loaded to its own table and attached as a partition - groups are
+    loaded in parallel if jobs > 1
+    """
+    timings = []
+    load_start = time.time()
+    func = partial(fwa.load_partition,
+                   in_file=gdb,
+                   table='whse_basemapping.' + table,
+                   db_url=db_url,
+                   engine=engine)
+    # load the first group on its own, creating the partitioned table
+    timings.append(func(groups[0]))
+    click.echo('{g}: {s:.1f}s'.format(g=timings[0][0], s=timings[0][1]))
+    if jobs > 1:
+        pool = multiprocessing.Pool(processes=jobs)
+        results = pool.imap_unordered(func, groups[1:])
+    else:
+        pool = None
+        results = map(func, groups[1:])
+    for group, elapsed in results:
+        click.echo('{g}: {s:.1f}s'.format(g=group, s=elapsed))
+        timings.append((group, elapsed))
+    if pool:
+        pool.close()
+        pool.join()
+    report_group_timings(table, timings, time.time() - load_start)
+
+
 @click.group()
 def cli():
     pass
@@ -60,7 +157,13 @@ def create_db(db_url):
               default=settings.source_url)
 @click.option('--dl_path', '-p', help='Local path to download files to',
               default=settings.dl_path)
-def download(files, source_url, dl_path):
+@click.option('--cache_path', '-c',
+              help='Local path to cache archives (default is dl_path/cache)')
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of files to download at the same time')
+@click.option('--no_unzip', '-nu', is_flag=True,
+              help="Only download archives, don't unzip (for load --zipped)")
+def download(files, source_url, dl_path, cache_path, jobs, no_unzip):
     """Download FWA gdb archives from GeoBC ftp
     """
     # download files from internet
@@ -71,10 +174,21 @@ def download(files, source_url, dl_path):
         files = files.split(",")
     else:
         files = settings.source_files
-    for source_file in files:
-        url = urljoin(source_url, source_file)
-        click.echo('Downloading '+source_file)
-        fwa.util.download_and_unzip(url, dl_path)
+    urls = [urljoin(source_url, source_file) for source_file in files]
+    click.echo('Downloading '+', '.join(files))
+    if not cache_path:
+        cache_path = os.path.join(dl_path, 'cache')
+    if no_unzip:
+        func = partial(fwa.util.cache_archive, cache_dir=cache_path)
+    else:
+        func = partial(fwa.util.download_and_unzip,
+                       unzip_dir=dl_path,
+                       cache_dir=cache_path)
+    # downloads are io bound, use threads
+    pool = ThreadPool(processes=jobs)
+    pool.map(func, urls)
+    pool.close()
+    pool.join()
 
 
 @cli.command()
@@ -86,10 +200,24 @@ def download(files, source_url, dl_path):
 @click.option('--db_url', '-db', help='Database to load files to',
               envvar='FWA_DB')
 @click.option('--wsg', '-g', help='List of group codes to load')
-def load(layers, skiplayers, dl_path, db_url, wsg):
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of watershed groups to load in parallel')
+@click.option('--partition', '-pt', is_flag=True,
+              help='Load grouped layers to tables partitioned by watershed group')
+@click.option('--zipped', '-z', is_flag=True,
+              help='Read sources directly from the downloaded .zip archives')
+@click.option('--cache_path', '-c',
+              help='Path to cached archives (default is dl_path/cache)')
+@click.option('--engine', '-e', type=click.Choice(['ogr', 'copy']),
+              default='ogr',
+              help='Load with ogr2ogr (default) or with binary COPY')
+def load(layers, skiplayers, dl_path, db_url, wsg, jobs, partition, zipped,
+         cache_path, engine):
     """Load FWA data to PostgreSQL
     """
     db = fwa.util.connect(db_url)
+    if not db_url:
+        db_url = os.environ['FWA_DB']
     # parse the input layers
     in_layers = parse_layers(layers, skiplayers)
 
@@ -103,9 +231,10 @@ def load(layers, skiplayers, dl_path, db_url, wsg):
     if 'whse_basemapping.fwa_watershed_groups_poly' not in db.tables:
         layer = [t for t in settings.source_tables if t['table'] == 'fwa_watershed_groups_poly'][0]
         click.echo('Loading '+layer['table'])
-        gdb = os.path.join(dl_path, os.path.splitext(layer['source_file'])[0])
-        if not os.path.exists(gdb):
-            raise IOError(gdb+' does not exist, download it first')
+        gdb = fwa.util.source_path(layer['source_file'], dl_path, zipped,
+                                   cache_path)
+        if not gdb:
+            raise IOError(layer['source_file']+' does not exist, download it first')
         db.ogr2pg(gdb,
                   in_layer=layer['table'].upper(),
                   out_layer=layer['table'],
@@ -116,8 +245,9 @@ def load(layers, skiplayers, dl_path, db_url, wsg):
     for layer in settings.source_tables:
         table = fwa.tables[layer['table']]
         if layer['table'] in in_layers:
-            gdb = os.path.join(dl_path, os.path.splitext(layer['source_file'])[0])
-            if os.path.exists(gdb):
+            gdb = fwa.util.source_path(layer['source_file'], dl_path, zipped,
+                                       cache_path)
+            if gdb:
                 # load data that is not split up by watershed group
                 if not layer['grouped']:
                     click.echo('Loading %s' % layer['table'])
@@ -125,11 +255,11 @@ def load(layers, skiplayers, dl_path, db_url, wsg):
                     if table not in db.tables:
                         # only load the group of interest if specified
                         if not wsg:
-                            db.ogr2pg(gdb,
-                                      in_layer=layer['table'].upper(),
-                                      out_layer=layer['table'],
-                                      schema='whse_basemapping',
-                                      dim=3)
+                            load_layer(db, gdb, layer['table'].upper(),
+                                       layer['table'], engine=engine)
+                            # ogr2ogr creates a spatial index, match it
+                            if engine == 'copy':
+                                db[table].create_index_geom()
                         else:
                             db.ogr2pg(gdb,
                                       in_layer=layer['table'].upper(),
@@ -140,38 +270,57 @@ def load(layers, skiplayers, dl_path, db_url, wsg):
                 # load data that *is* split up by watershed group
                 else:
                     click.echo('Loading %s by watershed group' % layer['table'])
-                    # overwrite if the table exists
-                    db[table].drop()
+                    # overwrite if the table exists (but only replace the
+                    # partitions of groups being loaded to partitioned tables)
+                    if not (partition and fwa.is_partitioned(table, db=db)):
+                        db[table].drop()
                     if wsg:
                         groups = wsg.split(',')
                     else:
                         groups = fwa.list_groups(db=db)
-                    for i, group in enumerate(sorted(groups)):
-                        click.echo(group)
-                        db.ogr2pg(gdb,
-                                  in_layer=group,
-                                  out_layer=layer['table']+'_'+group.lower(),
-                                  schema='whse_basemapping',
-                                  dim=3)
-                        # combine the groups into a single table
-                        if i == 0:
-                            sql = '''CREATE TABLE whse_basemapping.{table}
-                                     (LIKE whse_basemapping.{g})
+                    groups = sorted(groups)
+                    if partition:
+                        load_groups_partitioned(gdb, layer['table'], groups,
+                                                db_url, jobs, engine)
+                    elif jobs > 1:
+                        load_groups_parallel(gdb, layer['table'], groups,
+                                             db_url, jobs, engine)
+                    else:
+                        timings = []
+                        load_start = time.time()
+                        for i, group in enumerate(groups):
+                            click.echo(group)
+                            start_time = time.time()
+                            load_layer(db, gdb, group,
+                                       layer['table']+'_'+group.lower(),
+                                       engine=engine, unlogged=True)
+                            # combine the groups into a single table
+                            if i == 0:
+                                sql = '''CREATE TABLE whse_basemapping.{table}
+                                         (LIKE whse_basemapping.{g})
+                                      '''.format(table=layer['table'],
+                                                 g=layer['table']+'_'+group.lower())
+                                db.execute(sql)
+                            sql = '''INSERT INTO whse_basemapping.{table}
+                                     SELECT * FROM whse_basemapping.{g}
                                   '''.format(table=layer['table'],
                                              g=layer['table']+'_'+group.lower())
                             db.execute(sql)
-                        sql = '''INSERT INTO whse_basemapping.{table}
-                                 SELECT * FROM whse_basemapping.{g}
-                              '''.format(table=layer['table'],
-                                         g=layer['table']+'_'+group.lower())
-                        db.execute(sql)
-                        # drop the source group table
-                        db['whse_basemapping.'+layer['table']+'_'+group.lower()].drop()
+                            # drop the source group table
+                            db['whse_basemapping.'+layer['table']+'_'+group.lower()].drop()
+                            timings.append((group, time.time() - start_time))
+                        report_group_timings(layer['table'], timings,
+                                             time.time() - load_start)
             else:
                 click.echo("""{l}: source file {f} does not exist, skipping"""
                            .format(l=layer['table'],
                                    f=layer['source_file']))
 
+    # cached upstream geometries and stream profiles are no longer valid
+    if 'fwa_stream_networks_sp' in in_layers:
+        fwa.clear_geomupstream_cache(db=db)
+        fwa.clear_stream_profiles(db=db)
+
 
 @cli.command()
 @click.option('--layers', '-l', help='Comma separated list of tables to clean')
@@ -179,55 +328,95 @@ def load(layers, skiplayers, dl_path, db_url, wsg):
               help='Comma separated list of tables to skip')
 @click.option('--db_url', '-db', help='Database to load files to',
               envvar='FWA_DB')
-def clean(layers, skiplayers, db_url):
+@click.option('--rewrite', '-r', is_flag=True,
+              help='Clean each table in a single pass (including gradient)')
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of indexes to build in parallel')
+@click.option('--maintenance_work_mem', '-m',
+              help="maintenance_work_mem for each index build (eg '1GB')")
+def clean(layers, skiplayers, db_url, rewrite, jobs, maintenance_work_mem):
     """Clean and index the data after load
     """
     db = fwa.util.connect(db_url)
+    if not db_url:
+        db_url = os.environ['FWA_DB']
+    db.execute(fwa.queries['fwa_wsc2ltree'])
     # parse the input layers
     in_layers = parse_layers(layers, skiplayers)
+    indexes = []
     for layer in settings.source_tables:
         table = fwa.tables[layer['table']]
         if layer['table'] in in_layers and table in db.tables:
-            click.echo(layer['table']+': cleaning')
-            # drop ogr and esri columns
-            for column in settings.drop_columns:
-                if column in db[table].columns:
-                    db[table].drop_column(column)
-            # ensure _id keys are int - ogr maps them to double
-            for column in db[table].columns:
-                if column[-3:] == '_id':
-                    if column == 'linear_feature_id':
-                        column_type = 'bigint'
-                    else:
-                        column_type = 'integer'
-                    sql = '''ALTER TABLE {t} ALTER COLUMN {col} TYPE {type}
-                          '''.format(t=table, col=column, type=column_type)
-                    db.execute(sql)
-            # make sure there are no '<Null>' strings in codes
-            for column in ['fwa_watershed_code', 'local_watershed_code']:
-                if column in db[table].columns:
-                    sql = """UPDATE {t} SET {c} = NULL WHERE {c} = '<Null>'
-                          """.format(t=table, c=column)
-                    db.execute(sql)
-            # add ltree columns to tables with watershed codes
-            if 'fwa_watershed_code' in db[table].columns:
-                click.echo(layer['table']+': adding ltree types')
-                fwa.add_ltree(table, db=db)
+            if rewrite:
+                # clean the table with a single CREATE TABLE AS
+                click.echo(layer['table']+': rewriting')
+                fwa.rewrite_table(
+                    table,
+                    wsc_arrays='wscode_array' in db[table].columns,
+                    db=db)
+            else:
+                click.echo(layer['table']+': cleaning')
+                # drop ogr and esri columns
+                for column in settings.drop_columns:
+                    if column in db[table].columns:
+                        db[table].drop_column(column)
+                # ensure _id keys are int - ogr maps them to double
+                for column in db[table].columns:
+                    if column[-3:] == '_id':
+                        if column == 'linear_feature_id':
+                            column_type = 'bigint'
+                        else:
+                            column_type = 'integer'
+                        sql = '''ALTER TABLE {t} ALTER COLUMN {col} TYPE {type}
+                              '''.format(t=table, col=column, type=column_type)
+                        db.execute(sql)
+                # make sure there are no '<Null>' strings in codes
+                for column in ['fwa_watershed_code', 'local_watershed_code']:
+                    if column in db[table].columns:
+                        sql = """UPDATE {t} SET {c} = NULL WHERE {c} = '<Null>'
+                              """.format(t=table, c=column)
+                        db.execute(sql)
+                # add ltree columns to tables with watershed codes
+                if 'fwa_watershed_code' in db[table].columns:
+                    click.echo(layer['table']+': adding ltree types')
+                    fwa.add_ltree(table, index=False, db=db)
             # add primary key constraint
-            db[table].add_primary_key(layer['id'])
-            click.echo(layer['table']+': indexing')
-            # create indexes on columns noted in parameters
+            fwa.add_primary_key(table, layer['id'], db=db)
+            # queue indexes on columns noted in parameters
             for column in layer['index_fields']:
-                db[table].create_index([column])
-            # create geometry index for tables loaded by group
-            if layer['grouped']:
-                db[table].create_index_geom()
+                indexes.append((table, column, 'btree', None))
+            # index ltree columns
+            for column in fwa.LTREE_COLUMNS.values():
+                if column in db[table].columns:
+                    for index_type in ['btree', 'gist']:
+                        indexes.append((table, column, index_type, None))
+            # index integer array codes, if present (see wsc_arrays)
+            for column in fwa.WSC_ARRAY_COLUMNS.values():
+                if column in db[table].columns:
+                    indexes.append((table, column, 'btree', None))
+            # create geometry index for tables loaded by group (and for all
+            # tables when rewriting, the ogr spatial index is not retained)
+            if (layer['grouped'] or rewrite) and 'geom' in db[table].columns:
+                indexes.append((table, 'geom', 'gist', None))
             # index watershed codes
             for col in ['fwa_watershed_code', 'local_watershed_code']:
                 if col in db[table].columns:
-                    sql = """CREATE INDEX IF NOT EXISTS ix_{n}_{c}_tpo ON {t} ({c} text_pattern_ops)
-                              """.format(n=layer['table'], t=table, c=col)
-                    db.execute(sql)
+                    indexes.append((table, col, 'btree', 'text_pattern_ops'))
+
+    # build the indexes
+    if indexes:
+        click.echo('Indexing, {n} indexes with {j} job(s)'.format(n=len(indexes),
+                                                                j=jobs))
+        for sql, elapsed in fwa.create_indexes(indexes,
+                                               db_url=db_url,
+                                               jobs=jobs,
+                                               maintenance_work_mem=maintenance_work_mem):
+            click.echo('{s:.1f}s: {sql}'.format(s=elapsed, sql=sql))
+
+    # cached upstream geometries and stream profiles are no longer valid
+    if 'fwa_stream_networks_sp' in in_layers:
+        fwa.clear_geomupstream_cache(db=db)
+        fwa.clear_stream_profiles(db=db)
 
     # create additional functions, convenience tables, lookups
     # (run queries with 'create_' prefix if required sources are present)
@@ -248,6 +437,10 @@ def clean(layers, skiplayers, db_url):
             'whse_basemapping.fwa_manmade_waterbodies_poly' in db.tables):
         db.execute(fwa.queries['create_fwa_named_streams'])
 
+    # create blue line extents lookup
+    if 'whse_basemapping.fwa_stream_networks_sp' in db.tables:
+        db.execute(fwa.queries['create_fwa_blue_lines'])
+
     # subdivide watershed group polys
     if 'whse_basemapping.fwa_watershed_groups_poly' in db.tables:
         db.execute(fwa.queries['create_fwa_watershed_groups_subdivided'])
@@ -260,41 +453,303 @@ def clean(layers, skiplayers, db_url):
     if ('whse_basemapping.fwa_wetlands_poly' in db.tables and
             'whse_basemapping.fwa_lakes_poly' in db.tables and
             'whse_basemapping.fwa_manmade_waterbodies_poly' in db.tables and
-            'whse_basemapping.fwa_rivers_poly' in db.tables):
+            'whse_basemapping.fwa_rivers_poly' in db.tables and
+            'whse_basemapping.fwa_glaciers_poly' in db.tables):
         db.execute(fwa.queries['create_fwa_waterbodies'])
 
-    # create text_pattern_pos indexes on watershed codes
-    # (these aren't included in sources.json indexes as index type is required)
-
     # add CDB_MakeHexagon function
     db.execute(fwa.queries['CDB_MakeHexagon'])
 
 
+@cli.command()
+@click.option('--layers', '-l', help='Comma separated list of tables to sync')
+@click.option('--skiplayers', '-sl',
+              help='Comma separated list of tables to skip')
+@click.option('--dl_path', '-p', help='Local path to downloaded files',
+              default=settings.dl_path)
+@click.option('--db_url', '-db', help='Database to sync',
+              envvar='FWA_DB')
+@click.option('--wsg', '-g', help='List of group codes to sync')
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of groups to load to staging in parallel')
+@click.option('--zipped', '-z', is_flag=True,
+              help='Read sources directly from the downloaded .zip archives')
+@click.option('--cache_path', '-c',
+              help='Path to cached archives (default is dl_path/cache)')
+@click.option('--engine', '-e', type=click.Choice(['ogr', 'copy']),
+              default='ogr',
+              help='Load with ogr2ogr (default) or with binary COPY')
+def sync(layers, skiplayers, dl_path, db_url, wsg, jobs, zipped, cache_path,
+         engine):
+    """Apply changes in new FWA source data to loaded (and cleaned) tables
+    """
+    db = fwa.util.connect(db_url)
+    if not db_url:
+        db_url = os.environ['FWA_DB']
+    in_layers = parse_layers(layers, skiplayers)
+    db.execute(fwa.queries['fwa_wsc2ltree'])
+    groups = sorted(wsg.split(',')) if wsg else None
+    changed_tables = []
+    affected = set()
+    for layer in settings.source_tables:
+        table = fwa.tables[layer['table']]
+        if layer['table'] not in in_layers:
+            continue
+        if table not in db.tables:
+            click.echo('{t}: not loaded, skipping (use load)'.format(t=layer['table']))
+            continue
+        gdb = fwa.util.source_path(layer['source_file'], dl_path, zipped,
+                                   cache_path)
+        if not gdb:
+            click.echo('{l}: source file {f} does not exist, skipping'
+                       .format(l=layer['table'], f=layer['source_file']))
+            continue
+        # load the new data to a staging table and clean it to match
+        staging = layer['table'] + '_sync'
+        db['whse_basemapping.' + staging].drop()
+        click.echo(layer['table'] + ': loading to ' + staging)
+        if layer['grouped']:
+            load_groups_parallel(gdb, staging,
+                                 groups or fwa.list_groups(db=db),
+                                 db_url, jobs, engine)
+        elif groups:
+            db.ogr2pg(gdb,
+                      in_layer=layer['table'].upper(),
+                      out_layer=staging,
+                      schema='whse_basemapping',
+                      sql='watershed_group_code IN ({g})'.format(
+                          g=",".join(["'{}'".format(g) for g in groups])),
+                      dim=3)
+        else:
+            dim = 2 if layer['table'] == 'fwa_watershed_groups_poly' else 3
+            load_layer(db, gdb, layer['table'].upper(), staging, dim=dim,
+                       engine=engine)
+        fwa.rewrite_table('whse_basemapping.' + staging, db=db)
+        # apply the differences
+        counts, table_groups = fwa.sync_table(table,
+                                              'whse_basemapping.' + staging,
+                                              layer['id'],
+                                              groups=groups,
+                                              db=db)
+        db['whse_basemapping.' + staging].drop()
+        click.echo('{t}: {i} inserted, {u} updated, {d} deleted'.format(
+            t=layer['table'], i=counts['inserted'], u=counts['updated'],
+            d=counts['deleted']))
+        if sum(counts.values()):
+            changed_tables.append(layer['table'])
+            affected.update(table_groups)
+            # integer array codes are not in staging, derive them again
+            if 'wscode_array' in db[table].columns:
+                fwa.add_wsc_arrays(table, db=db)
+            db.execute('ANALYZE {t}'.format(t=table))
+
+    # refresh derived tables for the groups that changed
+    if affected:
+        click.echo('Refreshing derived tables for groups: ' +
+                   ','.join(sorted(affected)))
+        fwa.refresh_derived(affected, changed_tables, db=db)
+    # rebuild downstream lengths if they are in use
+    if ('fwa_stream_networks_sp' in changed_tables and
+            fwa.LENGTH_DOWNSTREAM_TABLE in db.tables):
+        click.echo('Rebuilding ' + fwa.LENGTH_DOWNSTREAM_TABLE)
+        fwa.build_length_downstream(db=db)
+    # cached upstream geometries are no longer valid
+    if 'fwa_stream_networks_sp' in changed_tables:
+        fwa.clear_geomupstream_cache(db=db)
+    # rebuild stream profiles for the groups that changed
+    if ('fwa_stream_networks_sp' in changed_tables and affected and
+            fwa.STREAM_PROFILE_TABLE in db.tables):
+        click.echo('Rebuilding ' + fwa.STREAM_PROFILE_TABLE)
+        fwa.build_stream_profiles(affected, db=db)
+    # renumber intervals if they are in use
+    if [t for t in changed_tables if fwa.tables[t] in fwa.INTERVAL_TABLES and
+            'wscode_left' in db[fwa.tables[t]].columns]:
+        click.echo('Rebuilding watershed code intervals')
+        fwa.add_intervals(db=db)
+        # upstream totals change downstream of any change, rebuild them all
+        if fwa.LENGTH_UPSTREAM_TABLE in db.tables:
+            click.echo('Rebuilding ' + fwa.LENGTH_UPSTREAM_TABLE)
+            fwa.build_length_upstream(db=db)
+
+
+@cli.command()
 @click.option('--db_url', '-db', help='FWA database', envvar='FWA_DB')
-def populate_gradient(db_url, n_processes):
-    """ FWA Gradient column is empty, calculate it
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of indexes to build in parallel')
+def intervals(db_url, jobs):
+    """Number watershed codes for fast upstream queries (rebuild after load)
+    """
+    db = fwa.util.connect(db_url)
+    if not db_url:
+        db_url = os.environ['FWA_DB']
+    tables = [t for t in fwa.INTERVAL_TABLES if t in db.tables]
+    if not tables:
+        raise click.ClickException('Load and clean streams/watersheds first')
+    click.echo('Adding intervals to ' + ', '.join(tables))
+    fwa.add_intervals(tables, db=db)
+    indexes = [(t, c, 'btree', None)
+               for t in tables
+               for c in ['wscode_left', 'localcode_left']]
+    for sql, elapsed in fwa.create_indexes(indexes, db_url=db_url, jobs=jobs):
+        click.echo('{s:.1f}s: {sql}'.format(s=elapsed, sql=sql))
+    if 'whse_basemapping.fwa_stream_networks_sp' in tables:
+        db.execute(fwa.queries['fwa_lengthupstream_interval'])
+        db.execute(fwa.queries['fwa_geomupstream_interval'])
 
-    With millions of updates, this is an expensive operation. Run in parallel
-    to try and speed things up.
 
-    Todo: these calculations should take place at the same time as populating the ltree columns
-    https://dba.stackexchange.com/questions/52517/best-way-to-populate-a-new-column-in-a-large-table/52531#52531
+@cli.command()
+@click.option('--db_url', '-db', help='FWA database', envvar='FWA_DB')
+@click.option('--jobs', '-j', type=int, default=1,
+              help='Number of indexes to build in parallel')
+def wsc_arrays(db_url, jobs):
+    """Add integer array watershed codes, an alternative to ltree
     """
-    db = fwa.util.connect(db_url=db_url)
-    groups = fwa.list_groups(db=db)
+    db = fwa.util.connect(db_url)
+    if not db_url:
+        db_url = os.environ['FWA_DB']
+    tables = [t for t in fwa.WSC_ARRAY_TABLES if t in db.tables]
+    if not tables:
+        raise click.ClickException('Load and clean streams/watersheds first')
+    for table in tables:
+        click.echo('Adding integer array codes to ' + table)
+        fwa.add_wsc_arrays(table, db=db)
+    indexes = [(t, c, 'btree', None)
+               for t in tables
+               for c in fwa.WSC_ARRAY_COLUMNS.values()]
+    for sql, elapsed in fwa.create_indexes(indexes, db_url=db_url, jobs=jobs):
+        click.echo('{s:.1f}s: {sql}'.format(s=elapsed, sql=sql))
+    for function in ['fwa_upstreamwsc_array', 'fwa_downstreamwsc_array']:
+        db.execute(fwa.queries[function])
+    if 'whse_basemapping.fwa_stream_networks_sp' in tables:
+        db.execute(fwa.queries['fwa_lengthupstream_array'])
+        db.execute(fwa.queries['fwa_lengthdownstream_array'])
+
 
-    # load the query string
-    sql = fwa.queries['populate_gradient']
+@cli.command()
+@click.option('--db_url', '-db', help='FWA database', envvar='FWA_DB')
+@click.option('--wsg', '-g', help='List of group codes to rebuild')
+@click.option('--validate', '-v', type=int, default=0,
+              help='Check values at this many random locations against fwa_lengthdownstream')
+def length_downstream(db_url, wsg, validate):
+    """Precompute length downstream (to outlet) of each stream segment
+    """
+    db = fwa.util.connect(db_url)
+    groups = wsg.split(',') if wsg else None
+    start_time = time.time()
+    fwa.build_length_downstream(groups, db=db)
+    click.echo('{t}: built in {s:.1f}s'.format(t=fwa.LENGTH_DOWNSTREAM_TABLE,
+                                              s=time.time() - start_time))
+    if validate:
+        mismatches = fwa.validate_length_downstream(validate, db=db)
+        for blkey, measure, precomputed, calculated in mismatches:
+            click.echo('{b} {m:.1f}: {p} (precomputed), {c} (calculated)'.format(
+                b=blkey, m=measure, p=precomputed, c=calculated))
+        click.echo('{n} of {v} locations differ'.format(n=len(mismatches),
+                                                        v=validate))
 
-    # run updates on each group in parallel
-    func = partial(fwa.util.execute_parallel_wsg, sql, db_url=db_url)
 
-    # set number of processes 1-5, depending on how many cores available
-    # (the best number will depend on system resources and db settings, this
-    # is just a stab in the dark)
-    n_processes = max(1, min(5, multiprocessing.cpu_count() - 1))
-    pool = multiprocessing.Pool(processes=n_processes)
-    pool.map(func, groups)
+@cli.command()
+@click.option('--db_url', '-db', help='FWA database', envvar='FWA_DB')
+@click.option('--wsg', '-g', help='List of group codes to rebuild')
+def length_upstream(db_url, wsg):
+    """Precompute length upstream of each stream segment (run intervals first)
+    """
+    db = fwa.util.connect(db_url)
+    if 'wscode_left' not in db['whse_basemapping.fwa_stream_networks_sp'].columns:
+        raise click.ClickException('Streams have no intervals, run intervals first')
+    groups = wsg.split(',') if wsg else None
+    start_time = time.time()
+    fwa.build_length_upstream(groups, db=db)
+    click.echo('{t}: built in {s:.1f}s'.format(t=fwa.LENGTH_UPSTREAM_TABLE,
+                                              s=time.time() - start_time))
+
+
+@cli.command()
+@click.option('--db_url', '-db', help='FWA database', envvar='FWA_DB')
+@click.option('--wsg', '-g', help='List of group codes to rebuild')
+def stream_profiles(db_url, wsg):
+    """Precompute stream vertex elevations for fast elevation/slope lookups
+    """
+    db = fwa.util.connect(db_url)
+    groups = wsg.split(',') if wsg else None
+    start_time = time.time()
+    fwa.build_stream_profiles(groups, db=db)
+    click.echo('{t}: built in {s:.1f}s'.format(t=fwa.STREAM_PROFILE_TABLE,
+                                              s=time.time() - start_time))
+
+
+@cli.command()
+@click.option('--db_url', '-db', help='FWA database', envvar='FWA_DB')
+@click.option('--max_size_mb', '-m', type=int, default=1024,
+              help='Size at which least recently used entries are removed')
+@click.option('--clear', '-c', is_flag=True, help='Remove all cached entries')
+def geomupstream_cache(db_url, max_size_mb, clear):
+    """Create (or clear) cache of upstream geometries used by fwa_geomupstream_cached
+    """
+    db = fwa.util.connect(db_url)
+    fwa.create_geomupstream_cache(max_size_mb, db=db)
+    if clear:
+        fwa.clear_geomupstream_cache(db=db)
+        click.echo(fwa.GEOMUPSTREAM_CACHE + ': cleared')
+    elif fwa.validate_geomupstream_cache(db=db):
+        click.echo(fwa.GEOMUPSTREAM_CACHE + ': streams have changed, cleared')
+
+
+@cli.command()
+@click.option('--db_url', '-db', help='FWA database', envvar='FWA_DB')
+@click.option('--jobs', '-j', type=int,
+              default=max(1, min(5, multiprocessing.cpu_count() - 1)),
+              help='Number of updates to run in parallel')
+@click.option('--batch_size', '-b', type=int,
+              help='Size of linear_feature_id ranges to update in each batch '
+                   '(default is to update each group in one batch)')
+def populate_gradient(db_url, jobs, batch_size):
+    """FWA Gradient column is empty, calculate it
+
+    With millions of updates, this is an expensive operation. Run in parallel
+    (by watershed group and linear_feature_id range) to try and speed things
+    up. Each batch is committed on its own and only segments without a
+    gradient are updated, so re-running an interrupted job resumes where it
+    stopped.
+
+    To avoid the separate UPDATE pass entirely, use `fwakit clean --rewrite`,
+    which calculates gradient as the table is written.
+    """
+    db = fwa.util.connect(db_url=db_url)
+    if not db_url:
+        db_url = os.environ['FWA_DB']
+
+    # find the ranges of ids remaining to be updated in each group
+    sql = """SELECT
+               watershed_group_code,
+               min(linear_feature_id),
+               max(linear_feature_id)
+             FROM whse_basemapping.fwa_stream_networks_sp
+             WHERE gradient IS NULL
+             GROUP BY watershed_group_code
+             ORDER BY watershed_group_code"""
+    batches = []
+    for group, min_id, max_id in db.query(sql).fetchall():
+        if not batch_size:
+            batches.append((group, min_id, max_id + 1))
+        else:
+            for start_id in range(min_id, max_id + 1, batch_size):
+                batches.append((group, start_id, start_id + batch_size))
+    if not batches:
+        click.echo('Gradient is already populated')
+        return
+    click.echo('Populating gradient, {n} batches with {j} job(s)'.format(
+        n=len(batches), j=jobs))
+
+    # run the updates
+    func = partial(fwa.util.execute_parallel,
+                   fwa.queries['populate_gradient'],
+                   db_url=db_url)
+    pool = multiprocessing.Pool(processes=jobs)
+    for i, (params, elapsed) in enumerate(pool.imap_unordered(func, batches)):
+        click.echo('{g} {a}-{b}: {s:.1f}s ({i}/{n})'.format(
+            g=params[0], a=params[1], b=params[2], s=elapsed, i=i + 1,
+            n=len(batches)))
     pool.close()
     pool.join()
 
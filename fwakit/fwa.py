@@ -9,16 +9,73 @@ Tools for working with BC Freshwater Atlas loaded to PostgreSQL
 from __future__ import absolute_import
 
 import datetime
+import multiprocessing
+import os
 import re
+from functools import partial
 
 from sqlalchemy.dialects.postgresql import INTEGER, BIGINT
 
+import pgdata
+
 import fwakit as fwa
+from fwakit import pgcopy
+from fwakit import settings
 from fwakit import util
 
 
 queries = util.QueryDict()
 
+# column on which grouped tables are partitioned
+PARTITION_KEY = "watershed_group_code"
+
+# ltree columns to derive from watershed code columns
+LTREE_COLUMNS = {"fwa_watershed_code": "wscode_ltree",
+                 "local_watershed_code": "localcode_ltree"}
+
+# integer array columns to derive from watershed code columns (optional,
+# an alternative to ltree - see add_wsc_arrays)
+WSC_ARRAY_COLUMNS = {"fwa_watershed_code": "wscode_array",
+                     "local_watershed_code": "localcode_array"}
+
+# tables to add integer array watershed codes to
+WSC_ARRAY_TABLES = ["whse_basemapping.fwa_stream_networks_sp",
+                    "whse_basemapping.fwa_watersheds_poly_sp"]
+
+# gradient of a stream segment, from elevation at ends of the (single part) line
+GRADIENT_SQL = """round(
+      ((ST_Z(ST_PointN(ST_GeometryN(geom, 1), -1)) -
+        ST_Z(ST_PointN(ST_GeometryN(geom, 1), 1))) /
+       NULLIF(ST_Length(ST_GeometryN(geom, 1)), 0))::numeric, 4
+    )::double precision"""
+
+# tables with watershed codes numbered by a depth first walk of the code tree
+INTERVAL_TABLES = ["whse_basemapping.fwa_stream_networks_sp",
+                   "whse_basemapping.fwa_watersheds_poly_sp"]
+
+# (left, right) interval columns to derive from ltree columns
+INTERVAL_COLUMNS = {"wscode_ltree": ("wscode_left", "wscode_right"),
+                    "localcode_ltree": ("localcode_left", "localcode_right")}
+
+# lookup of the interval of each code
+INTERVAL_LOOKUP = "whse_basemapping.fwa_wsc_intervals"
+
+# precomputed length upstream of each stream segment
+LENGTH_UPSTREAM_TABLE = "whse_basemapping.fwa_stream_networks_lengthupstream"
+
+# precomputed length downstream (distance to outlet) of each stream segment,
+# and of the mouth of each watershed code
+LENGTH_DOWNSTREAM_TABLE = "whse_basemapping.fwa_stream_networks_lengthdownstream"
+LENGTH_DOWNSTREAM_LOOKUP = "whse_basemapping.fwa_wsc_lengthdownstream"
+
+# elevation at each vertex of each blue line
+STREAM_PROFILE_TABLE = "whse_basemapping.fwa_stream_profiles"
+
+# cache of upstream geometries (by segment and simplification tolerance),
+# and its size limit and the signature of the streams it was built from
+GEOMUPSTREAM_CACHE = "whse_basemapping.fwa_geomupstream_cache"
+GEOMUPSTREAM_CACHE_SETTINGS = "whse_basemapping.fwa_geomupstream_cache_settings"
+
 
 def list_groups(table=None, db=None):
     """Return sorted list of watershed groups in specified table
@@ -50,36 +107,46 @@ def get_local_code(blue_line_key, measure, db=None):
         return None
 
 
-def add_ltree(table, column_lookup={"fwa_watershed_code": "wscode_ltree",
-                                    "local_watershed_code": "localcode_ltree"},
-              db=None):
+def add_code_columns(table, column_lookup, function, column_type, db=None):
     """
-    Add watershed code ltree types and indexes to specified table.
+    Add columns derived from watershed codes to table, calculating each new
+    column with function (eg fwa_wsc2ltree) applied to its source column.
     (making a copy of the table is *much* faster than updating)
+
+    Returns the new columns added.
     """
     if not db:
         db = util.connect()
     # only add columns if source is present and new column not present
     new_columns = {k: v for (k, v) in column_lookup.items()
         if k in db[table].columns and v not in db[table].columns}
-    if new_columns:
+    if new_columns and is_partitioned(table, db=db):
+        code_sql = ", ".join(["{f}({c}) as {n}".format(f=function, c=c, n=n)
+                              for (c, n) in new_columns.items()])
+        rebuild_partitioned(table,
+                            "SELECT *, {code_sql} FROM {{t}}".format(
+                                code_sql=code_sql),
+                            db=db)
+    elif new_columns:
         # create new table
         db[table+"_tmp"].drop()
         db.execute("""CREATE TABLE {t}_tmp
                       (LIKE {t} INCLUDING ALL)""".format(t=table))
-        ltree_list = []
+        code_list = []
         # add columns to new table
         for column in new_columns:
-            db.execute("""ALTER TABLE {t}_tmp ADD COLUMN {c} ltree
-                       """.format(t=table, c=column_lookup[column]))
+            db.execute("""ALTER TABLE {t}_tmp ADD COLUMN {c} {ct}
+                       """.format(t=table, c=column_lookup[column],
+                                  ct=column_type))
             # add columns to select string
-            ltree_list.append("fwa_wsc2ltree({incolumn}) as {outcolumn}"
-                .format(incolumn=column, outcolumn=column_lookup[column]))
+            code_list.append("{f}({incolumn}) as {outcolumn}"
+                .format(f=function, incolumn=column,
+                        outcolumn=column_lookup[column]))
 
         # insert data
-        ltree_sql = ", ".join(ltree_list)
-        sql = """INSERT INTO {t}_tmp (SELECT *, {ltree_sql} FROM {t})
-              """.format(ltree_sql=ltree_sql, t=table)
+        code_sql = ", ".join(code_list)
+        sql = """INSERT INTO {t}_tmp (SELECT *, {code_sql} FROM {t})
+              """.format(code_sql=code_sql, t=table)
         db.execute(sql)
 
         # drop original table
@@ -87,14 +154,847 @@ def add_ltree(table, column_lookup={"fwa_watershed_code": "wscode_ltree",
         # rename new table back to original name
         _, tablename = db.parse_table_name(table)
         db[table+'_tmp'].rename(tablename)
+    return list(new_columns.values())
+
 
+def add_ltree(table, column_lookup=LTREE_COLUMNS, index=True, db=None):
+    """
+    Add watershed code ltree types and indexes to specified table.
+    """
+    if not db:
+        db = util.connect()
+    new_columns = add_code_columns(table, column_lookup, "fwa_wsc2ltree",
+                                   "ltree", db=db)
+    if new_columns and index:
         # create ltree indexes
-        for column in new_columns.values():
+        for column in new_columns:
             for index_type in ["btree", "gist"]:
                 db[table].create_index([column], index_type=index_type)
 
 
-def get_events(table, pk, filters=None, param=None, db=None):
+def add_wsc_arrays(table, column_lookup=WSC_ARRAY_COLUMNS, db=None):
+    """
+    Add watershed codes as integer arrays (one element per level, see
+    fwa_wsc2array) to specified table. Arrays compare as ltree codes do, so
+    a btree index is all that the fwa_*_array functions require.
+
+    If the columns are already present, only rows where the array no longer
+    matches the watershed code are updated (for use after sync).
+    Indexes are not created (see `fwakit wsc_arrays`).
+    """
+    if not db:
+        db = util.connect()
+    db.execute(queries["fwa_wsc2array"])
+    new_columns = add_code_columns(table, column_lookup, "fwa_wsc2array",
+                                   "integer[]", db=db)
+    for code_column, array_column in column_lookup.items():
+        if (code_column in db[table].columns and
+                array_column not in new_columns):
+            db.execute("""UPDATE {t}
+                          SET {a} = fwa_wsc2array({c})
+                          WHERE {a} IS DISTINCT FROM fwa_wsc2array({c})
+                       """.format(t=table, a=array_column, c=code_column))
+
+
+def is_partitioned(table, db=None):
+    """Return True if table exists and is a partitioned table
+    """
+    if not db:
+        db = util.connect()
+    result = db.query_one("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)",
+                          (table,))
+    return bool(result) and result[0] == "p"
+
+
+def list_partitions(table, db=None):
+    """
+    Return sorted list of (partition table, watershed group code) tuples for
+    the partitions of specified table
+    """
+    if not db:
+        db = util.connect()
+    sql = """SELECT
+               n.nspname || '.' || c.relname as partition,
+               pg_get_expr(c.relpartbound, c.oid) as bound
+             FROM pg_inherits i
+             INNER JOIN pg_class c ON i.inhrelid = c.oid
+             INNER JOIN pg_namespace n ON c.relnamespace = n.oid
+             WHERE i.inhparent = to_regclass(%s)
+             ORDER BY c.relname"""
+    partitions = []
+    for partition, bound in db.query(sql, (table,)).fetchall():
+        # bounds are of form FOR VALUES IN ('SALM')
+        group = re.search(r"\('(\w+)'\)", bound).group(1)
+        partitions.append((partition, group))
+    return partitions
+
+
+def attach_partition(table, partition_table, group, db=None):
+    """
+    Attach partition_table to partitioned table as the partition holding
+    rows for watershed group. The partitioned table is created (using
+    partition_table as a template) if it does not exist. Any existing
+    partition for the group is replaced - the swap is done in a single
+    transaction so queries never see a missing group.
+    """
+    if not db:
+        db = util.connect()
+    schema, tablename = db.parse_table_name(table)
+    partition = "{t}_{g}".format(t=tablename, g=group.lower())
+    if not is_partitioned(table, db=db):
+        db.execute("""CREATE TABLE IF NOT EXISTS {t}
+                      (LIKE {p})
+                      PARTITION BY LIST ({k})
+                   """.format(t=table, p=partition_table, k=PARTITION_KEY))
+    sql = ["DROP TABLE IF EXISTS {s}.{p}".format(s=schema, p=partition)]
+    # partitions must have the NOT NULL constraints of the parent (eg primary
+    # key columns once the table is cleaned), tables built by loading or by
+    # rewrite_table have none
+    not_null = [r[0] for r in db.query(
+        """SELECT attname FROM pg_attribute
+           WHERE attrelid = to_regclass(%s)
+           AND attnum > 0 AND attnotnull AND NOT attisdropped
+           ORDER BY attnum""", (table,)).fetchall()]
+    if not_null:
+        sql.append("ALTER TABLE {pt} {c}".format(
+            pt=partition_table,
+            c=", ".join(["ALTER COLUMN {} SET NOT NULL".format(c)
+                         for c in not_null])))
+    if partition_table != schema + "." + partition:
+        sql.append("ALTER TABLE {pt} RENAME TO {p}".format(pt=partition_table,
+                                                           p=partition))
+    sql.append("""ALTER TABLE {t} ATTACH PARTITION {s}.{p} FOR VALUES IN (%s)
+               """.format(t=table, s=schema, p=partition))
+    db.execute(";\n".join(sql), (group,))
+
+
+def add_parent_columns(table, partition_table, db=None):
+    """
+    Add columns of partitioned table that are missing from partition_table
+    (eg intervals, which are not created by rewrite_table) so that it can be
+    attached as a partition. Added interval columns are numbered from
+    INTERVAL_LOOKUP, other added columns are NULL. Returns list of columns
+    added.
+    """
+    if not db:
+        db = util.connect()
+    extra = set(db[partition_table].columns) - set(db[table].columns)
+    if extra:
+        raise ValueError("{p} has columns not present in {t}: {c}".format(
+            p=partition_table, t=table, c=", ".join(sorted(extra))))
+    existing = db[partition_table].columns
+    added = [(column, column_type) for column, column_type in db.query(
+        """SELECT attname, format_type(atttypid, atttypmod)
+           FROM pg_attribute
+           WHERE attrelid = to_regclass(%s)
+           AND attnum > 0 AND NOT attisdropped
+           ORDER BY attnum""", (table,)).fetchall()
+        if column not in existing]
+    if not added:
+        return []
+    db.execute("ALTER TABLE {p} {c}".format(
+        p=partition_table,
+        c=", ".join(["ADD COLUMN {} {}".format(column, column_type)
+                     for column, column_type in added])))
+    added = [column for column, column_type in added]
+    # codes not present when the intervals were built remain NULL until
+    # intervals are rebuilt (see add_intervals)
+    if INTERVAL_LOOKUP in db.tables:
+        for code_column, (left, right) in INTERVAL_COLUMNS.items():
+            if left in added and code_column in existing:
+                db.execute("""UPDATE {p} t
+                              SET {l} = i.lft, {r} = i.rgt
+                              FROM {i} i
+                              WHERE t.{c} = i.code
+                           """.format(p=partition_table, i=INTERVAL_LOOKUP,
+                                      c=code_column, l=left, r=right))
+    return added
+
+
+def load_partition(group, in_file, table, db_url=None, engine="ogr"):
+    """
+    Load layer for specified watershed group from in_file (with ogr2ogr or
+    binary COPY) and attach it to table as a partition, using a non-pooled
+    connection. Returns the group and the time taken (seconds)
+    """
+    if not db_url:
+        db_url = os.environ["FWA_DB"]
+    start_time = datetime.datetime.now()
+    db = pgdata.connect(db_url, multiprocessing=True)
+    schema, tablename = db.parse_table_name(table)
+    staging = "{t}_{g}_load".format(t=tablename, g=group.lower())
+    if engine == "copy":
+        # copy to an unlogged table, logging it once loaded
+        db.execute("DROP TABLE IF EXISTS {s}.{t}".format(s=schema, t=staging))
+        pgcopy.copy_layer(in_file, group, schema + "." + staging, db, dim=3)
+        db.execute("ALTER TABLE {s}.{t} SET LOGGED".format(s=schema, t=staging))
+    else:
+        db.ogr2pg(in_file,
+                  in_layer=group,
+                  out_layer=staging,
+                  schema=schema,
+                  dim=3)
+    # if the existing table has been cleaned, clean the new data to match
+    if (is_partitioned(table, db=db) and
+            set(db[schema + "." + staging].columns) != set(db[table].columns)):
+        rewrite_table(schema + "." + staging,
+                      wsc_arrays="wscode_array" in db[table].columns,
+                      db=db)
+        added = add_parent_columns(table, schema + "." + staging, db=db)
+        if added:
+            util.log("{t}: added {c} to partition {g}".format(
+                t=table, c=", ".join(added), g=group))
+    attach_partition(table, schema + "." + staging, group, db=db)
+    elapsed = (datetime.datetime.now() - start_time).total_seconds()
+    util.log("{t}: loaded partition {g} in {s:.1f}s".format(t=table, g=group,
+                                                            s=elapsed))
+    return (group, elapsed)
+
+
+def rebuild_partitioned(table, select_sql, db=None):
+    """
+    Rebuild each partition of table using provided select_sql, where {t} in
+    the query is the partition being rebuilt. (making new partitions and
+    swapping them in is *much* faster than updating)
+    """
+    if not db:
+        db = util.connect()
+    schema, tablename = db.parse_table_name(table)
+    partitions = list_partitions(table, db=db)
+    if not partitions:
+        raise ValueError("{t} has no partitions to rebuild".format(t=table))
+    for partition, group in partitions:
+        db.execute("DROP TABLE IF EXISTS {p}_tmp".format(p=partition))
+        db.execute("CREATE TABLE {p}_tmp AS {sql}".format(
+            p=partition, sql=select_sql.format(t=partition)))
+    # create a new parent with the structure of the new partitions
+    db.execute("DROP TABLE IF EXISTS {t}_tmp".format(t=table))
+    db.execute("""CREATE TABLE {t}_tmp
+                  (LIKE {p}_tmp)
+                  PARTITION BY LIST ({k})
+               """.format(t=table, p=partitions[0][0], k=PARTITION_KEY))
+    # swap the tables, dropping the parent drops the old partitions
+    sql = ["DROP TABLE {t}".format(t=table),
+           "ALTER TABLE {t}_tmp RENAME TO {n}".format(t=table, n=tablename)]
+    for partition, group in partitions:
+        _, partition_name = db.parse_table_name(partition)
+        sql.append("ALTER TABLE {p}_tmp RENAME TO {n}".format(p=partition,
+                                                              n=partition_name))
+        sql.append("ALTER TABLE {t} ATTACH PARTITION {p} FOR VALUES IN ('{g}')"
+                   .format(t=table, p=partition, g=group))
+    db.execute(";\n".join(sql))
+
+
+def add_primary_key(table, column, db=None):
+    """
+    Add primary key to table. Primary keys on partitioned tables must
+    include the partition key.
+    """
+    if not db:
+        db = util.connect()
+    if is_partitioned(table, db=db):
+        db.execute("ALTER TABLE {t} ADD PRIMARY KEY ({c}, {k})".format(
+            t=table, c=column, k=PARTITION_KEY))
+    else:
+        db[table].add_primary_key(column)
+
+
+def rewrite_sql(columns, wsc_arrays=False):
+    """
+    Return a select (from {t}) that cleans a loaded FWA table in one pass:
+      - drop ogr and esri columns
+      - cast _id columns to integer (ogr maps them to double)
+      - convert '<Null>' strings in watershed codes to NULL
+      - derive ltree columns from watershed codes
+      - derive integer array columns from watershed codes (if wsc_arrays)
+      - calculate gradient
+    """
+    derived = list(LTREE_COLUMNS.values()) + list(WSC_ARRAY_COLUMNS.values())
+    select = []
+    for column in columns:
+        if column in settings.drop_columns or column in derived:
+            continue
+        elif column[-3:] == "_id":
+            if column == "linear_feature_id":
+                column_type = "bigint"
+            else:
+                column_type = "integer"
+            select.append("{c}::{t} AS {c}".format(c=column, t=column_type))
+        elif column in LTREE_COLUMNS:
+            select.append("NULLIF({c}, '<Null>') AS {c}".format(c=column))
+        elif column == "gradient" and "geom" in columns:
+            select.append(GRADIENT_SQL + " AS gradient")
+        else:
+            select.append(column)
+    for column in [c for c in LTREE_COLUMNS if c in columns]:
+        select.append("fwa_wsc2ltree(NULLIF({c}, '<Null>')) AS {l}".format(
+            c=column, l=LTREE_COLUMNS[column]))
+    if wsc_arrays:
+        for column in [c for c in WSC_ARRAY_COLUMNS if c in columns]:
+            select.append("fwa_wsc2array(NULLIF({c}, '<Null>')) AS {a}".format(
+                c=column, a=WSC_ARRAY_COLUMNS[column]))
+    return "SELECT\n  " + ",\n  ".join(select) + "\nFROM {t}"
+
+
+def rewrite_table(table, wsc_arrays=False, db=None):
+    """
+    Clean a loaded FWA table with a single CREATE TABLE AS (see rewrite_sql),
+    rather than rewriting the table with a series of ALTER and UPDATE
+    statements. Indexes and constraints must be added afterwards.
+    """
+    if not db:
+        db = util.connect()
+    if wsc_arrays:
+        db.execute(queries["fwa_wsc2array"])
+    select_sql = rewrite_sql(db[table].columns, wsc_arrays=wsc_arrays)
+    if is_partitioned(table, db=db):
+        rebuild_partitioned(table, select_sql, db=db)
+    else:
+        db.execute("DROP TABLE IF EXISTS {t}_tmp".format(t=table))
+        db.execute("CREATE TABLE {t}_tmp AS {sql}".format(
+            t=table, sql=select_sql.format(t=table)))
+        _, tablename = db.parse_table_name(table)
+        db.execute("""DROP TABLE {t};
+                      ALTER TABLE {t}_tmp RENAME TO {n}
+                   """.format(t=table, n=tablename))
+
+
+def row_hash_sql(alias, columns):
+    """Return expression hashing columns of a row (for change detection)
+    """
+    return "md5(ROW({c})::text)".format(
+        c=", ".join(["{a}.{c}".format(a=alias, c=c) for c in columns]))
+
+
+def sync_table(table, staging_table, pk, groups=None, db=None):
+    """
+    Apply differences between staging_table (a newly loaded and cleaned copy
+    of the source) and table, matching features by primary key pk and
+    comparing a hash of each row:
+      - delete features no longer present in the source
+      - update features that have changed
+      - insert new features
+    If groups are provided, the staging table holds only those watershed
+    groups and deletes are restricted to them.
+
+    Returns a dict of counts for each operation and the set of watershed
+    groups that were affected (empty if table has no watershed_group_code).
+    """
+    if not db:
+        db = util.connect()
+    staging_columns = db[staging_table].columns
+    columns = [c for c in db[table].columns if c in staging_columns]
+    # derived columns are rebuilt from the other columns, don't compare them
+    derived = (list(LTREE_COLUMNS.values()) +
+               list(WSC_ARRAY_COLUMNS.values()) + ["gradient"])
+    compare = [c for c in columns if c not in derived]
+    grouped = PARTITION_KEY in columns
+    params = {"groups": list(groups or [])}
+    if groups and grouped:
+        group_filter = "AND t.{k} = ANY(%(groups)s)".format(k=PARTITION_KEY)
+    else:
+        group_filter = ""
+    affected = set()
+    counts = {}
+
+    # note groups of changed features, before and after the update
+    # (features may move to a different group)
+    if grouped:
+        sql = """SELECT DISTINCT t.{k}, s.{k}
+                 FROM {t} t
+                 INNER JOIN {s} s ON t.{pk} = s.{pk}
+                 WHERE {th} <> {sh}
+              """.format(k=PARTITION_KEY, t=table, s=staging_table, pk=pk,
+                         th=row_hash_sql("t", compare),
+                         sh=row_hash_sql("s", compare))
+        for old_group, new_group in db.query(sql):
+            affected.update([old_group, new_group])
+
+    returning = "RETURNING t.{k}".format(k=PARTITION_KEY) if grouped else ""
+    sql = """DELETE FROM {t} t
+             WHERE NOT EXISTS (SELECT 1 FROM {s} s WHERE s.{pk} = t.{pk})
+             {f}
+             {r}
+          """.format(t=table, s=staging_table, pk=pk, f=group_filter,
+                     r=returning)
+    if grouped:
+        rows = db.query(sql, params).fetchall()
+        counts["deleted"] = len(rows)
+        affected.update([r[0] for r in rows])
+    else:
+        counts["deleted"] = db.execute(sql, params).rowcount
+
+    sql = """UPDATE {t} t
+             SET ({c}) = ROW({sc})
+             FROM {s} s
+             WHERE t.{pk} = s.{pk}
+             AND {th} <> {sh}
+          """.format(t=table, s=staging_table, pk=pk,
+                     c=", ".join(columns),
+                     sc=", ".join(["s." + c for c in columns]),
+                     th=row_hash_sql("t", compare),
+                     sh=row_hash_sql("s", compare))
+    counts["updated"] = db.execute(sql).rowcount
+
+    sql = """INSERT INTO {t} AS t ({c})
+             SELECT {sc}
+             FROM {s} s
+             WHERE NOT EXISTS (SELECT 1 FROM {t} x WHERE x.{pk} = s.{pk})
+             {r}
+          """.format(t=table, s=staging_table, pk=pk,
+                     c=", ".join(columns),
+                     sc=", ".join(["s." + c for c in columns]),
+                     r=returning)
+    if grouped:
+        rows = db.query(sql).fetchall()
+        counts["inserted"] = len(rows)
+        affected.update([r[0] for r in rows])
+    else:
+        counts["inserted"] = db.execute(sql).rowcount
+    return counts, affected
+
+
+def refresh_derived(groups, changed_tables, db=None):
+    """
+    Refresh tables derived from the source tables (fwa_named_streams,
+    fwa_blue_lines, fwa_waterbodies, fwa_watershed_groups_subdivided) for
+    the provided watershed groups only, after changed_tables have been
+    synced.
+    Tables that do not exist yet, or with sources that are not loaded, are
+    left alone (run clean to create them).
+    """
+    if not db:
+        db = util.connect()
+    groups = sorted(groups)
+    if not groups:
+        return
+    params = {"groups": groups}
+    named_streams_sources = ["fwa_stream_networks_sp",
+                             "fwa_lakes_poly",
+                             "fwa_manmade_waterbodies_poly"]
+    waterbody_sources = ["fwa_lakes_poly",
+                         "fwa_wetlands_poly",
+                         "fwa_rivers_poly",
+                         "fwa_manmade_waterbodies_poly",
+                         "fwa_glaciers_poly"]
+    derived = {
+        "fwa_named_streams": named_streams_sources,
+        "fwa_blue_lines": ["fwa_stream_networks_sp"],
+        "fwa_waterbodies": waterbody_sources,
+        "fwa_watershed_groups_subdivided": ["fwa_watershed_groups_poly"]}
+    for table, sources in derived.items():
+        if ("whse_basemapping." + table in db.tables and
+                all(["whse_basemapping." + t in db.tables for t in sources]) and
+                set(sources) & set(changed_tables)):
+            db.execute(queries["refresh_" + table], params)
+
+
+def wsc_intervals(codes):
+    """
+    Number watershed codes with a depth first walk of the watershed code
+    tree. Codes (ltree text, eg '100.190442') must be distinct and sorted in
+    ltree order, which is the order of a depth first walk - a code is
+    followed by all of its descendants.
+
+    Yields (code, left, right) for each code, where left is the position of
+    the code in the walk and right is the position of its last descendant.
+    Code b is a descendant of (upstream of) code a when left of b falls
+    between left and right of a.
+    """
+    stack = []
+    left = 0
+    for left, code in enumerate(codes, 1):
+        while stack and not code.startswith(stack[-1][0] + "."):
+            parent, parent_left = stack.pop()
+            yield (parent, parent_left, left - 1)
+        stack.append((code, left))
+    while stack:
+        parent, parent_left = stack.pop()
+        yield (parent, parent_left, left)
+
+
+def build_intervals(tables=INTERVAL_TABLES, chunk_size=100000, db=None):
+    """
+    Create table INTERVAL_LOOKUP, holding the (left, right) interval of
+    every watershed and local code present in tables
+    """
+    if not db:
+        db = util.connect()
+    sql = " UNION ".join(
+        ["SELECT {c} AS code FROM {t} WHERE {c} IS NOT NULL".format(c=c, t=t)
+         for t in tables for c in INTERVAL_COLUMNS])
+    codes = (str(r[0]) for r in db.query(
+        "SELECT code FROM ({sql}) AS codes ORDER BY code".format(sql=sql)))
+    db.execute("DROP TABLE IF EXISTS {t}".format(t=INTERVAL_LOOKUP))
+    db.execute("""CREATE TABLE {t}
+                  (code ltree PRIMARY KEY,
+                   lft integer,
+                   rgt integer)""".format(t=INTERVAL_LOOKUP))
+    util.copy_rows(wsc_intervals(codes), INTERVAL_LOOKUP, ["code", "lft", "rgt"],
+                   db, chunk_size=chunk_size)
+    db.execute("ANALYZE {t}".format(t=INTERVAL_LOOKUP))
+
+
+def add_intervals(tables=INTERVAL_TABLES, db=None):
+    """
+    Add interval columns (see INTERVAL_COLUMNS) to tables from a depth first
+    walk of the watershed code tree, so that upstream queries can use btree
+    range tests rather than ltree comparisons. Intervals are numbered over
+    all provided tables, they must be rebuilt for all tables after any table
+    is reloaded or synced.
+    """
+    if not db:
+        db = util.connect()
+    tables = [t for t in tables if t in db.tables]
+    build_intervals(tables, db=db)
+    for table in tables:
+        for code_column, (left, right) in INTERVAL_COLUMNS.items():
+            for column in [left, right]:
+                if column not in db[table].columns:
+                    db.execute("ALTER TABLE {t} ADD COLUMN {c} integer".format(
+                        t=table, c=column))
+            # only write rows that have changed
+            db.execute("""UPDATE {t} t
+                          SET {l} = i.lft, {r} = i.rgt
+                          FROM {i} i
+                          WHERE t.{c} = i.code
+                          AND (t.{l} IS DISTINCT FROM i.lft OR
+                               t.{r} IS DISTINCT FROM i.rgt)
+                       """.format(t=table, i=INTERVAL_LOOKUP, c=code_column,
+                                  l=left, r=right))
+            db.execute("""UPDATE {t}
+                          SET {l} = NULL, {r} = NULL
+                          WHERE {c} IS NULL AND {l} IS NOT NULL
+                       """.format(t=table, c=code_column, l=left, r=right))
+
+
+def build_length_upstream(groups=None, db=None):
+    """
+    Calculate the length of stream upstream of every stream segment (in the
+    provided watershed groups, or all groups) in one pass over the network,
+    writing to LENGTH_UPSTREAM_TABLE, and create fwa_lengthupstream_lookup,
+    which looks up these totals.
+
+    Stream intervals must be current (see add_intervals). Totals include
+    everything upstream, so when rebuilding for specific groups include any
+    groups downstream of those that have changed.
+    """
+    if not db:
+        db = util.connect()
+    streams = "whse_basemapping.fwa_stream_networks_sp"
+    if "wscode_left" not in db[streams].columns:
+        raise ValueError("{t} has no intervals, run add_intervals first".format(
+            t=streams))
+    db.execute("""CREATE TABLE IF NOT EXISTS {t}
+                  (linear_feature_id bigint PRIMARY KEY,
+                   watershed_group_code text,
+                   length_upstream double precision)
+               """.format(t=LENGTH_UPSTREAM_TABLE))
+    if groups:
+        groups = list(groups)
+        db.execute("DELETE FROM {t} WHERE watershed_group_code = ANY(%(groups)s)"
+                   .format(t=LENGTH_UPSTREAM_TABLE), {"groups": groups})
+    else:
+        groups = None
+        db.execute("TRUNCATE {t}".format(t=LENGTH_UPSTREAM_TABLE))
+    db.execute(queries["create_fwa_stream_networks_lengthupstream"],
+               {"groups": groups})
+    db.execute("ANALYZE {t}".format(t=LENGTH_UPSTREAM_TABLE))
+    db.execute(queries["fwa_lengthupstream_lookup"])
+
+
+def accumulate_downstream(codes):
+    """
+    Accumulate length below the mouths of watershed codes. Codes must be
+    provided as (code, length) tuples sorted in ltree order, where length is
+    the length of stream on the parent code below the mouth of the code.
+
+    Yields (code, total) for each code, where total is the length from the
+    mouth of the code to the outlet - the length of the code plus the total
+    of its nearest ancestor.
+    """
+    stack = []
+    for code, length in codes:
+        while stack and not code.startswith(stack[-1][0] + "."):
+            stack.pop()
+        total = length + (stack[-1][1] if stack else 0)
+        stack.append((code, total))
+        yield (code, total)
+
+
+def build_length_downstream(groups=None, chunk_size=100000, db=None):
+    """
+    Calculate length downstream (distance to outlet) of every stream segment
+    (in the provided watershed groups, or all groups), writing to
+    LENGTH_DOWNSTREAM_TABLE, and create fwa_lengthdownstream_lookup and
+    fwa_lengthinstream_lookup functions that use these values.
+
+    Lengths below the mouth of each watershed code are accumulated down the
+    code tree in one pass (see accumulate_downstream), then each segment
+    adds the length below it on its own code.
+    """
+    if not db:
+        db = util.connect()
+    codes = [(str(r[0]), r[1])
+             for r in db.query(queries["wsc_length_below_mouth"])]
+    db.execute("DROP TABLE IF EXISTS {t}".format(t=LENGTH_DOWNSTREAM_LOOKUP))
+    db.execute("""CREATE TABLE {t}
+                  (code ltree PRIMARY KEY,
+                   length_downstream double precision)
+               """.format(t=LENGTH_DOWNSTREAM_LOOKUP))
+    util.copy_rows(accumulate_downstream(codes), LENGTH_DOWNSTREAM_LOOKUP,
+                   ["code", "length_downstream"], db, chunk_size=chunk_size)
+    db.execute("""CREATE TABLE IF NOT EXISTS {t}
+                  (linear_feature_id bigint PRIMARY KEY,
+                   watershed_group_code text,
+                   length_downstream double precision)
+               """.format(t=LENGTH_DOWNSTREAM_TABLE))
+    if groups:
+        groups = list(groups)
+        db.execute("DELETE FROM {t} WHERE watershed_group_code = ANY(%(groups)s)"
+                   .format(t=LENGTH_DOWNSTREAM_TABLE), {"groups": groups})
+    else:
+        groups = None
+        db.execute("TRUNCATE {t}".format(t=LENGTH_DOWNSTREAM_TABLE))
+    db.execute(queries["create_fwa_stream_networks_lengthdownstream"],
+               {"groups": groups})
+    db.execute("ANALYZE {t}".format(t=LENGTH_DOWNSTREAM_TABLE))
+    db.execute(queries["fwa_upstreamwsc"])
+    db.execute(queries["fwa_lengthdownstream_lookup"])
+    db.execute(queries["fwa_lengthinstream_lookup"])
+
+
+def validate_length_downstream(sample_size=100, tolerance=0.01, db=None):
+    """
+    Compare precomputed downstream lengths with fwa_lengthdownstream (which
+    sums the downstream segments on each call) at the midpoints of a random
+    sample of stream segments.
+
+    Returns a list of (blue_line_key, measure, precomputed, calculated) for
+    locations where the values differ by more than tolerance (metres).
+    """
+    if not db:
+        db = util.connect()
+    db.execute(queries["fwa_lengthdownstream"])
+    sql = """SELECT blue_line_key, measure,
+                    fwa_lengthdownstream_lookup(blue_line_key, measure),
+                    fwa_lengthdownstream(blue_line_key, measure)
+             FROM
+               (SELECT blue_line_key,
+                       downstream_route_measure + (length_metre / 2) AS measure
+                FROM {t} TABLESAMPLE SYSTEM_ROWS(%s)
+                WHERE localcode_ltree IS NOT NULL) AS sample
+          """
+    db.execute("CREATE EXTENSION IF NOT EXISTS tsm_system_rows")
+    results = db.query(sql.format(t="whse_basemapping.fwa_stream_networks_sp"),
+                       (sample_size,))
+    return [r for r in results
+            if (r[2] is None) != (r[3] is None) or
+            (r[2] is not None and abs(r[2] - r[3]) > tolerance)]
+
+
+def build_stream_profiles(groups=None, db=None):
+    """
+    Write the measure and elevation of every vertex of every stream segment
+    (in the provided watershed groups, or all groups) to
+    STREAM_PROFILE_TABLE, and replace fwa_elevation (used by fwa_slope and
+    fwa_slopewindow) with a version that looks up and interpolates between
+    these vertices rather than working with segment geometries.
+    """
+    if not db:
+        db = util.connect()
+    db.execute("""CREATE TABLE IF NOT EXISTS {t}
+                  (blue_line_key integer,
+                   downstream_route_measure double precision,
+                   elevation double precision,
+                   watershed_group_code text,
+                   PRIMARY KEY (blue_line_key, downstream_route_measure)
+                   INCLUDE (elevation))
+               """.format(t=STREAM_PROFILE_TABLE))
+    if groups:
+        groups = list(groups)
+        db.execute("DELETE FROM {t} WHERE watershed_group_code = ANY(%(groups)s)"
+                   .format(t=STREAM_PROFILE_TABLE), {"groups": groups})
+    else:
+        groups = None
+        db.execute("TRUNCATE {t}".format(t=STREAM_PROFILE_TABLE))
+    db.execute(queries["create_fwa_stream_profiles"], {"groups": groups})
+    db.execute("ANALYZE {t}".format(t=STREAM_PROFILE_TABLE))
+    db.execute(queries["fwa_elevation_lookup"])
+    db.execute(queries["fwa_slope"])
+
+
+def clear_stream_profiles(db=None):
+    """
+    Drop STREAM_PROFILE_TABLE (if it exists) and restore the version of
+    fwa_elevation that works with segment geometries - profiles are not
+    valid once streams are reloaded
+    """
+    if not db:
+        db = util.connect()
+    if STREAM_PROFILE_TABLE in db.tables:
+        db.execute("DROP TABLE {t}".format(t=STREAM_PROFILE_TABLE))
+        db.execute(queries["fwa_elevation"])
+
+
+def table_signature(table="whse_basemapping.fwa_stream_networks_sp", db=None):
+    """
+    Return signature of table that changes whenever the table is modified
+    (see table_signature.sql)
+    """
+    if not db:
+        db = util.connect()
+    sql = db.build_query(queries["table_signature"], {"table": table})
+    return db.query(sql, {"table": table}).fetchone()[0]
+
+
+def create_geomupstream_cache(max_size_mb=1024, db=None):
+    """
+    Create GEOMUPSTREAM_CACHE and fwa_geomupstream_cached, which fills the
+    cache as upstream geometries are requested and removes least recently
+    used entries once the cache is larger than max_size_mb.
+    An existing cache is kept (with the new size limit), along with the
+    signature of the streams it was filled from (see
+    validate_geomupstream_cache).
+    """
+    if not db:
+        db = util.connect()
+    db.execute("""CREATE TABLE IF NOT EXISTS {t}
+                  (linear_feature_id bigint,
+                   tolerance double precision,
+                   geom geometry,
+                   size_bytes integer,
+                   last_used timestamptz DEFAULT now(),
+                   CONSTRAINT fwa_geomupstream_cache_pkey
+                   PRIMARY KEY (linear_feature_id, tolerance))
+               """.format(t=GEOMUPSTREAM_CACHE))
+    # entries are removed oldest first
+    db.execute("""CREATE INDEX IF NOT EXISTS fwa_geomupstream_cache_last_used_idx
+                  ON {t} (last_used, linear_feature_id, tolerance)
+               """.format(t=GEOMUPSTREAM_CACHE))
+    db.execute("""CREATE TABLE IF NOT EXISTS {t}
+                  (max_size_bytes bigint,
+                   stream_signature text,
+                   cached_bytes bigint DEFAULT 0)
+               """.format(t=GEOMUPSTREAM_CACHE_SETTINGS))
+    db.execute("""ALTER TABLE {t}
+                  ADD COLUMN IF NOT EXISTS cached_bytes bigint DEFAULT 0
+               """.format(t=GEOMUPSTREAM_CACHE_SETTINGS))
+    max_size_bytes = int(max_size_mb * 1048576)
+    if db.query_one("SELECT 1 FROM {t}".format(t=GEOMUPSTREAM_CACHE_SETTINGS)):
+        db.execute("UPDATE {t} SET max_size_bytes = %s".format(
+            t=GEOMUPSTREAM_CACHE_SETTINGS), (max_size_bytes,))
+    else:
+        db.execute("""INSERT INTO {t} (max_size_bytes, stream_signature)
+                      VALUES (%s, %s)""".format(t=GEOMUPSTREAM_CACHE_SETTINGS),
+                   (max_size_bytes, table_signature(db=db)))
+    # the function keeps the total size of the entries, start from the
+    # entries present
+    db.execute("""UPDATE {s}
+                  SET cached_bytes = (SELECT COALESCE(SUM(size_bytes), 0)
+                                      FROM {t})
+               """.format(s=GEOMUPSTREAM_CACHE_SETTINGS, t=GEOMUPSTREAM_CACHE))
+    db.execute(queries["fwa_geomupstream_cached"])
+
+
+def clear_geomupstream_cache(db=None):
+    """Remove all entries from GEOMUPSTREAM_CACHE (if it exists)
+    """
+    if not db:
+        db = util.connect()
+    if GEOMUPSTREAM_CACHE in db.tables:
+        db.execute("TRUNCATE {t}".format(t=GEOMUPSTREAM_CACHE))
+        db.execute("UPDATE {t} SET cached_bytes = 0".format(
+            t=GEOMUPSTREAM_CACHE_SETTINGS))
+        if "whse_basemapping.fwa_stream_networks_sp" in db.tables:
+            db.execute("UPDATE {t} SET stream_signature = %s".format(
+                t=GEOMUPSTREAM_CACHE_SETTINGS), (table_signature(db=db),))
+
+
+def validate_geomupstream_cache(db=None):
+    """
+    Clear GEOMUPSTREAM_CACHE if streams have changed since it was filled,
+    returning True if the cache was cleared
+    """
+    if not db:
+        db = util.connect()
+    if GEOMUPSTREAM_CACHE not in db.tables:
+        return False
+    signature = db.query_one("SELECT stream_signature FROM {t}".format(
+        t=GEOMUPSTREAM_CACHE_SETTINGS))
+    if signature and signature[0] == table_signature(db=db):
+        return False
+    clear_geomupstream_cache(db=db)
+    return True
+
+
+def index_sql(table, column, index_type="btree", opclass=None):
+    """Return CREATE INDEX statement for column of (schema qualified) table
+    """
+    tablename = table.split(".")[-1]
+    name = "ix_{t}_{c}".format(t=tablename, c=column)
+    if index_type != "btree":
+        name = name + "_" + index_type
+    if opclass == "text_pattern_ops":
+        name = name + "_tpo"
+    elif opclass:
+        name = name + "_" + opclass
+    return "CREATE INDEX IF NOT EXISTS {n} ON {t} USING {i} ({c}{o})".format(
+        n=name, t=table, i=index_type, c=column,
+        o=" " + opclass if opclass else "")
+
+
+def table_size(table, db=None):
+    """Return size of table in bytes (including partitions)
+    """
+    if not db:
+        db = util.connect()
+    sql = """SELECT COALESCE(SUM(pg_relation_size(c.oid)), 0)
+             FROM pg_class c
+             WHERE c.oid = to_regclass(%s)
+             OR c.oid IN (SELECT inhrelid FROM pg_inherits
+                          WHERE inhparent = to_regclass(%s))"""
+    return int(db.query_one(sql, (table, table))[0])
+
+
+def create_indexes(indexes, db_url=None, jobs=1, maintenance_work_mem=None,
+                   db=None):
+    """
+    Build indexes, running up to `jobs` CREATE INDEX statements at the same
+    time over a pool of connections. Indexes are built largest first (by
+    size of table, with gist indexes ahead of btree) so that the longest
+    builds are not left running alone at the end.
+
+    indexes              - list of (table, column, index_type, opclass) tuples
+    maintenance_work_mem - memory setting to use for each build (eg '2GB')
+
+    Yields (CREATE INDEX statement, seconds taken) as each build completes.
+    """
+    if not db:
+        db = util.connect(db_url)
+    if not db_url:
+        db_url = util.get_db_url(db)
+    sizes = {t: table_size(t, db=db) for t in set([i[0] for i in indexes])}
+    indexes = sorted(indexes,
+                     key=lambda i: (sizes[i[0]], i[2] == "gist"),
+                     reverse=True)
+    statements = [index_sql(*i) for i in indexes]
+    func = partial(util.create_index_parallel,
+                   db_url=db_url,
+                   maintenance_work_mem=maintenance_work_mem)
+    if jobs > 1:
+        pool = multiprocessing.Pool(processes=jobs)
+        for result in pool.imap_unordered(func, statements):
+            yield result
+        pool.close()
+        pool.join()
+    else:
+        for statement in statements:
+            yield func(statement)
+
+
+def get_events(table, pk, filters=None, param=None, db=None, fetch_size=None,
+               output="dict"):
     """
     Return blue line key event info from supplied event table
 
@@ -107,6 +1007,12 @@ def get_events(table, pk, filters=None, param=None, db=None):
                   "(wscode_ltree ~ %s OR wscode_ltree ~ %s"]
     param      - parameters to supply to the query
                  (replacing %s in the filters)
+    fetch_size - if provided (or output is not dict), stream the events from
+                 a server side cursor, fetch_size rows at a time, returning
+                 a generator rather than the full result
+    output     - when streaming, generate rows as dicts ("dict") or each
+                 fetch as a NumPy structured array ("numpy") or pyarrow
+                 RecordBatch ("arrow"), see util.stream_query
     """
     if not db:
         db = util.connect()
@@ -120,41 +1026,216 @@ def get_events(table, pk, filters=None, param=None, db=None):
     if filters:
         sql = sql + "\nWHERE " + "\n AND ".join(filters)
     sql = sql + "\nORDER BY {pk}".format(pk=pk)
+    if fetch_size or output != "dict":
+        return util.stream_query(sql, param or None, db=db,
+                                 fetch_size=fetch_size or util.FETCH_SIZE,
+                                 output=output)
     if param:
         return db.query(sql, param)
     else:
         return db.query(sql)
 
 
-def reference_points(point_table, point_id, out_table, threshold=100, closest=False,
-                     db=None):
-    """Create a table that references input points to stream network
+def event_lengths(events, event_id, out_table, query, column, groups=None,
+                  jobs=1, db_url=None, db=None):
+    """
+    Create out_table ({event_id}, {column}) and populate it by running query
+    (one of the events_length* queries) over the events table, as a single
+    set based query or split by watershed group over a pool of connections
+    if jobs > 1. If groups are provided, only events in those groups are
+    processed.
+    """
+    if not db:
+        db = util.connect(db_url)
+    if not db_url:
+        db_url = util.get_db_url(db)
+    db[out_table].drop()
+    db.execute("""CREATE TABLE {o} AS
+                  SELECT {i}, NULL::double precision AS {c}
+                  FROM {e}
+                  WITH NO DATA""".format(o=out_table, i=event_id, c=column,
+                                         e=events))
+    sql = db.build_query(queries[query], {"events": events,
+                                          "event_id": event_id,
+                                          "out_table": out_table})
+    if jobs > 1:
+        if not groups:
+            groups = list_groups(db=db)
+        func = partial(util.execute_parallel, sql, db_url=db_url)
+        pool = multiprocessing.Pool(processes=jobs)
+        for params, elapsed in pool.imap_unordered(
+                func, [{"groups": [g]} for g in groups]):
+            util.log("{t}: {g} in {s:.1f}s".format(t=out_table,
+                                                   g=params["groups"][0],
+                                                   s=elapsed))
+        pool.close()
+        pool.join()
+    else:
+        db.execute(sql, {"groups": list(groups) if groups else None})
+    db[out_table].create_index([event_id])
+    return out_table
+
+
+def length_upstream_events(events, event_id, out_table, groups=None, jobs=1,
+                           db_url=None, db=None):
+    """
+    Calculate length upstream of each event (blue_line_key,
+    downstream_route_measure, as returned by get_events) in one query,
+    as fwa_lengthupstream does for a single location
+    """
+    return event_lengths(events, event_id, out_table, "events_lengthupstream",
+                         "length_upstream", groups=groups, jobs=jobs,
+                         db_url=db_url, db=db)
+
+
+def length_downstream_events(events, event_id, out_table, groups=None, jobs=1,
+                             db_url=None, db=None):
+    """
+    Calculate length downstream of each event (blue_line_key,
+    downstream_route_measure, as returned by get_events) in one query,
+    as fwa_lengthdownstream does for a single location
+    """
+    return event_lengths(events, event_id, out_table, "events_lengthdownstream",
+                         "length_downstream", groups=groups, jobs=jobs,
+                         db_url=db_url, db=db)
+
+
+def length_instream_events(events, event_id, out_table, groups=None, jobs=1,
+                           db_url=None, db=None):
+    """
+    Calculate length of stream between pairs of locations in one query.
+    events must include blue_line_key_a, downstream_route_measure_a (lower
+    location) and blue_line_key_b, downstream_route_measure_b (upper
+    location). Length is NULL where b is not upstream of a.
+    """
+    if not db:
+        db = util.connect(db_url)
+    db.execute(queries["fwa_upstreamwsc"])
+    return event_lengths(events, event_id, out_table, "events_lengthinstream",
+                         "length_instream", groups=groups, jobs=jobs,
+                         db_url=db_url, db=db)
+
+
+def reference_points_sql(point_table, point_id, closest=False,
+                         chunk_filter=None, db=None):
+    """
+    Return query referencing points in point_table to the stream network
+    (reference_points.sql), optionally only the closest match for each point
+    and only points matching chunk_filter (sql with named parameters)
     """
     if not db:
         db = util.connect()
-    # create preliminary table, with all potential matches within threshold
-    sql = db.build_query(
-        fwa.queries['reference_points'],
-        {'point_table': point_table,
-         'point_id': point_id,
-         'out_table': out_table})
-    db.execute(sql, (threshold))
-    # if 'closest' is specified, only retain the closest match
+    if chunk_filter:
+        points = "(SELECT * FROM {t} WHERE {f})".format(t=point_table,
+                                                       f=chunk_filter)
+    else:
+        points = point_table
     if closest:
-        db[out_table + "_t"].drop()
-        sql = """
-           CREATE TABLE {out_table}_t AS
-           SELECT DISTINCT ON ({point_id}) *
-           FROM {out_table}
-           ORDER BY {point_id}, distance_to_stream
-           """.format(out_table=out_table,
-                      point_id=point_id)
-        db.execute(sql)
-        db[out_table].drop()
-        schema, table = db.parse_table_name(out_table)
-        db.execute("""ALTER TABLE {out_table}_t RENAME TO {table}
-                   """.format(out_table=out_table,
-                              table=table))
+        distinct = "DISTINCT ON (bluelines.{p})".format(p=point_id)
+        order = "ORDER BY bluelines.{p}, candidates.distance_to_stream".format(
+            p=point_id)
+    else:
+        distinct = ""
+        order = ""
+    return db.build_query(queries["reference_points"],
+                          {"point_table": point_table,
+                           "point_id": point_id,
+                           "points": points,
+                           "distinct": distinct,
+                           "order": order})
+
+
+def point_chunks(point_table, chunk_column=None, tile_size=None, db=None):
+    """
+    Split point_table into chunks for referencing, by the values of
+    chunk_column (eg watershed_group_code) or by square tiles of tile_size
+    metres. Returns sql filtering the point table to a chunk and a list of
+    query parameters (and a name) for each chunk.
+    """
+    if not db:
+        db = util.connect()
+    if chunk_column:
+        chunk_filter = ("({c} = %(chunk)s OR (%(chunk)s IS NULL AND {c} IS NULL))"
+                        .format(c=chunk_column))
+        sql = "SELECT DISTINCT {c} FROM {t} ORDER BY {c}".format(
+            c=chunk_column, t=point_table)
+        chunks = [{"chunk": r[0], "name": str(r[0])} for r in db.query(sql)]
+    else:
+        # points are in a tile when their (lower left) corner is, the bounding
+        # box test is just for the spatial index
+        chunk_filter = """geom && ST_MakeEnvelope(%(xmin)s, %(ymin)s,
+                                                 %(xmin)s + %(size)s,
+                                                 %(ymin)s + %(size)s,
+                                                 ST_SRID(geom))
+                          AND ST_XMin(geom) >= %(xmin)s
+                          AND ST_XMin(geom) < %(xmin)s + %(size)s
+                          AND ST_YMin(geom) >= %(ymin)s
+                          AND ST_YMin(geom) < %(ymin)s + %(size)s"""
+        sql = """SELECT DISTINCT
+                   floor(ST_XMin(geom) / %(size)s) * %(size)s,
+                   floor(ST_YMin(geom) / %(size)s) * %(size)s
+                 FROM {t}
+                 ORDER BY 1, 2""".format(t=point_table)
+        chunks = [{"xmin": x, "ymin": y, "size": tile_size,
+                   "name": "{x:.0f},{y:.0f}".format(x=x, y=y)}
+                  for x, y in db.query(sql, {"size": tile_size})]
+    return chunk_filter, chunks
+
+
+def reference_points(point_table, point_id, out_table, threshold=100, closest=False,
+                     db=None, jobs=1, chunk_column=None, tile_size=None,
+                     db_url=None):
+    """
+    Create a table that references input points to stream network
+
+    With closest=True, only the closest match for each point is written.
+    To reference large point tables, split the points into chunks by
+    chunk_column (eg watershed_group_code) or into tiles of tile_size metres
+    and run up to `jobs` chunks at the same time over a pool of connections
+    (when jobs > 1 and neither is provided, points are split by
+    watershed_group_code if present, otherwise into 50km tiles).
+    """
+    if not db:
+        db = util.connect(db_url)
+    if jobs > 1 and not chunk_column and not tile_size:
+        if PARTITION_KEY in db[point_table].columns:
+            chunk_column = PARTITION_KEY
+        else:
+            tile_size = 50000
+    chunk_filter, chunks = None, [{}]
+    if chunk_column or tile_size:
+        chunk_filter, chunks = point_chunks(point_table, chunk_column,
+                                            tile_size, db=db)
+    select_sql = reference_points_sql(point_table, point_id, closest,
+                                      chunk_filter, db=db)
+    # create the output table, then append the matches for each chunk
+    db[out_table].drop()
+    db.execute("CREATE TABLE {o} AS {s} WITH NO DATA".format(o=out_table,
+                                                            s=select_sql),
+               {"chunk": None, "xmin": 0, "ymin": 0, "size": tile_size or 1,
+                "threshold": threshold})
+    insert_sql = "INSERT INTO {o} {s}".format(o=out_table, s=select_sql)
+    params = [dict(c, threshold=threshold) for c in chunks]
+    if jobs > 1:
+        # workers connect to the database the output table was created in
+        if not db_url:
+            db_url = util.get_db_url(db)
+        func = partial(util.execute_parallel, insert_sql, db_url=db_url)
+        pool = multiprocessing.Pool(processes=jobs)
+        for i, (chunk, elapsed) in enumerate(pool.imap_unordered(func, params), 1):
+            util.log("{t}: {c} in {s:.1f}s ({i}/{n})".format(
+                t=out_table, c=chunk["name"], s=elapsed, i=i, n=len(params)))
+        pool.close()
+        pool.join()
+    else:
+        for i, chunk in enumerate(params, 1):
+            start_time = datetime.datetime.now()
+            db.execute(insert_sql, chunk)
+            if chunk_filter:
+                elapsed = (datetime.datetime.now() - start_time).total_seconds()
+                util.log("{t}: {c} in {s:.1f}s ({i}/{n})".format(
+                    t=out_table, c=chunk["name"], s=elapsed, i=i,
+                    n=len(params)))
     return out_table
 
 
@@ -0,0 +1,454 @@
+"""
+FWA stream network held in memory as NumPy arrays
+  - each referencable stream segment is a node, linked to the segment
+    immediately downstream (see sql/network_edges.sql)
+  - nodes are numbered in depth first (preorder) order, so everything
+    upstream of a node is the contiguous range node:node + size[node]
+  - children of each node are held in CSR form (indptr, children)
+  - length upstream and length to outlet are accumulated for every node
+    when the network is built
+  - watershed and local codes, when available, are held as integer arrays
+    (wscode, localcode) encoded with fwakit.wsc
+
+Upstream/downstream here follow the network links rather than comparison
+of watershed codes, side channels are upstream of the segment at their
+downstream end only.
+
+eg:
+
+    net = network.Network.from_db()
+    nodes = net.locate(blue_line_keys, measures)
+    net.length_upstream(nodes, measures)
+
+Networks can be saved to a binary snapshot and opened with mmap, so that
+worker processes start without rebuilding and share the arrays:
+
+    net = network.load('network.snap')
+"""
+
+from __future__ import absolute_import
+
+import json
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from fwakit import fwa
+from fwakit import util
+from fwakit import wsc
+
+
+FIELDS = ["linear_feature_id",
+          "blue_line_key",
+          "downstream_route_measure",
+          "length_metre",
+          "downstream_id"]
+
+# optional, encoded with fwakit.wsc
+CODE_FIELDS = ["fwa_watershed_code",
+               "local_watershed_code"]
+
+SOURCE_TABLE = "whse_basemapping.fwa_stream_networks_sp"
+
+# snapshot files are the magic string, the version and length of a json
+# header, then the arrays listed in the header, each aligned to ALIGN bytes
+SNAPSHOT_MAGIC = b"FWANET\0\0"
+SNAPSHOT_VERSION = 2
+ALIGN = 64
+
+
+def expand_ranges(starts, counts):
+    """Return concatenation of ranges starts[i]:starts[i] + counts[i]
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    total = counts.sum()
+    if not total:
+        return np.zeros(0, dtype=np.int64)
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(np.asarray(starts, dtype=np.int64), counts) + (
+        np.arange(total, dtype=np.int64) - offsets)
+
+
+def children_csr(parent, order_by=None):
+    """
+    Return CSR arrays (indptr, children) of the children of each node, given
+    the parent of each node (-1 for roots). Children of a node are sorted by
+    order_by (eg measure) if provided.
+    """
+    n = len(parent)
+    child_nodes = np.nonzero(parent >= 0)[0]
+    parents = parent[child_nodes]
+    if order_by is not None:
+        order = np.lexsort((order_by[child_nodes], parents))
+    else:
+        order = np.argsort(parents, kind="mergesort")
+    children = child_nodes[order].astype(np.int32)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    np.cumsum(np.bincount(parents, minlength=n), out=indptr[1:])
+    return indptr, children
+
+
+def preorder(parent, order_by=None):
+    """
+    Return (position, size) of each node in a depth first (preorder) walk
+    of the forest defined by parent, where size is the number of nodes in
+    the subtree of the node (including the node). The walk is done a level
+    at a time so each step is vectorized.
+    """
+    n = len(parent)
+    indptr, children = children_csr(parent, order_by)
+    levels = [np.nonzero(parent < 0)[0]]
+    while True:
+        nodes = levels[-1]
+        counts = indptr[nodes + 1] - indptr[nodes]
+        if not counts.sum():
+            break
+        levels.append(children[expand_ranges(indptr[nodes], counts)])
+    if sum([len(nodes) for nodes in levels]) != n:
+        raise ValueError("Network links are not a forest (cycles found)")
+    # subtree sizes, bottom up
+    size = np.ones(n, dtype=np.int64)
+    for nodes in reversed(levels[1:]):
+        np.add.at(size, parent[nodes], size[nodes])
+    # positions, top down - a child follows its parent and the subtrees of
+    # its earlier siblings
+    position = np.zeros(n, dtype=np.int64)
+    roots = levels[0]
+    position[roots] = np.cumsum(size[roots]) - size[roots]
+    for nodes in levels[:-1]:
+        counts = indptr[nodes + 1] - indptr[nodes]
+        kids = children[expand_ranges(indptr[nodes], counts)]
+        if not len(kids):
+            continue
+        sizes = size[kids]
+        before = np.cumsum(sizes) - sizes
+        # subtract the running total at the first child of each parent
+        first = np.repeat(np.cumsum(counts) - counts, counts)
+        earlier = before - before[first]
+        position[kids] = np.repeat(position[nodes], counts) + 1 + earlier
+    return position, size
+
+
+class Network(object):
+    """
+    Stream network arrays, in preorder. Build with from_records, from_db or
+    from_csv, or open a snapshot with open_snapshot / load.
+    """
+
+    # arrays held by a network, as written to snapshots
+    ARRAYS = ["linear_feature_id",
+              "blue_line_key",
+              "downstream_route_measure",
+              "length_metre",
+              "parent",
+              "size",
+              "indptr",
+              "children",
+              "bluelines",
+              "location_order",
+              "location_key",
+              "upstream_total",
+              "outlet_distance",
+              "wscode",
+              "localcode"]
+
+    def __init__(self, linear_feature_id, blue_line_key, downstream_route_measure,
+                 length_metre, parent, size, wscode=None, localcode=None):
+        self.linear_feature_id = linear_feature_id
+        self.blue_line_key = blue_line_key
+        self.downstream_route_measure = downstream_route_measure
+        self.length_metre = length_metre
+        self.parent = parent
+        self.size = size
+        self.wscode = wscode
+        self.localcode = localcode
+        self.indptr, self.children = children_csr(parent)
+        self.index_locations()
+        self.accumulate()
+
+    def __len__(self):
+        return len(self.linear_feature_id)
+
+    @classmethod
+    def from_records(cls, linear_feature_id, blue_line_key,
+                     downstream_route_measure, length_metre, downstream_id,
+                     fwa_watershed_code=None, local_watershed_code=None):
+        """
+        Build network from aligned sequences of segment attributes, where
+        downstream_id is the linear_feature_id of the segment downstream
+        (-1 at outlets). Watershed codes are optional.
+        """
+        ids = np.asarray(linear_feature_id, dtype=np.int64)
+        downstream_id = np.asarray(downstream_id, dtype=np.int64)
+        measure = np.asarray(downstream_route_measure, dtype=np.float64)
+        # find index of each downstream segment
+        order = np.argsort(ids)
+        pos = np.searchsorted(ids[order], downstream_id)
+        pos = np.minimum(pos, len(ids) - 1)
+        found = ids[order][pos] == downstream_id
+        parent = np.where(found, order[pos], -1)
+        # renumber everything in preorder
+        position, size = preorder(parent, order_by=measure)
+        new = np.empty(len(ids), dtype=np.int64)
+        new[position] = np.arange(len(ids))
+        parent = parent[new]
+        parent = np.where(parent >= 0, position[np.maximum(parent, 0)], -1)
+        codes = [wsc.encode(c)[new] if c is not None else None
+                 for c in [fwa_watershed_code, local_watershed_code]]
+        return cls(ids[new],
+                   np.asarray(blue_line_key, dtype=np.int32)[new],
+                   measure[new],
+                   np.asarray(length_metre, dtype=np.float64)[new],
+                   parent.astype(np.int32),
+                   size[new].astype(np.int32),
+                   *codes)
+
+    @classmethod
+    def from_arrays(cls, arrays, scale):
+        """
+        Create network from all of its arrays (see ARRAYS) without
+        recalculating anything, eg from a snapshot
+        """
+        net = cls.__new__(cls)
+        for name in cls.ARRAYS:
+            setattr(net, name, arrays.get(name))
+        net.scale = scale
+        return net
+
+    @classmethod
+    def from_db(cls, db=None):
+        """Build network from fwa_stream_networks_sp
+        """
+        if not db:
+            db = util.connect()
+        rows = db.query(fwa.queries["network_edges"]).fetchall()
+        columns = (list(zip(*rows)) if rows else
+                   [[]] * len(FIELDS + CODE_FIELDS))
+        return cls.from_records(*columns)
+
+    @classmethod
+    def from_csv(cls, in_file):
+        """Build network from a csv export of the network (see export_csv)
+        """
+        with open(in_file) as f:
+            names = f.readline().strip().split(",")
+        dtypes = dict(zip(FIELDS + CODE_FIELDS,
+                          [np.int64, np.int32, np.float64, np.float64, np.int64,
+                           "U{}".format(wsc.CODE_WIDTH),
+                           "U{}".format(wsc.CODE_WIDTH)]))
+        data = np.genfromtxt(in_file, delimiter=",", names=True,
+                             dtype=[dtypes[name] for name in names],
+                             encoding="ascii")
+        data = np.atleast_1d(data)
+        codes = [data[f] if f in data.dtype.names else None
+                 for f in CODE_FIELDS]
+        return cls.from_records(*[data[f] for f in FIELDS] + codes)
+
+    def index_locations(self):
+        """Sort segments by blue line and measure for locate()
+        """
+        self.bluelines = np.unique(self.blue_line_key)
+        rank = np.searchsorted(self.bluelines, self.blue_line_key)
+        # combine blue line and measure into a single sortable key
+        self.scale = float(np.ceil((self.downstream_route_measure +
+                                    self.length_metre).max() + 1)) if len(self) else 1.0
+        key = rank * self.scale + self.downstream_route_measure
+        self.location_order = np.argsort(key)
+        self.location_key = key[self.location_order]
+
+    def accumulate(self):
+        """
+        Calculate length upstream (including the segment) and length to the
+        outlet (below the segment) of every segment, with prefix sums over
+        the preorder numbering
+        """
+        n = len(self)
+        cumulative = np.zeros(n + 1)
+        np.cumsum(self.length_metre, out=cumulative[1:])
+        nodes = np.arange(n)
+        self.upstream_total = cumulative[nodes + self.size] - cumulative[nodes]
+        # add the length of each segment to everything upstream of it
+        diff = np.zeros(n + 1)
+        np.add.at(diff, nodes + 1, self.length_metre)
+        np.add.at(diff, nodes + self.size, -self.length_metre)
+        self.outlet_distance = np.cumsum(diff)[:n]
+
+    def locate(self, blue_line_key, measure, padding=.001):
+        """
+        Return index of the segment on which each location (blue_line_key,
+        measure) falls, -1 where there is no segment
+        """
+        blue_line_key = np.atleast_1d(np.asarray(blue_line_key, dtype=np.int64))
+        measure = np.atleast_1d(np.asarray(measure, dtype=np.float64))
+        rank = np.searchsorted(self.bluelines, blue_line_key)
+        rank = np.minimum(rank, len(self.bluelines) - 1)
+        valid = self.bluelines[rank] == blue_line_key
+        key = rank * self.scale + measure + padding
+        pos = np.searchsorted(self.location_key, key, side="right") - 1
+        nodes = self.location_order[np.maximum(pos, 0)]
+        valid = valid & (pos >= 0) & (self.blue_line_key[nodes] == blue_line_key)
+        return np.where(valid, nodes, -1)
+
+    def length_upstream(self, nodes, measure):
+        """Return length of stream upstream of locations on nodes
+        """
+        nodes = np.asarray(nodes)
+        return (self.upstream_total[nodes] -
+                (measure - self.downstream_route_measure[nodes]))
+
+    def length_downstream(self, nodes, measure):
+        """Return length of stream downstream of locations on nodes
+        """
+        nodes = np.asarray(nodes)
+        return (self.outlet_distance[nodes] +
+                (measure - self.downstream_route_measure[nodes]))
+
+    def is_upstream(self, a, b, measure_a=None, measure_b=None):
+        """
+        Return True where node b is upstream of (or equal to) node a. If
+        measures are provided, locations on the same node are compared.
+        """
+        a = np.asarray(a)
+        b = np.asarray(b)
+        result = (b >= a) & (b < a + self.size[a])
+        if measure_a is not None and measure_b is not None:
+            result = result & ((a != b) |
+                               (np.asarray(measure_b) >= np.asarray(measure_a)))
+        return result
+
+    def length_instream(self, a, measure_a, b, measure_b):
+        """
+        Return length of stream between locations a (lower) and b (upper),
+        NaN where b is not upstream of a
+        """
+        length = (self.length_downstream(b, measure_b) -
+                  self.length_downstream(a, measure_a))
+        return np.where(self.is_upstream(a, b, measure_a, measure_b),
+                        length, np.nan)
+
+    def upstream(self, node):
+        """Return indexes of all nodes upstream of (and including) node
+        """
+        return np.arange(node, node + self.size[node])
+
+    def downstream(self, node):
+        """Return indexes of all nodes downstream of node, to the outlet
+        """
+        path = []
+        node = self.parent[node]
+        while node >= 0:
+            path.append(node)
+            node = self.parent[node]
+        return np.array(path, dtype=np.int64)
+
+    def children_of(self, node):
+        """Return indexes of nodes immediately upstream of node
+        """
+        return self.children[self.indptr[node]:self.indptr[node + 1]]
+
+
+def write_snapshot(net, path, signature=None):
+    """
+    Write network to a snapshot file at path, recording signature of the
+    source table. The file is written alongside and moved into place, so
+    processes with the old snapshot open are unaffected.
+    """
+    arrays = [(name, np.ascontiguousarray(getattr(net, name)))
+              for name in Network.ARRAYS if getattr(net, name) is not None]
+    index = {}
+    offset = 0
+    for name, array in arrays:
+        index[name] = {"dtype": array.dtype.str,
+                       "shape": list(array.shape),
+                       "offset": offset}
+        offset += -(-array.nbytes // ALIGN) * ALIGN
+    header = json.dumps({"signature": signature,
+                         "scale": net.scale,
+                         "arrays": index}).encode("utf-8")
+    start = -(-(len(SNAPSHOT_MAGIC) + 8 + len(header)) // ALIGN) * ALIGN
+    tmp = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp, "wb") as f:
+        f.write(SNAPSHOT_MAGIC)
+        f.write(struct.pack("<II", SNAPSHOT_VERSION, len(header)))
+        f.write(header)
+        for name, array in arrays:
+            f.seek(start + index[name]["offset"])
+            f.write(array.tobytes())
+        # pad the last array
+        f.truncate(start + offset)
+    os.rename(tmp, path)
+    return path
+
+
+def read_snapshot_header(path):
+    """
+    Return (header, start of data) of snapshot at path, None if the file
+    is not a snapshot of the current version
+    """
+    with open(path, "rb") as f:
+        magic = f.read(len(SNAPSHOT_MAGIC))
+        if magic != SNAPSHOT_MAGIC:
+            return None
+        version, length = struct.unpack("<II", f.read(8))
+        if version != SNAPSHOT_VERSION:
+            return None
+        header = json.loads(f.read(length).decode("utf-8"))
+    start = -(-(len(SNAPSHOT_MAGIC) + 8 + length) // ALIGN) * ALIGN
+    return header, start
+
+
+def open_snapshot(path):
+    """
+    Open snapshot at path, with arrays read only and backed by the file
+    (mmap), so pages are loaded on demand and shared between processes
+    """
+    result = read_snapshot_header(path)
+    if not result:
+        raise ValueError("{} is not a network snapshot (version {})".format(
+            path, SNAPSHOT_VERSION))
+    header, start = result
+    with open(path, "rb") as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = {}
+    for name, info in header["arrays"].items():
+        dtype = np.dtype(info["dtype"])
+        count = int(np.prod(info["shape"]))
+        arrays[name] = np.frombuffer(buf, dtype=dtype, count=count,
+                                     offset=start + info["offset"]).reshape(
+                                         info["shape"])
+    return Network.from_arrays(arrays, header["scale"])
+
+
+def load(path, db=None, table=SOURCE_TABLE):
+    """
+    Open network snapshot at path, first (re)building it from the database
+    if it does not exist, is an old version or table has changed since it
+    was written. Load in the parent before starting worker processes to
+    build only once.
+    """
+    if not db:
+        db = util.connect()
+    signature = fwa.table_signature(table, db=db)
+    result = read_snapshot_header(path) if os.path.exists(path) else None
+    if not result or result[0]["signature"] != signature:
+        util.log("Building network snapshot {}".format(path))
+        write_snapshot(Network.from_db(db), path, signature)
+    return open_snapshot(path)
+
+
+def export_csv(out_file, db=None):
+    """Write network links from the database to csv, for Network.from_csv
+    """
+    if not db:
+        db = util.connect()
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        with open(out_file, "w") as f:
+            cursor.copy_expert("COPY ({sql}) TO STDOUT WITH CSV HEADER".format(
+                sql=fwa.queries["network_edges"].strip().rstrip(";")), f)
+    finally:
+        conn.close()
+    return out_file
@@ -0,0 +1,290 @@
+"""
+Reference points to FWA streams in memory, without the database
+  - streams (a watershed group or more, see sql/reference_vertices.sql) are
+    held as NumPy arrays of line segments (vertex to vertex)
+  - segments are indexed by a regular grid: each segment is listed in every
+    cell its bounding box touches, cells are held in CSR form (cell_keys,
+    cell_start, cell_segments)
+  - points are snapped in batches: the cells within the threshold of each
+    point give the candidate segments, distances and positions along the
+    segments are calculated for all candidates at once
+
+Results match reference_points.sql: of the 100 closest streams within the
+threshold of a point, the closest match on each blue line is returned
+(or only the closest match, with closest=True), with measures interpolated
+along the stream as ST_LineLocatePoint does.
+
+eg:
+
+    streams = reference.StreamIndex.from_db(groups=['SALM'])
+    events = streams.snap(x, y, threshold=100)
+
+Coordinates must be BC Albers (EPSG:3005). Extracts of the streams can be
+written to csv for referencing where the database is not available:
+
+    reference.export_csv('salm.csv', groups=['SALM'])
+    streams = reference.StreamIndex.from_csv('salm.csv')
+"""
+
+from __future__ import absolute_import
+
+import numpy as np
+
+from fwakit import fwa
+from fwakit import util
+
+
+FIELDS = ["linear_feature_id",
+          "blue_line_key",
+          "downstream_route_measure",
+          "length_metre",
+          "part",
+          "x",
+          "y"]
+
+RESULT_DTYPE = [("point", np.int64),
+                ("linear_feature_id", np.int64),
+                ("blue_line_key", np.int32),
+                ("downstream_route_measure", np.float64),
+                ("distance_to_stream", np.float64)]
+
+# grid cell size (m), with the default threshold each point searches up to
+# 3x3 cells
+CELL_SIZE = 100.0
+
+# number of closest streams considered for each point (as reference_points.sql)
+MAX_STREAMS = 100
+
+BATCH_SIZE = 50000
+
+
+def first_of_groups(*keys):
+    """
+    Return mask of the first element of each run of equal keys, for arrays
+    sorted by the keys
+    """
+    first = np.ones(len(keys[0]), dtype=bool)
+    if len(keys[0]):
+        first[1:] = np.any([k[1:] != k[:-1] for k in keys], axis=0)
+    return first
+
+
+class StreamIndex(object):
+    """Stream segments indexed by a regular grid, for snapping points
+    """
+
+    def __init__(self, linear_feature_id, blue_line_key,
+                 downstream_route_measure, length_metre, part, x, y,
+                 cell_size=CELL_SIZE):
+        """
+        Build index from aligned sequences of vertex attributes, ordered by
+        linear_feature_id and by position along each line
+        """
+        ids = np.asarray(linear_feature_id, dtype=np.int64)
+        part = np.asarray(part, dtype=np.int32)
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        self.cell_size = float(cell_size)
+        # attributes of each line
+        first = first_of_groups(ids)
+        self.linear_feature_id = ids[first]
+        self.blue_line_key = np.asarray(blue_line_key, dtype=np.int32)[first]
+        self.downstream_route_measure = np.asarray(
+            downstream_route_measure, dtype=np.float64)[first]
+        self.length_metre = np.asarray(length_metre, dtype=np.float64)[first]
+        # a segment joins each vertex to the next vertex of the same part
+        start = np.flatnonzero(~first_of_groups(ids, part)) - 1
+        self.feature = (np.cumsum(first) - 1)[start]
+        self.x0 = x[start]
+        self.y0 = y[start]
+        self.dx = x[start + 1] - self.x0
+        self.dy = y[start + 1] - self.y0
+        self.segment_length = np.hypot(self.dx, self.dy)
+        # planar length along the line to the start of each segment, and of
+        # each line, for interpolating measures
+        before = np.cumsum(self.segment_length) - self.segment_length
+        line_start = np.searchsorted(self.feature, self.feature)
+        self.offset = before - before[line_start]
+        self.line_length = np.bincount(self.feature, weights=self.segment_length,
+                                       minlength=len(self.linear_feature_id))
+        self.index_segments()
+
+    def __len__(self):
+        return len(self.x0)
+
+    @classmethod
+    def from_db(cls, groups=None, db=None, cell_size=CELL_SIZE):
+        """Build index of streams in watershed groups (all when None)
+        """
+        if not db:
+            db = util.connect()
+        rows = db.query(fwa.queries["reference_vertices"],
+                        {"groups": groups}).fetchall()
+        columns = list(zip(*rows)) if rows else [[]] * len(FIELDS)
+        return cls(*columns, cell_size=cell_size)
+
+    @classmethod
+    def from_csv(cls, in_file, cell_size=CELL_SIZE):
+        """Build index from a csv extract of stream vertices (see export_csv)
+        """
+        with open(in_file) as f:
+            names = f.readline().strip().split(",")
+        data = np.loadtxt(in_file, delimiter=",", skiprows=1, ndmin=2)
+        columns = dict(zip(names, data.T))
+        return cls(*[columns[f] for f in FIELDS], cell_size=cell_size)
+
+    def cells(self, x, y):
+        """Return grid column and row of coordinates
+        """
+        return (np.floor((x - self.origin[0]) / self.cell_size).astype(np.int64),
+                np.floor((y - self.origin[1]) / self.cell_size).astype(np.int64))
+
+    def index_segments(self):
+        """List each segment in every grid cell its bounding box touches
+        """
+        x1 = self.x0 + self.dx
+        y1 = self.y0 + self.dy
+        if len(self):
+            self.origin = (min(self.x0.min(), x1.min()),
+                           min(self.y0.min(), y1.min()))
+        else:
+            self.origin = (0.0, 0.0)
+        col0, row0 = self.cells(np.minimum(self.x0, x1), np.minimum(self.y0, y1))
+        col1, row1 = self.cells(np.maximum(self.x0, x1), np.maximum(self.y0, y1))
+        self.rows = int(row1.max()) + 1 if len(self) else 1
+        ncols = col1 - col0 + 1
+        count = ncols * (row1 - row0 + 1)
+        # one entry per (segment, cell), cells numbered along each row of
+        # the bounding box
+        segments = np.repeat(np.arange(len(self)), count)
+        step = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        col = col0[segments] + step % ncols[segments]
+        row = row0[segments] + step // ncols[segments]
+        keys = col * self.rows + row
+        order = np.argsort(keys, kind="stable")
+        keys = keys[order]
+        self.cell_segments = segments[order]
+        self.cell_keys, first = np.unique(keys, return_index=True)
+        self.cell_start = np.append(first, len(keys))
+
+    def candidates(self, x, y, threshold):
+        """
+        Return (point, segment) index pairs of segments listed in the cells
+        within threshold of each point. Segments in more than one cell may be
+        listed more than once for a point.
+        """
+        col0, row0 = self.cells(x - threshold, y - threshold)
+        col1, row1 = self.cells(x + threshold, y + threshold)
+        width = int(np.ceil(2 * threshold / self.cell_size)) + 1
+        step = np.arange(width)
+        col = col0[:, None, None] + step[None, :, None]
+        row = row0[:, None, None] + step[None, None, :]
+        valid = ((col <= col1[:, None, None]) & (row <= row1[:, None, None]) &
+                 (col >= 0) & (row >= 0) & (row < self.rows))
+        keys = col * self.rows + row
+        pos = np.searchsorted(self.cell_keys, keys)
+        pos = np.minimum(pos, len(self.cell_keys) - 1)
+        valid = valid & (self.cell_keys[pos] == keys)
+        points = np.nonzero(valid)[0]
+        pos = pos[valid]
+        start = self.cell_start[pos]
+        count = self.cell_start[pos + 1] - start
+        step = np.arange(count.sum()) - np.repeat(np.cumsum(count) - count, count)
+        return (np.repeat(points, count),
+                self.cell_segments[np.repeat(start, count) + step])
+
+    def snap(self, x, y, threshold=100, closest=False, batch_size=BATCH_SIZE):
+        """
+        Reference points (x, y) to streams within threshold, returning
+        structured array of events (see RESULT_DTYPE) ordered by point and
+        distance, where point is the index of the point in x, y
+        """
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        if not len(self):
+            return np.empty(0, dtype=RESULT_DTYPE)
+        results = []
+        for i in range(0, len(x), batch_size):
+            result = self.snap_batch(x[i:i + batch_size], y[i:i + batch_size],
+                                     threshold, closest)
+            result["point"] += i
+            results.append(result)
+        if not results:
+            return np.empty(0, dtype=RESULT_DTYPE)
+        return np.concatenate(results)
+
+    def snap_batch(self, x, y, threshold, closest):
+        """Reference a batch of points, see snap()
+        """
+        points, segments = self.candidates(x, y, threshold)
+        # closest position on each candidate segment, as a fraction of the
+        # segment length
+        px = x[points] - self.x0[segments]
+        py = y[points] - self.y0[segments]
+        dx = self.dx[segments]
+        dy = self.dy[segments]
+        length2 = dx * dx + dy * dy
+        t = np.where(length2 > 0,
+                     (px * dx + py * dy) / np.where(length2 > 0, length2, 1), 0)
+        t = np.clip(t, 0, 1)
+        distance = np.hypot(px - t * dx, py - t * dy)
+        keep = distance < threshold
+        points, segments = points[keep], segments[keep]
+        t, distance = t[keep], distance[keep]
+        features = self.feature[segments]
+        # closest segment of each stream - sort by distance then (stable,
+        # integer) by point and stream, much faster than a lexsort of all three
+        pair = points * len(self.linear_feature_id) + features
+        order = np.argsort(distance)
+        order = order[np.argsort(pair[order], kind="stable")]
+        order = order[first_of_groups(pair[order])]
+        # the closest streams of each point
+        order = order[np.lexsort((distance[order], points[order]))]
+        rank = np.arange(len(order)) - np.searchsorted(points[order],
+                                                       points[order])
+        order = order[rank < MAX_STREAMS]
+        if closest:
+            order = order[first_of_groups(points[order])]
+        else:
+            # closest stream of each blue line
+            blue_line_key = self.blue_line_key[features[order]]
+            by_line = np.lexsort((distance[order], blue_line_key, points[order]))
+            by_line = by_line[first_of_groups(points[order][by_line],
+                                              blue_line_key[by_line])]
+            order = order[np.sort(by_line)]
+        segments = segments[order]
+        features = features[order]
+        # measure as ST_LineLocatePoint * length_metre + downstream measure
+        along = self.offset[segments] + t[order] * self.segment_length[segments]
+        line_length = self.line_length[features]
+        fraction = np.where(line_length > 0,
+                            along / np.where(line_length > 0, line_length, 1), 0)
+        result = np.empty(len(order), dtype=RESULT_DTYPE)
+        result["point"] = points[order]
+        result["linear_feature_id"] = self.linear_feature_id[features]
+        result["blue_line_key"] = self.blue_line_key[features]
+        result["downstream_route_measure"] = (
+            fraction * self.length_metre[features] +
+            self.downstream_route_measure[features])
+        result["distance_to_stream"] = distance[order]
+        return result
+
+
+def export_csv(out_file, groups=None, db=None):
+    """
+    Write vertices of streams in watershed groups (all when None) from the
+    database to csv, for StreamIndex.from_csv
+    """
+    if not db:
+        db = util.connect()
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        sql = cursor.mogrify(fwa.queries["reference_vertices"].strip().rstrip(";"),
+                             {"groups": groups}).decode("utf-8")
+        with open(out_file, "w") as f:
+            cursor.copy_expert("COPY ({sql}) TO STDOUT WITH CSV HEADER".format(
+                sql=sql), f)
+    finally:
+        conn.close()
+    return out_file
@@ -0,0 +1,53 @@
+-- create a lookup of the extents of each blue line, for quick validation of
+-- measures and blue line lengths without scanning all segments of the line:
+--   - downstream_route_measure / upstream_route_measure: measures at the
+--     ends of the blue line
+--   - length_metre: length of the blue line within BC (to the upstream end
+--     of the highest segment that is not outside of BC, edge_type 6010)
+--   - linear_feature_id, wscode_ltree, localcode_ltree,
+--     watershed_group_code: the outlet (lowest) segment of the blue line
+--     and its watershed codes
+
+DROP TABLE IF EXISTS whse_basemapping.fwa_blue_lines;
+
+CREATE TABLE whse_basemapping.fwa_blue_lines
+(blue_line_key integer PRIMARY KEY,
+ downstream_route_measure double precision,
+ upstream_route_measure double precision,
+ length_metre double precision,
+ linear_feature_id bigint,
+ wscode_ltree ltree,
+ localcode_ltree ltree,
+ watershed_group_code text);
+
+INSERT INTO whse_basemapping.fwa_blue_lines
+SELECT
+  e.blue_line_key,
+  e.downstream_route_measure,
+  e.upstream_route_measure,
+  e.length_metre,
+  o.linear_feature_id,
+  o.wscode_ltree,
+  o.localcode_ltree,
+  o.watershed_group_code
+FROM
+  (SELECT
+     blue_line_key,
+     min(downstream_route_measure) AS downstream_route_measure,
+     max(upstream_route_measure) AS upstream_route_measure,
+     max(downstream_route_measure + length_metre)
+       FILTER (WHERE edge_type != 6010) AS length_metre
+   FROM whse_basemapping.fwa_stream_networks_sp
+   GROUP BY blue_line_key) AS e
+INNER JOIN
+  (SELECT DISTINCT ON (blue_line_key)
+     blue_line_key,
+     linear_feature_id,
+     wscode_ltree,
+     localcode_ltree,
+     watershed_group_code
+   FROM whse_basemapping.fwa_stream_networks_sp
+   ORDER BY blue_line_key, downstream_route_measure) AS o
+ON e.blue_line_key = o.blue_line_key;
+
+ANALYZE whse_basemapping.fwa_blue_lines;
@@ -0,0 +1,36 @@
+-- Calculate the length of stream downstream of each stream segment (from the
+-- downstream end of the segment to the outlet of the network), for segments
+-- in the provided watershed groups (all groups if NULL).
+
+-- The length below the mouth of each watershed code is accumulated by
+-- fwakit.fwa.build_length_downstream (in fwa_wsc_lengthdownstream), here we
+-- just add the length of stream below each segment on its own watershed code:
+--   - segments on the same watershed code with lower local code
+--   - segments lower on the same blue line, with the same local code
+
+INSERT INTO whse_basemapping.fwa_stream_networks_lengthdownstream
+  (linear_feature_id, watershed_group_code, length_downstream)
+SELECT
+  s.linear_feature_id,
+  s.watershed_group_code,
+  w.length_downstream + s.length_below AS length_downstream
+FROM
+  (SELECT
+     linear_feature_id,
+     watershed_group_code,
+     wscode_ltree,
+     -- running sum including the segment's local code, less the local code
+     SUM(length_metre) OVER (PARTITION BY wscode_ltree
+                             ORDER BY localcode_ltree) -
+     SUM(length_metre) OVER (PARTITION BY wscode_ltree, localcode_ltree) +
+     -- running sum along the blue line within the local code, less the segment
+     SUM(length_metre) OVER (PARTITION BY wscode_ltree, localcode_ltree, blue_line_key
+                             ORDER BY downstream_route_measure) -
+     length_metre AS length_below
+   FROM whse_basemapping.fwa_stream_networks_sp
+   WHERE wscode_ltree IS NOT NULL
+   AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+  ) AS s
+INNER JOIN whse_basemapping.fwa_wsc_lengthdownstream w
+ON s.wscode_ltree = w.code
+WHERE (%(groups)s::text[] IS NULL OR s.watershed_group_code = ANY(%(groups)s));
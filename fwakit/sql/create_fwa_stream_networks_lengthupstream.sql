@@ -0,0 +1,76 @@
+-- Accumulate the length of stream upstream of each stream segment (from the
+-- downstream end of the segment, including the segment itself), for segments
+-- in the provided watershed groups (all groups if NULL).
+
+-- Requires the interval columns added by fwakit.fwa.add_intervals. With
+-- segments sorted by interval, each upstream set used by fwa_lengthupstream
+-- is at most two contiguous runs, so every segment's total comes from
+-- running sums over the whole network rather than a join per segment:
+--   - wscode = localcode: everything in the interval of the watershed code,
+--     less the segments lower down on the same blue line
+--   - wscode != localcode: segments on the same watershed code with larger
+--     (or equal) localcode, plus everything after the interval of the
+--     localcode within the interval of the watershed code
+
+-- The running sums are calculated over all groups (upstream totals cross
+-- group boundaries), only the output is restricted to the groups.
+
+INSERT INTO whse_basemapping.fwa_stream_networks_lengthupstream
+  (linear_feature_id, watershed_group_code, length_upstream)
+
+WITH per_code AS
+(
+  SELECT wscode_left, SUM(length_metre) AS length_metre
+  FROM whse_basemapping.fwa_stream_networks_sp
+  WHERE wscode_left IS NOT NULL
+  GROUP BY wscode_left
+),
+
+-- total length of segments with wscode_left <= lft, for every interval
+-- position (plus position 0)
+cumulative AS
+(
+  SELECT
+    i.lft,
+    SUM(COALESCE(p.length_metre, 0)) OVER (ORDER BY i.lft) AS length_metre
+  FROM whse_basemapping.fwa_wsc_intervals i
+  LEFT OUTER JOIN per_code p ON i.lft = p.wscode_left
+  UNION ALL
+  SELECT 0, 0
+),
+
+segments AS
+(
+  SELECT
+    linear_feature_id,
+    watershed_group_code,
+    length_metre,
+    wscode_left,
+    wscode_right,
+    localcode_left,
+    localcode_right,
+    localcode_ltree,
+    -- length of segments on the same watershed code with localcode >= this one
+    SUM(length_metre) OVER (PARTITION BY wscode_left
+                            ORDER BY localcode_left DESC NULLS LAST) AS length_tail,
+    -- length of the blue line up to and including this segment
+    SUM(length_metre) OVER (PARTITION BY blue_line_key
+                            ORDER BY downstream_route_measure) AS length_blueline
+  FROM whse_basemapping.fwa_stream_networks_sp
+  WHERE wscode_left IS NOT NULL
+)
+
+SELECT
+  s.linear_feature_id,
+  s.watershed_group_code,
+  CASE
+    WHEN s.wscode_left = s.localcode_left
+    THEN (ws_right.length_metre - ws_left.length_metre) - s.length_blueline + s.length_metre
+    ELSE s.length_tail + (ws_right.length_metre - local_right.length_metre)
+  END AS length_upstream
+FROM segments s
+INNER JOIN cumulative ws_right ON ws_right.lft = s.wscode_right
+INNER JOIN cumulative ws_left ON ws_left.lft = s.wscode_left - 1
+INNER JOIN cumulative local_right ON local_right.lft = s.localcode_right
+WHERE s.localcode_ltree IS NOT NULL AND s.localcode_ltree != ''
+AND (%(groups)s::text[] IS NULL OR s.watershed_group_code = ANY(%(groups)s));
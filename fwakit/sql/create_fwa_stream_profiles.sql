@@ -0,0 +1,56 @@
+-- Write the vertices of stream segments in the provided watershed groups
+-- (all groups if NULL) to fwa_stream_profiles as (blue_line_key, measure,
+-- elevation), for fast elevation and slope lookups.
+
+-- The measure of each vertex is the measure at the start of the segment
+-- plus the distance along the segment to the vertex, scaled to the length
+-- of the segment (length_metre). Vertices shared by adjacent segments of a
+-- blue line are written once (measures are rounded to the mm). When
+-- rebuilding selected groups, vertices at group boundaries may already be
+-- present under the neighbouring group, these are left as they are.
+
+INSERT INTO whse_basemapping.fwa_stream_profiles
+  (blue_line_key, downstream_route_measure, elevation, watershed_group_code)
+
+WITH vertices AS
+(
+  SELECT
+    s.linear_feature_id,
+    s.blue_line_key,
+    s.watershed_group_code,
+    s.downstream_route_measure,
+    s.length_metre,
+    v.path[1] AS vertex_id,
+    ST_Z(v.geom) AS elevation,
+    COALESCE(
+      ST_Distance(v.geom, lag(v.geom) OVER (PARTITION BY s.linear_feature_id
+                                            ORDER BY v.path[1])),
+      0) AS step
+  FROM whse_basemapping.fwa_stream_networks_sp s,
+  LATERAL ST_DumpPoints(ST_GeometryN(s.geom, 1)) AS v
+  WHERE (%(groups)s IS NULL OR s.watershed_group_code = ANY(%(groups)s))
+),
+
+measures AS
+(
+  SELECT
+    blue_line_key,
+    watershed_group_code,
+    round(
+      (downstream_route_measure + length_metre *
+        COALESCE(SUM(step) OVER (PARTITION BY linear_feature_id ORDER BY vertex_id) /
+                 NULLIF(SUM(step) OVER (PARTITION BY linear_feature_id), 0), 0)
+      )::numeric, 3)::double precision AS downstream_route_measure,
+    elevation
+  FROM vertices
+)
+
+SELECT DISTINCT ON (blue_line_key, downstream_route_measure)
+  blue_line_key,
+  downstream_route_measure,
+  elevation,
+  watershed_group_code
+FROM measures
+WHERE elevation IS NOT NULL
+ORDER BY blue_line_key, downstream_route_measure
+ON CONFLICT (blue_line_key, downstream_route_measure) DO NOTHING;
@@ -0,0 +1,66 @@
+-- Add length downstream of every event in $events to $out_table, in a single
+-- set based query (rather than calling fwa_lengthdownstream for each event).
+-- Downstream logic matches fwa_lengthdownstream (with default padding).
+
+-- Only events on segments in the watershed groups provided are processed
+-- (all events if groups is NULL), so that groups can be run in parallel.
+
+INSERT INTO $out_table ($event_id, length_downstream)
+
+-- get the segment on which each event falls
+WITH a AS
+(
+  SELECT
+    e.$event_id,
+    e.downstream_route_measure AS measure,
+    s.linear_feature_id,
+    s.blue_line_key,
+    s.downstream_route_measure,
+    s.wscode_ltree,
+    s.localcode_ltree
+  FROM $events e
+  CROSS JOIN LATERAL
+    (SELECT *
+     FROM whse_basemapping.fwa_stream_networks_sp
+     WHERE blue_line_key = e.blue_line_key
+     -- use zero measure when measure minus padding is negative
+     AND downstream_route_measure <= GREATEST(0::float, (e.downstream_route_measure - .001)::float)
+     -- do not compute anything for side channels, we don't know what is downstream
+     AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+     ORDER BY downstream_route_measure desc
+     LIMIT 1) AS s
+  WHERE (%(groups)s::text[] IS NULL OR s.watershed_group_code = ANY(%(groups)s))
+)
+
+-- sum everything downstream of each event, plus the segment below the event
+SELECT
+  a.$event_id,
+  (a.measure - a.downstream_route_measure) +
+    COALESCE(SUM(b.length_metre), 0) AS length_downstream
+FROM a
+LEFT OUTER JOIN whse_basemapping.fwa_stream_networks_sp b ON
+  -- never return the stream segment at which we start, that is added above
+  b.linear_feature_id != a.linear_feature_id AND
+  (
+    -- downstream criteria 1 - same blue line, lower measure
+    (b.blue_line_key = a.blue_line_key AND
+     b.downstream_route_measure <= a.downstream_route_measure)
+    OR
+    -- criteria 2 - watershed code a is a child of watershed code b
+    (b.wscode_ltree @> a.wscode_ltree
+        AND (
+             -- AND local code is lower
+             b.localcode_ltree < subltree(a.localcode_ltree, 0, nlevel(b.localcode_ltree))
+             -- OR wscode and localcode are equivalent
+             OR b.wscode_ltree = b.localcode_ltree
+             -- OR any missed side channels on the same watershed code
+             OR (b.wscode_ltree = a.wscode_ltree AND
+                 b.blue_line_key != a.blue_line_key AND
+                 b.localcode_ltree < a.localcode_ltree)
+             )
+    )
+  )
+GROUP BY
+  a.$event_id,
+  a.measure,
+  a.downstream_route_measure;
@@ -0,0 +1,115 @@
+-- Add length of stream between pairs of locations in $events to $out_table,
+-- in a single set based query (rather than calling fwa_lengthinstream for
+-- each pair). $events must hold the lower location (blue_line_key_a,
+-- downstream_route_measure_a) and the upper location (blue_line_key_b,
+-- downstream_route_measure_b) of each pair.
+
+-- Length between the locations is the difference of their lengths
+-- downstream (calculated as in fwa_lengthdownstream), once the upper location
+-- is confirmed to be upstream of the lower. NULL is returned if it is not.
+
+-- Only pairs with the lower location on segments in the watershed groups
+-- provided are processed (all pairs if groups is NULL), so that groups can be
+-- run in parallel.
+
+INSERT INTO $out_table ($event_id, length_instream)
+
+-- pairs with the lower location in the groups of interest
+WITH pairs AS
+(
+  SELECT e.*
+  FROM $events e
+  CROSS JOIN LATERAL
+    (SELECT watershed_group_code
+     FROM whse_basemapping.fwa_stream_networks_sp
+     WHERE blue_line_key = e.blue_line_key_a
+     AND downstream_route_measure <= GREATEST(0::float, (e.downstream_route_measure_a - .001)::float)
+     AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+     ORDER BY downstream_route_measure desc
+     LIMIT 1) AS s
+  WHERE (%(groups)s::text[] IS NULL OR s.watershed_group_code = ANY(%(groups)s))
+),
+
+-- get the segment on which each location falls
+a AS
+(
+  SELECT
+    e.$event_id,
+    pt.location,
+    pt.measure,
+    s.linear_feature_id,
+    s.blue_line_key,
+    s.downstream_route_measure,
+    s.wscode_ltree,
+    s.localcode_ltree
+  FROM pairs e
+  CROSS JOIN LATERAL
+    (VALUES ('a', e.blue_line_key_a, e.downstream_route_measure_a),
+            ('b', e.blue_line_key_b, e.downstream_route_measure_b)
+    ) AS pt (location, blue_line_key, measure)
+  CROSS JOIN LATERAL
+    (SELECT *
+     FROM whse_basemapping.fwa_stream_networks_sp
+     WHERE blue_line_key = pt.blue_line_key
+     AND downstream_route_measure <= GREATEST(0::float, (pt.measure - .001)::float)
+     AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+     ORDER BY downstream_route_measure desc
+     LIMIT 1) AS s
+),
+
+-- length downstream of each location
+downstream AS
+(
+  SELECT
+    a.$event_id,
+    a.location,
+    a.measure,
+    a.blue_line_key,
+    a.wscode_ltree,
+    a.localcode_ltree,
+    (a.measure - a.downstream_route_measure) +
+      COALESCE(SUM(b.length_metre), 0) AS length_downstream
+  FROM a
+  LEFT OUTER JOIN whse_basemapping.fwa_stream_networks_sp b ON
+    b.linear_feature_id != a.linear_feature_id AND
+    (
+      (b.blue_line_key = a.blue_line_key AND
+       b.downstream_route_measure <= a.downstream_route_measure)
+      OR
+      (b.wscode_ltree @> a.wscode_ltree
+          AND (
+               b.localcode_ltree < subltree(a.localcode_ltree, 0, nlevel(b.localcode_ltree))
+               OR b.wscode_ltree = b.localcode_ltree
+               OR (b.wscode_ltree = a.wscode_ltree AND
+                   b.blue_line_key != a.blue_line_key AND
+                   b.localcode_ltree < a.localcode_ltree)
+               )
+      )
+    )
+  GROUP BY
+    a.$event_id,
+    a.location,
+    a.measure,
+    a.downstream_route_measure,
+    a.blue_line_key,
+    a.wscode_ltree,
+    a.localcode_ltree
+)
+
+SELECT
+  bottom.$event_id,
+  CASE
+    -- same stream, top must be higher up
+    WHEN bottom.blue_line_key = top.blue_line_key AND top.measure >= bottom.measure
+    THEN top.length_downstream - bottom.length_downstream
+    -- different streams, top must be upstream of bottom
+    WHEN bottom.blue_line_key != top.blue_line_key AND
+         fwa_upstreamwsc(bottom.wscode_ltree, bottom.localcode_ltree,
+                         top.wscode_ltree, top.localcode_ltree)
+    THEN top.length_downstream - bottom.length_downstream
+  END AS length_instream
+FROM downstream bottom
+INNER JOIN downstream top
+ON bottom.$event_id = top.$event_id
+AND bottom.location = 'a'
+AND top.location = 'b';
@@ -0,0 +1,76 @@
+-- Add length upstream of every event in $events to $out_table, in a single
+-- set based query (rather than calling fwa_lengthupstream for each event).
+-- Upstream logic matches fwa_lengthupstream (with default padding).
+
+-- Only events on segments in the watershed groups provided are processed
+-- (all events if groups is NULL), so that groups can be run in parallel.
+
+INSERT INTO $out_table ($event_id, length_upstream)
+
+-- get the segment on which each event falls
+WITH a AS
+(
+  SELECT
+    e.$event_id,
+    e.downstream_route_measure AS measure,
+    s.linear_feature_id,
+    s.blue_line_key,
+    s.downstream_route_measure,
+    s.length_metre,
+    s.wscode_ltree,
+    s.localcode_ltree
+  FROM $events e
+  CROSS JOIN LATERAL
+    (SELECT *
+     FROM whse_basemapping.fwa_stream_networks_sp
+     WHERE
+       blue_line_key = e.blue_line_key
+       AND downstream_route_measure <= (e.downstream_route_measure + .001)
+       AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+     ORDER BY downstream_route_measure DESC
+     LIMIT 1) AS s
+  WHERE (%(groups)s::text[] IS NULL OR s.watershed_group_code = ANY(%(groups)s))
+)
+
+-- sum everything upstream of each event, plus the segment above the event
+SELECT
+  a.$event_id,
+  (a.length_metre - (a.measure - a.downstream_route_measure)) +
+    COALESCE(SUM(b.length_metre), 0) AS length_upstream
+FROM a
+LEFT OUTER JOIN whse_basemapping.fwa_stream_networks_sp b ON
+  -- b is a child of a, always
+  b.wscode_ltree <@ a.wscode_ltree
+  -- never return the start segment, that is added above
+  AND b.linear_feature_id != a.linear_feature_id
+  AND
+    CASE
+      -- wscode and localcode are equivalent
+      WHEN
+        a.wscode_ltree = a.localcode_ltree AND
+        (b.blue_line_key <> a.blue_line_key OR
+         b.downstream_route_measure > a.downstream_route_measure + .001)
+      THEN TRUE
+      -- wscode and localcode are not equivalent
+      WHEN
+        a.wscode_ltree != a.localcode_ltree AND
+        (
+         -- higher up the blue line (plus fudge factor)
+          (b.blue_line_key = a.blue_line_key AND
+           b.downstream_route_measure > a.downstream_route_measure + .001)
+          OR
+         -- tributaries: b wscode > a localcode and b wscode is not a child of a localcode
+          (b.wscode_ltree > a.localcode_ltree AND
+           NOT b.wscode_ltree <@ a.localcode_ltree)
+          OR
+         -- side channels: b is the same watershed code, with larger localcode
+          (b.wscode_ltree = a.wscode_ltree AND
+           b.localcode_ltree >= a.localcode_ltree)
+        )
+      THEN TRUE
+    END
+GROUP BY
+  a.$event_id,
+  a.length_metre,
+  a.measure,
+  a.downstream_route_measure;
@@ -0,0 +1,42 @@
+/*
+FWA_DownstreamWSC_Array(wscode_array_a, localcode_array_a,
+                        wscode_array_b, localcode_array_b)
+
+Provided two sets of integer array watershed/local codes (a and b, see
+fwa_wsc2array), return TRUE when the codes for b are downstream of (or
+equivalent to) the codes for a. The comparison is that used by
+fwa_lengthdownstream:
+  - watershed code of b is a parent of (or equal to) watershed code of a
+  - and local code of b is lower than the local code of a (truncated to the
+    length of b), or b watershed and local codes are equivalent, or b is a
+    side channel on the same watershed code with a lower local code
+
+Parents of a sort ahead of a, so the leading wscode_array_b <= wscode_array_a
+condition is a btree range on wscode_array; the prefix test then discards
+the codes in that range that are not parents.
+*/
+
+CREATE OR REPLACE FUNCTION fwa_downstreamwsc_array(
+    wscode_array_a integer[],
+    localcode_array_a integer[],
+    wscode_array_b integer[],
+    localcode_array_b integer[]
+)
+
+RETURNS boolean AS $$
+
+-- a must be within the watershed of b
+SELECT wscode_array_b <= wscode_array_a
+AND wscode_array_a[1:cardinality(wscode_array_b)] = wscode_array_b
+AND (
+  -- local code is lower
+    localcode_array_b < localcode_array_a[1:cardinality(localcode_array_b)]
+  -- or watershed code and local code of b are equivalent
+  OR wscode_array_b = localcode_array_b
+  -- or side channels on the same watershed code
+  OR (wscode_array_b = wscode_array_a AND
+      localcode_array_b <= localcode_array_a)
+)
+
+$$
+language 'sql' immutable parallel safe;
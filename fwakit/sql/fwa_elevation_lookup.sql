@@ -0,0 +1,48 @@
+-- fwa_elevation(blue_line_key, downstream_route_measure)
+
+-- Return the elevation of a stream at a point, interpolated between the
+-- vertices on either side of the point in fwa_stream_profiles (see
+-- create_fwa_stream_profiles.sql). This replaces the version of the function
+-- that interpolates along the segment geometry (fwa_elevation.sql) with two
+-- index lookups on (blue_line_key, downstream_route_measure).
+
+-- Loading or cleaning streams drops the profiles and restores the geometry
+-- version of the function, rebuild them (fwakit stream_profiles) after
+-- reloading streams.
+
+
+CREATE OR REPLACE FUNCTION fwa_elevation(
+    blkey integer,
+    measure double precision
+)
+
+RETURNS numeric AS $$
+
+SELECT
+  ROUND(
+    (CASE
+      WHEN up.downstream_route_measure IS NULL THEN dn.elevation
+      ELSE dn.elevation + (up.elevation - dn.elevation) *
+           ((measure - dn.downstream_route_measure) /
+            (up.downstream_route_measure - dn.downstream_route_measure))
+    END)::numeric,
+    2) as elevation
+FROM
+  -- vertex at or below the point
+  (SELECT downstream_route_measure, elevation
+   FROM whse_basemapping.fwa_stream_profiles
+   WHERE blue_line_key = blkey
+   AND downstream_route_measure <= measure
+   ORDER BY downstream_route_measure DESC
+   LIMIT 1) AS dn
+LEFT OUTER JOIN LATERAL
+  -- vertex above the point
+  (SELECT downstream_route_measure, elevation
+   FROM whse_basemapping.fwa_stream_profiles
+   WHERE blue_line_key = blkey
+   AND downstream_route_measure > measure
+   ORDER BY downstream_route_measure
+   LIMIT 1) AS up ON true
+
+$$
+language 'sql' immutable strict parallel safe;
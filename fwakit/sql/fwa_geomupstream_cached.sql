@@ -0,0 +1,202 @@
+-- fwa_geomupstream_cached(blue_line_key, downstream_route_measure, tolerance, padding)
+
+-- As fwa_geomupstream, but the geometry of the streams upstream of the
+-- segment on which the point falls is cached in
+-- whse_basemapping.fwa_geomupstream_cache (see
+-- fwakit.fwa.create_geomupstream_cache), keyed by segment and
+-- simplification tolerance.
+
+-- Everything upstream of a segment other than the segment itself does not
+-- depend on where the point falls on the segment, so one cache entry serves
+-- every measure on the segment - the part of the start segment above the
+-- point is added on each call. The result is a collection of the cached
+-- (unioned) lines and this part, rather than a union of the two.
+
+-- Entries are added as they are requested:
+--   - full resolution upstream geometry (tolerance 0) is built with
+--     ST_Union over the upstream segments and cached
+--   - other tolerances are ST_Simplify of the full resolution geometry
+-- The total size of the entries is kept in fwa_geomupstream_cache_settings
+-- (cached_bytes). When it grows past max_size_bytes and the cache table is
+-- larger than max_size_bytes on disk (pg_total_relation_size), a batch of
+-- least recently used entries is removed, bringing the total back to 90%
+-- of the limit - the cache is not scanned on every miss. (The on disk size
+-- alone can't trigger eviction, it does not shrink when entries are
+-- deleted.)
+
+-- The cache must be cleared whenever streams are reloaded (fwakit load,
+-- clean and sync do this).
+
+
+CREATE OR REPLACE FUNCTION fwa_geomupstream_cached(
+    blkey integer,
+    measure double precision,
+    tolerance double precision DEFAULT 0,
+    padding numeric DEFAULT .001
+)
+
+RETURNS geometry AS $$
+#variable_conflict use_column
+-- (tolerance is also a column of the cache, use the column in queries)
+
+DECLARE
+  seg record;
+  upstream_geom geometry;
+  start_geom geometry;
+  max_bytes bigint;
+  total_bytes bigint;
+  n_inserted integer;
+
+BEGIN
+
+-- get the segment of interest and the part of it above the point
+SELECT
+  linear_feature_id,
+  blue_line_key,
+  downstream_route_measure,
+  wscode_ltree,
+  localcode_ltree,
+  ST_LineSubstring((ST_Dump(geom)).geom, ((measure - downstream_route_measure) / length_metre), 1) as geom
+INTO seg
+FROM whse_basemapping.fwa_stream_networks_sp
+WHERE
+  blue_line_key = blkey
+  AND downstream_route_measure <= (measure + .001)
+  AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+ORDER BY downstream_route_measure DESC
+LIMIT 1;
+
+IF NOT FOUND THEN
+  RETURN NULL;
+END IF;
+
+start_geom := seg.geom;
+IF fwa_geomupstream_cached.tolerance > 0 THEN
+  start_geom := ST_Simplify(start_geom, fwa_geomupstream_cached.tolerance);
+END IF;
+
+-- look for the upstream geometry in the cache
+UPDATE whse_basemapping.fwa_geomupstream_cache c
+SET last_used = now()
+WHERE c.linear_feature_id = seg.linear_feature_id
+AND c.tolerance = fwa_geomupstream_cached.tolerance
+RETURNING c.geom INTO upstream_geom;
+
+IF NOT FOUND THEN
+
+  -- full resolution geometry, from the cache or built from the segments
+  SELECT c.geom INTO upstream_geom
+  FROM whse_basemapping.fwa_geomupstream_cache c
+  WHERE c.linear_feature_id = seg.linear_feature_id
+  AND c.tolerance = 0;
+
+  IF NOT FOUND THEN
+    SELECT ST_Union(b.geom) INTO upstream_geom
+    FROM whse_basemapping.fwa_stream_networks_sp b
+    WHERE
+      -- b is a child of a, always
+      b.wscode_ltree <@ seg.wscode_ltree
+      -- never return the start segment
+    AND b.linear_feature_id != seg.linear_feature_id
+    AND
+      -- upstream join logic as fwa_geomupstream
+      CASE
+         WHEN
+            seg.wscode_ltree = seg.localcode_ltree AND
+            (b.blue_line_key <> seg.blue_line_key OR
+             b.downstream_route_measure > seg.downstream_route_measure + padding)
+         THEN TRUE
+         WHEN
+            seg.wscode_ltree != seg.localcode_ltree AND
+            (
+             -- higher up the blue line (plus fudge factor)
+                (b.blue_line_key = seg.blue_line_key AND
+                 b.downstream_route_measure > seg.downstream_route_measure + padding)
+                OR
+             -- tributaries
+                (b.wscode_ltree > seg.localcode_ltree AND
+                 NOT b.wscode_ltree <@ seg.localcode_ltree)
+                OR
+             -- side channels
+                (b.wscode_ltree = seg.wscode_ltree
+                 AND b.localcode_ltree >= seg.localcode_ltree)
+            )
+          THEN TRUE
+      END;
+
+    INSERT INTO whse_basemapping.fwa_geomupstream_cache
+      (linear_feature_id, tolerance, geom, size_bytes)
+    VALUES
+      (seg.linear_feature_id, 0, upstream_geom,
+       COALESCE(ST_MemSize(upstream_geom), 0))
+    ON CONFLICT ON CONSTRAINT fwa_geomupstream_cache_pkey
+    DO NOTHING;
+    GET DIAGNOSTICS n_inserted = ROW_COUNT;
+    IF n_inserted > 0 THEN
+      UPDATE whse_basemapping.fwa_geomupstream_cache_settings
+      SET cached_bytes = cached_bytes + COALESCE(ST_MemSize(upstream_geom), 0);
+    END IF;
+  END IF;
+
+  IF fwa_geomupstream_cached.tolerance > 0 THEN
+    upstream_geom := ST_Simplify(upstream_geom, fwa_geomupstream_cached.tolerance);
+    INSERT INTO whse_basemapping.fwa_geomupstream_cache
+      (linear_feature_id, tolerance, geom, size_bytes)
+    VALUES
+      (seg.linear_feature_id, fwa_geomupstream_cached.tolerance, upstream_geom,
+       COALESCE(ST_MemSize(upstream_geom), 0))
+    ON CONFLICT ON CONSTRAINT fwa_geomupstream_cache_pkey
+    DO NOTHING;
+    GET DIAGNOSTICS n_inserted = ROW_COUNT;
+    IF n_inserted > 0 THEN
+      UPDATE whse_basemapping.fwa_geomupstream_cache_settings
+      SET cached_bytes = cached_bytes + COALESCE(ST_MemSize(upstream_geom), 0);
+    END IF;
+  END IF;
+
+  -- remove a batch of least recently used entries once past the size limit
+  SELECT max_size_bytes, cached_bytes INTO max_bytes, total_bytes
+  FROM whse_basemapping.fwa_geomupstream_cache_settings;
+
+  IF total_bytes > max_bytes AND
+     pg_total_relation_size('whse_basemapping.fwa_geomupstream_cache') > max_bytes
+  THEN
+    WITH lru AS
+    (
+      SELECT
+        linear_feature_id,
+        tolerance,
+        size_bytes,
+        SUM(size_bytes) OVER (ORDER BY last_used, linear_feature_id, tolerance) AS freed_bytes
+      FROM
+        -- oldest entries first, read from the last_used index
+        (SELECT linear_feature_id, tolerance, size_bytes, last_used
+         FROM whse_basemapping.fwa_geomupstream_cache
+         ORDER BY last_used, linear_feature_id, tolerance
+         LIMIT 1000) AS oldest
+    ),
+
+    deleted AS
+    (
+      DELETE FROM whse_basemapping.fwa_geomupstream_cache c
+      USING lru
+      WHERE c.linear_feature_id = lru.linear_feature_id
+      AND c.tolerance = lru.tolerance
+      AND lru.freed_bytes - lru.size_bytes < total_bytes - (max_bytes * .9)
+      RETURNING c.size_bytes
+    )
+
+    UPDATE whse_basemapping.fwa_geomupstream_cache_settings
+    SET cached_bytes = cached_bytes - (SELECT COALESCE(SUM(size_bytes), 0)
+                                       FROM deleted);
+  END IF;
+
+END IF;
+
+RETURN ST_Collect(ARRAY(
+  SELECT (ST_Dump(g)).geom
+  FROM unnest(ARRAY[start_geom, upstream_geom]) AS g
+  WHERE g IS NOT NULL));
+
+END
+$$ LANGUAGE 'plpgsql' VOLATILE;
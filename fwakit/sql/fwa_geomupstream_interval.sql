@@ -0,0 +1,82 @@
+-- fwa_geomupstream_interval(blue_line_key, downstream_route_measure, padding)
+
+-- As fwa_geomupstream, but upstream segments are found using the interval
+-- (nested set) columns added by fwakit.fwa.add_intervals rather than ltree
+-- comparisons (see fwa_lengthupstream_interval)
+
+
+CREATE OR REPLACE FUNCTION fwa_geomupstream_interval(
+    blkey integer,
+    measure double precision,
+    padding numeric DEFAULT .001
+)
+
+RETURNS geometry AS $$
+
+-- get the segment of interest
+WITH a AS
+  (SELECT
+     linear_feature_id,
+     blue_line_key,
+     downstream_route_measure,
+     wscode_left,
+     wscode_right,
+     localcode_left,
+     localcode_right,
+     ST_LineSubstring((ST_Dump(geom)).geom, ((measure - downstream_route_measure) / length_metre), 1) as geom
+   FROM whse_basemapping.fwa_stream_networks_sp
+   WHERE
+     blue_line_key = blkey
+     AND downstream_route_measure <= (measure + .001)
+     AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+   ORDER BY downstream_route_measure DESC
+   LIMIT 1),
+
+-- find all streams upstream, returning the sum of the lengths
+upstream AS
+(
+  SELECT
+    b.blue_line_key,
+    b.geom
+  FROM a
+  LEFT OUTER JOIN whse_basemapping.fwa_stream_networks_sp b ON
+    -- b is a child of a, always
+    b.wscode_left BETWEEN a.wscode_left AND a.wscode_right
+    -- never return the start segment, that is added at the end
+  AND b.linear_feature_id != a.linear_feature_id
+  AND
+    (
+      -- wscode and localcode of a are equivalent, everything not lower down
+      -- on the same blue line is upstream
+      (a.wscode_left = a.localcode_left AND
+        (b.blue_line_key <> a.blue_line_key OR
+         b.downstream_route_measure > a.downstream_route_measure + padding)
+      )
+      OR
+      (a.wscode_left != a.localcode_left AND
+        (
+         -- higher up the blue line (plus fudge factor)
+          (b.blue_line_key = a.blue_line_key AND
+           b.downstream_route_measure > a.downstream_route_measure + padding)
+          OR
+         -- tributaries: after the interval of a localcode
+          b.wscode_left > a.localcode_right
+          OR
+         -- side channels: same watershed code, with larger localcode
+          (b.wscode_left = a.wscode_left AND
+           b.localcode_left >= a.localcode_left)
+        )
+      )
+    )
+)
+
+  SELECT ST_Union(geom) as geom
+  FROM
+  (SELECT blue_line_key, geom
+   FROM a
+   UNION ALL
+   SELECT blue_line_key, geom
+   FROM upstream) as foo;
+
+$$
+language 'sql' immutable strict parallel safe;
@@ -0,0 +1,75 @@
+-- fwa_lengthdownstream_array(blue_line_key, downstream_route_measure, padding)
+
+-- As fwa_lengthdownstream, but downstream segments are found by comparing the
+-- integer array codes (wscode_array, localcode_array) added by
+-- fwakit.fwa.add_wsc_arrays rather than ltree codes (see
+-- fwa_downstreamwsc_array)
+
+
+CREATE OR REPLACE FUNCTION fwa_lengthdownstream_array(
+    blkey integer,
+    measure double precision,
+    padding numeric DEFAULT .001
+)
+
+RETURNS double precision AS $$
+
+with a as (
+  SELECT 1 as k,
+    linear_feature_id,
+    blue_line_key,
+    wscode_array,
+    localcode_array,
+    downstream_route_measure,
+    length_metre
+  FROM whse_basemapping.fwa_stream_networks_sp
+  WHERE blue_line_key = blkey
+  -- use zero measure when measure minus padding is negative
+  AND downstream_route_measure <= GREATEST(0::float, (measure - padding)::float)
+  -- do not compute anything for side channels, we don't know what is downstream
+  AND localcode_array IS NOT NULL
+  ORDER BY downstream_route_measure desc
+  LIMIT 1
+
+),
+
+downstream as (
+  SELECT
+      1 as k,
+      SUM(b.length_metre) as length_metre
+   FROM
+     whse_basemapping.fwa_stream_networks_sp b
+   INNER JOIN a ON
+    -- never return the stream segment at which we start, that is dealt with
+    -- at the end
+    b.linear_feature_id != a.linear_feature_id AND
+    (
+      -- downstream criteria 1 - same blue line, lower measure
+      (b.blue_line_key = a.blue_line_key AND
+       b.downstream_route_measure <= a.downstream_route_measure)
+      OR
+      -- criteria 2 - watershed code a is a child of watershed code b
+      (b.wscode_array <= a.wscode_array
+          AND a.wscode_array[1:cardinality(b.wscode_array)] = b.wscode_array
+          AND (
+               -- AND local code is lower
+               b.localcode_array < a.localcode_array[1:cardinality(b.localcode_array)]
+               -- OR wscode and localcode are equivalent
+               OR b.wscode_array = b.localcode_array
+               -- OR any missed side channels on the same watershed code
+               OR (b.wscode_array = a.wscode_array AND
+                   b.blue_line_key != a.blue_line_key AND
+                   b.localcode_array < a.localcode_array)
+               )
+      )
+  )
+)
+-- add together length from segment on which measure falls,
+-- plus everything downstream
+  SELECT
+    (measure - a.downstream_route_measure) +
+    COALESCE(downstream.length_metre, 0) AS length_downstr
+  FROM a left outer join downstream on a.k = downstream.k
+
+$$
+language 'sql' immutable strict parallel safe;
@@ -0,0 +1,40 @@
+-- fwa_lengthdownstream_lookup(blue_line_key, downstream_route_measure, padding)
+
+-- Return length of stream downstream of a point represented by a blue line
+-- key and a downstream route measure, using the distance to the outlet
+-- precomputed for each segment in fwa_stream_networks_lengthdownstream (see
+-- create_fwa_stream_networks_lengthdownstream.sql). The length is the stored
+-- value for the segment on which the point falls plus the distance from the
+-- bottom of the segment to the point.
+
+-- fwa_lengthdownstream remains available for validating the stored values
+-- (see fwakit.fwa.validate_length_downstream).
+
+-- Values must be rebuilt (fwakit length_downstream) whenever streams are reloaded.
+
+
+CREATE OR REPLACE FUNCTION fwa_lengthdownstream_lookup(
+    blkey integer,
+    measure double precision,
+    padding numeric DEFAULT .001
+)
+
+RETURNS double precision AS $$
+
+SELECT (measure - a.downstream_route_measure) + d.length_downstream
+FROM
+  -- get the segment of interest
+  (SELECT linear_feature_id, downstream_route_measure
+   FROM whse_basemapping.fwa_stream_networks_sp
+   WHERE blue_line_key = blkey
+   -- use zero measure when measure minus padding is negative
+   AND downstream_route_measure <= GREATEST(0::float, (measure - padding)::float)
+   -- do not compute anything for side channels, we don't know what is downstream
+   AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+   ORDER BY downstream_route_measure desc
+   LIMIT 1) AS a
+LEFT OUTER JOIN whse_basemapping.fwa_stream_networks_lengthdownstream d
+ON a.linear_feature_id = d.linear_feature_id;
+
+$$
+language 'sql' immutable strict parallel safe;
@@ -0,0 +1,72 @@
+-- fwa_lengthinstream_lookup(blue_line_key_a, measure_a, blue_line_key_b, measure_b, padding)
+
+-- Return length of stream between a point (a) and a point upstream (b),
+-- using the distance to the outlet precomputed for each segment in
+-- fwa_stream_networks_lengthdownstream. Once b is confirmed to be upstream
+-- of a, the length is the difference of their distances to the outlet.
+-- NULL is returned if b is not upstream of a.
+
+-- fwa_lengthinstream remains available for validating the results.
+
+
+CREATE OR REPLACE FUNCTION fwa_lengthinstream_lookup(
+    blkey_a integer,
+    measure_a double precision,
+    blkey_b integer,
+    measure_b double precision,
+    padding numeric DEFAULT .001
+)
+
+RETURNS double precision AS $$
+
+-- find the codes and distance to outlet of the lower point (a)
+WITH bottom AS
+(
+  SELECT
+    s.blue_line_key,
+    s.wscode_ltree,
+    s.localcode_ltree,
+    (measure_a - s.downstream_route_measure) + d.length_downstream AS length_downstream
+  FROM whse_basemapping.fwa_stream_networks_sp s
+  INNER JOIN whse_basemapping.fwa_stream_networks_lengthdownstream d
+  ON s.linear_feature_id = d.linear_feature_id
+  WHERE s.blue_line_key = blkey_a
+  AND s.downstream_route_measure <= GREATEST(0::float, (measure_a - padding)::float)
+  AND s.localcode_ltree IS NOT NULL AND s.localcode_ltree != ''
+  ORDER BY s.downstream_route_measure desc
+  LIMIT 1
+),
+
+-- find the codes and distance to outlet of the upper point (b)
+top AS
+(
+  SELECT
+    s.blue_line_key,
+    s.wscode_ltree,
+    s.localcode_ltree,
+    (measure_b - s.downstream_route_measure) + d.length_downstream AS length_downstream
+  FROM whse_basemapping.fwa_stream_networks_sp s
+  INNER JOIN whse_basemapping.fwa_stream_networks_lengthdownstream d
+  ON s.linear_feature_id = d.linear_feature_id
+  WHERE s.blue_line_key = blkey_b
+  AND s.downstream_route_measure <= GREATEST(0::float, (measure_b - padding)::float)
+  AND s.localcode_ltree IS NOT NULL AND s.localcode_ltree != ''
+  ORDER BY s.downstream_route_measure desc
+  LIMIT 1
+)
+
+SELECT
+  CASE
+    -- same stream, b must be higher up
+    WHEN b.blue_line_key = t.blue_line_key AND measure_b >= measure_a
+    THEN t.length_downstream - b.length_downstream
+    -- different streams, b must be upstream of a
+    WHEN b.blue_line_key != t.blue_line_key AND
+         fwa_upstreamwsc(b.wscode_ltree, b.localcode_ltree,
+                         t.wscode_ltree, t.localcode_ltree)
+    THEN t.length_downstream - b.length_downstream
+  END AS length_instream
+FROM bottom b, top t
+
+$$
+language 'sql' immutable strict parallel safe;
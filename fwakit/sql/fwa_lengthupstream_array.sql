@@ -0,0 +1,71 @@
+-- fwa_lengthupstream_array(blue_line_key, downstream_route_measure, padding)
+
+-- As fwa_lengthupstream, but upstream segments are found by comparing the
+-- integer array codes (wscode_array, localcode_array) added by
+-- fwakit.fwa.add_wsc_arrays rather than ltree codes (see
+-- fwa_upstreamwsc_array). All comparisons are btree range/equality tests.
+
+
+CREATE OR REPLACE FUNCTION fwa_lengthupstream_array(
+    blkey integer,
+    measure double precision,
+    padding numeric DEFAULT .001
+)
+
+RETURNS double precision AS $$
+
+-- get the segment of interest
+WITH a AS
+  (SELECT * FROM whse_basemapping.fwa_stream_networks_sp
+   WHERE
+     blue_line_key = blkey
+     AND downstream_route_measure <= (measure + padding)
+     AND localcode_array IS NOT NULL
+   ORDER BY downstream_route_measure DESC
+   LIMIT 1),
+
+-- find all streams upstream, returning the sum of the lengths
+upstream AS
+(
+  SELECT
+    COALESCE(SUM(b.length_metre), 0) as length_metre
+  FROM a
+  LEFT OUTER JOIN whse_basemapping.fwa_stream_networks_sp b ON
+    -- b is a child of a, always
+    b.wscode_array >= a.wscode_array
+  AND b.wscode_array < fwa_wscarray_upper(a.wscode_array)
+    -- never return the start segment, that is added at the end
+  AND b.linear_feature_id != a.linear_feature_id
+  AND
+    (
+      -- wscode and localcode of a are equivalent, everything not lower down
+      -- on the same blue line is upstream
+      (a.wscode_array = a.localcode_array AND
+        (b.blue_line_key <> a.blue_line_key OR
+         b.downstream_route_measure > a.downstream_route_measure + padding)
+      )
+      OR
+      (a.wscode_array != a.localcode_array AND
+        (
+         -- higher up the blue line (plus fudge factor)
+          (b.blue_line_key = a.blue_line_key AND
+           b.downstream_route_measure > a.downstream_route_measure + padding)
+          OR
+         -- tributaries: after local code of a and all of its children
+          b.wscode_array >= fwa_wscarray_upper(a.localcode_array)
+          OR
+         -- side channels: same watershed code, with larger localcode
+          (b.wscode_array = a.wscode_array AND
+           b.localcode_array >= a.localcode_array)
+        )
+      )
+    )
+)
+
+-- add together length from segment on which measure falls, plus
+-- everything upstream
+  SELECT  (a.length_metre - (measure - a.downstream_route_measure)) + upstream.length_metre
+  FROM a, upstream;
+
+$$
+language 'sql' immutable strict parallel safe;
@@ -0,0 +1,77 @@
+-- fwa_lengthupstream_interval(blue_line_key, downstream_route_measure, padding)
+
+-- As fwa_lengthupstream, but upstream segments are found using the interval
+-- (nested set) columns added by fwakit.fwa.add_intervals rather than ltree
+-- comparisons. Segment b is upstream of segment a when:
+--   - b wscode falls within the interval of a wscode (b is a child of a), and
+--   - a wscode and localcode are equivalent, or
+--   - b wscode is past the end of the interval of a localcode (tributaries
+--     above a, not children of a localcode), or
+--   - b is on the same watershed code, with larger localcode (side channels)
+-- These are all btree range/equality tests on integer columns.
+
+-- Intervals must be rebuilt (fwakit intervals) whenever streams are reloaded.
+
+
+CREATE OR REPLACE FUNCTION fwa_lengthupstream_interval(
+    blkey integer,
+    measure double precision,
+    padding numeric DEFAULT .001
+)
+
+RETURNS double precision AS $$
+
+-- get the segment of interest
+WITH a AS
+  (SELECT * FROM whse_basemapping.fwa_stream_networks_sp
+   WHERE
+     blue_line_key = blkey
+     AND downstream_route_measure <= (measure + padding)
+     AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+   ORDER BY downstream_route_measure DESC
+   LIMIT 1),
+
+-- find all streams upstream, returning the sum of the lengths
+upstream AS
+(
+  SELECT
+    COALESCE(SUM(b.length_metre), 0) as length_metre
+  FROM a
+  LEFT OUTER JOIN whse_basemapping.fwa_stream_networks_sp b ON
+    -- b is a child of a, always
+    b.wscode_left BETWEEN a.wscode_left AND a.wscode_right
+    -- never return the start segment, that is added at the end
+  AND b.linear_feature_id != a.linear_feature_id
+  AND
+    (
+      -- wscode and localcode of a are equivalent, everything not lower down
+      -- on the same blue line is upstream
+      (a.wscode_left = a.localcode_left AND
+        (b.blue_line_key <> a.blue_line_key OR
+         b.downstream_route_measure > a.downstream_route_measure + padding)
+      )
+      OR
+      (a.wscode_left != a.localcode_left AND
+        (
+         -- higher up the blue line (plus fudge factor)
+          (b.blue_line_key = a.blue_line_key AND
+           b.downstream_route_measure > a.downstream_route_measure + padding)
+          OR
+         -- tributaries: after the interval of a localcode
+          b.wscode_left > a.localcode_right
+          OR
+         -- side channels: same watershed code, with larger localcode
+          (b.wscode_left = a.wscode_left AND
+           b.localcode_left >= a.localcode_left)
+        )
+      )
+    )
+)
+
+-- add together length from segment on which measure falls, plus
+-- everything upstream
+  SELECT  (a.length_metre - (measure - a.downstream_route_measure)) + upstream.length_metre
+  FROM a, upstream;
+
+$$
+language 'sql' immutable strict parallel safe;
@@ -0,0 +1,42 @@
+-- fwa_lengthupstream_lookup(blue_line_key, downstream_route_measure, padding)
+
+-- Return length of stream upstream of a point represented by a blue line key
+-- and a downstream route measure, using the totals precomputed for each
+-- segment in fwa_stream_networks_lengthupstream (see
+-- create_fwa_stream_networks_lengthupstream.sql). The length is the stored
+-- total for the segment on which the point falls, less the length of the
+-- segment below the point.
+
+-- fwa_lengthupstream (which sums the upstream segments on each call) is
+-- unchanged.
+
+-- Note - totals are calculated with the default padding, padding only
+-- adjusts selection of the segment on which the point falls.
+
+-- Totals must be rebuilt (fwakit length_upstream) whenever streams are reloaded.
+
+
+CREATE OR REPLACE FUNCTION fwa_lengthupstream_lookup(
+    blkey integer,
+    measure double precision,
+    padding numeric DEFAULT .001
+)
+
+RETURNS double precision AS $$
+
+SELECT u.length_upstream - (measure - a.downstream_route_measure)
+FROM
+  -- get the segment of interest
+  (SELECT linear_feature_id, downstream_route_measure
+   FROM whse_basemapping.fwa_stream_networks_sp
+   WHERE
+     blue_line_key = blkey
+     AND downstream_route_measure <= (measure + padding)
+     AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+   ORDER BY downstream_route_measure DESC
+   LIMIT 1) AS a
+LEFT OUTER JOIN whse_basemapping.fwa_stream_networks_lengthupstream u
+ON a.linear_feature_id = u.linear_feature_id;
+
+$$
+language 'sql' immutable strict parallel safe;
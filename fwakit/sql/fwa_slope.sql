@@ -1,6 +1,9 @@
 -- Return slope of a stream between two measures
 -- fwa_slope(blue_line_key, downstream_route_measure, upstream_route_measure)
 
+-- Measures are validated against the blue line extents table
+-- (whse_basemapping.fwa_blue_lines, created by fwakit clean)
+
 CREATE OR REPLACE FUNCTION fwa_slope(
     blkey integer,
     measure_down double precision,
@@ -18,6 +21,17 @@ IF measure_down > measure_up THEN
   RAISE EXCEPTION 'Invalid measure - measure_up must be greater than measure_down';
 END IF;
 
+-- Check that the measures fall on the stream (with a mm of tolerance)
+IF NOT EXISTS
+  (SELECT 1
+   FROM whse_basemapping.fwa_blue_lines
+   WHERE blue_line_key = blkey
+   AND measure_down >= downstream_route_measure - .001
+   AND measure_up <= upstream_route_measure + .001)
+THEN
+  RAISE EXCEPTION 'Invalid measure, does not exist on stream';
+END IF;
+
 RETURN
   ROUND(
    ((fwa_elevation(blkey, measure_up) - fwa_elevation(blkey, measure_down))
@@ -1,7 +1,8 @@
 -- Find stream slope at point, over specified *total* length about point (m)
 
--- This function calls fwa_slope(blue_line_key, measure1, measure2), but
--- ensures that the measures used are within the length of the stream -
+-- Slope is calculated as fwa_slope(blue_line_key, measure1, measure2) does,
+-- but the measures are validated here only (once per call), ensuring that
+-- the measures used are within the length of the stream -
 -- intervals that correspond to measures shorter or longer than the stream are
 -- shifted to fall at the start/end of the line (the length of the interval
 -- is preserved).
@@ -22,6 +23,9 @@
 -- at end of line while preserving length of interval:
 --   fwa_intervalslope(99999, 980, 100)  ==  fwa_slope(99999, 950, 100)
 
+-- Measures at the ends of the stream come from the blue line extents table
+-- (whse_basemapping.fwa_blue_lines, created by fwakit clean)
+
 CREATE OR REPLACE FUNCTION fwa_slopewindow(
     blkey integer,             -- blue_line_key of stream
     measure double precision,  -- downstream_route_measure of measurement
@@ -49,15 +53,17 @@ meas := round(measure::numeric, 8);
 
 SELECT
   -- round to avoid floating point issues
-  -- a better strategy might be to round to the nearest cm/mm and convert
-  -- to integer?
-  -- (this would require modifying fwa_slope as well)
-  min(round(downstream_route_measure::numeric, 8)) as min_measure,
-  max(round(upstream_route_measure::numeric, 8)) as max_measure
-FROM whse_basemapping.fwa_stream_networks_sp
+  round(downstream_route_measure::numeric, 8) as min_measure,
+  round(upstream_route_measure::numeric, 8) as max_measure
+FROM whse_basemapping.fwa_blue_lines
 WHERE blue_line_key = blkey
 INTO min_m, max_m;
 
+-- Check that the stream exists
+IF min_m IS NULL THEN
+  RAISE EXCEPTION 'Invalid blue_line_key, does not exist';
+END IF;
+
 -- Check that the provided measure actually falls on the stream
 IF meas < min_m OR meas > max_m THEN
   RAISE EXCEPTION 'Invalid measure, does not exist on stream';
@@ -68,7 +74,8 @@ END IF;
 IF (max_m - min_m) < length
 THEN
   SELECT INTO slope
-    fwa_slope(blkey, min_m, max_m) as slope;
+    ROUND(((fwa_elevation(blkey, max_m) - fwa_elevation(blkey, min_m))
+           / (max_m - min_m))::numeric * 100, 2) as slope;
 
 -- Otherwise, check the measurement window - ensuring that we always measure
 -- the slope over the lenght specified, even if the measure is closer to the
@@ -99,7 +106,8 @@ WITH measures AS
 )
 
 SELECT INTO slope
-  fwa_slope(blkey, meas_down, meas_up) as slope
+  ROUND(((fwa_elevation(blkey, meas_up) - fwa_elevation(blkey, meas_down))
+         / (meas_up - meas_down))::numeric * 100, 2) as slope
 FROM measures;
 
 END IF;
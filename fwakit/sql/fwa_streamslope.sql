@@ -1,25 +1,29 @@
--- fwa_streamslope(blue_line_key, downstream_route_measure)
+-- fwa_streamprofile(blue_line_key, downstream_route_measure)
 
 -- Return slope of the stream at the location provided by blue_line_key and
 -- downstream_route_measure
 
+-- The measure parameter is new, previous versions took only blue_line_key
+-- (but referred to measure regardless). Drop the old signature so that it
+-- is not left behind as an overload.
+
+DROP FUNCTION IF EXISTS fwa_streamprofile(integer);
 
 CREATE OR REPLACE FUNCTION fwa_streamprofile(
-    blkey integer
+    blkey integer,
+    measure double precision
 )
 
 RETURNS double precision AS $$
 
+-- length of the blue line, not including lines outside of BC
+-- (from the blue line extents table created by fwakit clean)
 WITH total_len AS
 (SELECT
     blue_line_key,
-    downstream_route_measure + length_metre AS blue_line_length
- FROM whse_basemapping.fwa_stream_networks_sp
+    length_metre AS blue_line_length
+ FROM whse_basemapping.fwa_blue_lines
  WHERE blue_line_key = blkey
- -- do not include lines outside of BC
- AND edge_type != 6010
- ORDER BY downstream_route_measure DESC
- LIMIT 1
 ),
 
 line AS
@@ -22,8 +22,11 @@ fwakit=# SELECT FWW_UpstreamWSC('100.100000'::ltree, '100.100000'::ltree,
  t
 (1 row)
 
-Note that this function currently has a very large performance cost -
-the indexes may not be used - it does not get 'inlined'
+The function is a single boolean expression so that the planner can inline
+it into queries. Once inlined, the leading wscode_ltree_b <@ wscode_ltree_a
+condition can use the GiST index on wscode_ltree (when a is a constant or is
+the outer side of a nested loop join). For this to work, keep the function
+free of WHERE/FROM clauses and do not declare it STRICT.
 */
 
 CREATE OR REPLACE FUNCTION fwa_upstreamwsc(
@@ -35,32 +38,26 @@ CREATE OR REPLACE FUNCTION fwa_upstreamwsc(
 
 RETURNS boolean AS $$
 
-SELECT true
-WHERE
-  -- Simple case, where watershed code and local code of (a) are equivalent. -- Return TRUE for all records in (b) that are children of (a)
-    (wscode_ltree_a = localcode_ltree_a AND
-    wscode_ltree_b <@ wscode_ltree_a)
+-- b must be within the watershed of a
+SELECT wscode_ltree_b <@ wscode_ltree_a
+AND (
+  -- Simple case, where watershed code and local code of (a) are equivalent.
+  -- Return TRUE for all records in (b) that are children of (a)
+    wscode_ltree_a = localcode_ltree_a
 
-  -- Where watershed code and local code of (a) are not equivalent, more
-  -- comparison is required - the local codes must be compared:
+  -- Where watershed code and local code of (a) are not equivalent, the local
+  -- codes must be compared:
   OR
-    (
-      wscode_ltree_a != localcode_ltree_a
-      AND
-      wscode_ltree_b <@ wscode_ltree_a
-      AND
-      (
-       -- tributaries: watershed code of b > local code of a, and watershed code
-       -- of b is not a child of local code a
-          (wscode_ltree_b > localcode_ltree_a AND NOT
-           wscode_ltree_b <@ localcode_ltree_a)
-          OR
-       -- side channels, higher up on the same stream:
-       -- b is the same watershed code as a, but with larger local code
-          (wscode_ltree_b = wscode_ltree_a AND
-          localcode_ltree_b >= localcode_ltree_a)
-      )
-  )
+  -- tributaries: watershed code of b > local code of a, and watershed code
+  -- of b is not a child of local code a
+    (wscode_ltree_b > localcode_ltree_a AND NOT
+     wscode_ltree_b <@ localcode_ltree_a)
+  OR
+  -- side channels, higher up on the same stream:
+  -- b is the same watershed code as a, but with larger local code
+    (wscode_ltree_b = wscode_ltree_a AND
+     localcode_ltree_b >= localcode_ltree_a)
+)
 
 $$
-language 'sql' immutable parallel safe;
\ No newline at end of file
+language 'sql' immutable parallel safe;
@@ -0,0 +1,56 @@
+/*
+FWA_UpstreamWSC_Array(wscode_array_a, localcode_array_a,
+                      wscode_array_b, localcode_array_b)
+
+As FWA_UpstreamWSC, but comparing the integer array codes added by
+fwakit.fwa.add_wsc_arrays (see fwa_wsc2array) rather than ltree. Returns TRUE
+when the codes for b are upstream of (or equivalent to) the codes for a.
+
+Integer arrays sort element by element with a code ahead of its children, as
+ltree codes do, so every ltree test becomes a btree comparison:
+  - b <@ a (b within a)           b >= a AND b < fwa_wscarray_upper(a)
+  - b > a AND NOT b <@ a          b >= fwa_wscarray_upper(a)
+
+eg:
+
+fwakit=# SELECT FWA_UpstreamWSC_Array('{100,100000}', '{100,100000}',
+                                      '{100,100000,100}', '{100,100000,100}');
+ fwa_upstreamwsc_array
+-----------------------
+ t
+(1 row)
+
+As with FWA_UpstreamWSC, the function is a single boolean expression that the
+planner inlines; the leading range condition can then use the btree index on
+wscode_array.
+*/
+
+CREATE OR REPLACE FUNCTION fwa_upstreamwsc_array(
+    wscode_array_a integer[],
+    localcode_array_a integer[],
+    wscode_array_b integer[],
+    localcode_array_b integer[]
+)
+
+RETURNS boolean AS $$
+
+-- b must be within the watershed of a
+SELECT wscode_array_b >= wscode_array_a
+AND wscode_array_b < fwa_wscarray_upper(wscode_array_a)
+AND (
+  -- watershed code and local code of (a) are equivalent, everything within
+  -- the watershed of a is upstream
+    wscode_array_a = localcode_array_a
+  OR
+  -- tributaries: watershed code of b sorts after local code of a and all of
+  -- its children
+    wscode_array_b >= fwa_wscarray_upper(localcode_array_a)
+  OR
+  -- side channels, higher up on the same stream:
+  -- b is the same watershed code as a, but with larger local code
+    (wscode_array_b = wscode_array_a AND
+     localcode_array_b >= localcode_array_a)
+)
+
+$$
+language 'sql' immutable parallel safe;
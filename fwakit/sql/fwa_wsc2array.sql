@@ -0,0 +1,34 @@
+-- ------------------------------
+-- convert a watershed code string to an integer array
+-- (one element per level, trailing zero levels removed)
+-- ------------------------------
+CREATE OR REPLACE FUNCTION fwa_wsc2array(text)
+  RETURNS integer[]
+AS $$
+
+SELECT
+  string_to_array(regexp_replace($1, '(\-000000)+$', ''), '-')::integer[];
+
+$$
+LANGUAGE SQL
+IMMUTABLE
+PARALLEL SAFE
+RETURNS NULL ON NULL INPUT;
+
+-- ------------------------------
+-- return the smallest code array that sorts after a code and all of its
+-- children (the code with its last level incremented), so that codes within
+-- a watershed are the btree range:
+--   code >= a AND code < fwa_wscarray_upper(a)
+-- ------------------------------
+CREATE OR REPLACE FUNCTION fwa_wscarray_upper(integer[])
+  RETURNS integer[]
+AS $$
+
+SELECT
+  $1[1:cardinality($1) - 1] || ($1[cardinality($1)] + 1);
+
+$$
+LANGUAGE SQL
+IMMUTABLE
+PARALLEL SAFE;
@@ -0,0 +1,53 @@
+-- Return each referencable stream segment with the id of the segment
+-- immediately downstream (-1 at network outlets), for building an in-memory
+-- network (fwakit.network).
+
+-- Downstream of a segment is the next segment down the same blue line. At
+-- the bottom of a blue line it is the segment below the confluence on the
+-- main flow of the receiving stream:
+--   - for tributaries (main flow lines), the parent watershed code
+--   - for side channels, the same watershed code
+-- with the largest local code lower than the local code of the segment.
+
+WITH segments AS
+(
+  SELECT
+    linear_feature_id,
+    blue_line_key,
+    watershed_key,
+    downstream_route_measure,
+    length_metre,
+    wscode_ltree,
+    localcode_ltree,
+    fwa_watershed_code,
+    local_watershed_code,
+    lag(linear_feature_id) OVER (PARTITION BY blue_line_key
+                                 ORDER BY downstream_route_measure) AS downstream_id
+  FROM whse_basemapping.fwa_stream_networks_sp
+  WHERE localcode_ltree IS NOT NULL AND localcode_ltree != ''
+  AND NOT wscode_ltree <@ '999'
+)
+
+SELECT
+  s.linear_feature_id,
+  s.blue_line_key,
+  s.downstream_route_measure,
+  s.length_metre,
+  COALESCE(s.downstream_id, r.linear_feature_id, -1) AS downstream_id,
+  s.fwa_watershed_code,
+  s.local_watershed_code
+FROM segments s
+LEFT OUTER JOIN LATERAL
+  (SELECT p.linear_feature_id
+   FROM whse_basemapping.fwa_stream_networks_sp p
+   WHERE s.downstream_id IS NULL
+   AND p.wscode_ltree = CASE
+                          WHEN s.blue_line_key = s.watershed_key
+                          THEN subpath(s.wscode_ltree, 0, nlevel(s.wscode_ltree) - 1)
+                          ELSE s.wscode_ltree
+                        END
+   AND p.blue_line_key = p.watershed_key
+   AND p.localcode_ltree < s.localcode_ltree
+   AND p.localcode_ltree != ''
+   ORDER BY p.localcode_ltree DESC, p.downstream_route_measure DESC
+   LIMIT 1) AS r ON TRUE
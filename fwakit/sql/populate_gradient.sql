@@ -1,15 +1,17 @@
--- Populate the gradient column for specified watershed group
--- Dumping the geoms is necessary because they are loaded as MultiLinestrings,
--- which are not accepted by ST_PointN
+-- Populate the gradient column for specified watershed group and range of
+-- linear_feature_id (start inclusive, end exclusive)
+-- Only segments without a gradient are updated, so an interrupted run can be
+-- resumed.
+-- Streams are loaded as MultiLinestrings, which are not accepted by
+-- ST_PointN - extract the (single) line with ST_GeometryN
 
-WITH segment AS
-(SELECT
-  linear_feature_id,
-  (ST_Dump(geom)).geom as geom
-FROM whse_basemapping.fwa_stream_networks_sp
-WHERE watershed_group_code = %s)
-
-UPDATE whse_basemapping.fwa_stream_networks_sp as streams
-SET gradient = round((((ST_Z(ST_PointN(seg.geom, -1)) - ST_Z(ST_PointN(seg.geom, 1))) / ST_Length(seg.geom))::numeric), 4)
-FROM segment as seg
-WHERE streams.linear_feature_id = seg.linear_feature_id;
+UPDATE whse_basemapping.fwa_stream_networks_sp
+SET gradient = round(
+      ((ST_Z(ST_PointN(ST_GeometryN(geom, 1), -1)) -
+        ST_Z(ST_PointN(ST_GeometryN(geom, 1), 1))) /
+       NULLIF(ST_Length(ST_GeometryN(geom, 1)), 0))::numeric, 4
+    )
+WHERE watershed_group_code = %s
+AND linear_feature_id >= %s
+AND linear_feature_id < %s
+AND gradient IS NULL;
@@ -1,14 +1,15 @@
--- Create event table from provided points
--- note that this will return up to 100 results per point,
--- every stream within the tolerance is returned
+-- Reference points to the stream network
+-- note that this will return up to 100 results per point - of the closest
+-- 100 streams within the tolerance, the closest match on each blue line is
+-- returned, unless only the closest match for each point is requested
+
+-- This is the SELECT only - fwakit.fwa.reference_points creates the output
+-- table and appends the results for each chunk of points (the points source
+-- is the point table, filtered to the chunk)
 
 -- this would be much better as a postgres function where we are not injecting
 -- sql - but how do we pass the point table and id to the CTE?
 
-DROP TABLE IF EXISTS $out_table;
-
-CREATE TABLE $out_table AS
-
 WITH candidates AS
  ( SELECT
     pt.$point_id,
@@ -23,26 +24,35 @@ WITH candidates AS
     nn.distance_to_stream,
     nn.watershed_group_code,
     ST_LineMerge(nn.geom) AS geom
-  FROM $point_table as pt
+  FROM $points as pt
   CROSS JOIN LATERAL
-  (SELECT
-     str.linear_feature_id,
-     str.wscode_ltree,
-     str.localcode_ltree,
-     str.fwa_watershed_code,
-     str.local_watershed_code,
-     str.blue_line_key,
-     str.length_metre,
-     str.downstream_route_measure,
-     str.watershed_group_code,
-     str.geom,
-     ST_Distance(str.geom, pt.geom) as distance_to_stream
-    FROM whse_basemapping.fwa_stream_networks_sp AS str
-    WHERE str.localcode_ltree IS NOT NULL
-    AND NOT str.wscode_ltree <@ '999'
-    ORDER BY str.geom <-> pt.geom
-    LIMIT 100) as nn
-  WHERE nn.distance_to_stream < %s
+  -- the 100 closest streams, of those within the threshold: ST_DWithin
+  -- bounds the index search by the threshold and the (few) streams found
+  -- are sorted. OFFSET 0 keeps the planner from using an ordered (KNN)
+  -- index scan instead, which reads on past the threshold until 100 streams
+  -- are found.
+  (SELECT *
+   FROM
+    (SELECT
+       str.linear_feature_id,
+       str.wscode_ltree,
+       str.localcode_ltree,
+       str.fwa_watershed_code,
+       str.local_watershed_code,
+       str.blue_line_key,
+       str.length_metre,
+       str.downstream_route_measure,
+       str.watershed_group_code,
+       str.geom,
+       ST_Distance(str.geom, pt.geom) as distance_to_stream
+      FROM whse_basemapping.fwa_stream_networks_sp AS str
+      WHERE ST_DWithin(str.geom, pt.geom, %(threshold)s)
+      AND str.localcode_ltree IS NOT NULL
+      AND NOT str.wscode_ltree <@ '999'
+      OFFSET 0) AS within
+   ORDER BY distance_to_stream
+   LIMIT 100) as nn
+  WHERE nn.distance_to_stream < %(threshold)s
 ),
 
 bluelines AS
@@ -54,7 +64,7 @@ FROM candidates
 ORDER BY $point_id, blue_line_key, distance_to_stream
 )
 
-SELECT
+SELECT $distinct
   bluelines.$point_id,
   candidates.linear_feature_id,
   candidates.wscode_ltree,
@@ -72,4 +82,5 @@ FROM bluelines
 INNER JOIN candidates ON bluelines.$point_id = candidates.$point_id
 AND bluelines.blue_line_key = candidates.blue_line_key
 AND bluelines.distance_to_stream = candidates.distance_to_stream
-INNER JOIN $point_table pts ON bluelines.$point_id = pts.$point_id
\ No newline at end of file
+INNER JOIN $point_table pts ON bluelines.$point_id = pts.$point_id
+$order
@@ -0,0 +1,32 @@
+-- Return the vertices of each referencable stream segment, in order along
+-- each line, for building an in-memory index of the streams
+-- (fwakit.reference). Streams are limited to the watershed groups provided
+-- (all groups when NULL) and filtered as in reference_points.sql.
+
+-- Lines are merged as in reference_points.sql - where a line remains
+-- multipart the part is noted, so no segment is made between the parts.
+
+SELECT
+  s.linear_feature_id,
+  s.blue_line_key,
+  s.downstream_route_measure,
+  s.length_metre,
+  CASE
+    WHEN array_length((s.vertex).path, 1) = 2 THEN (s.vertex).path[1]
+    ELSE 1
+  END AS part,
+  ST_X((s.vertex).geom) AS x,
+  ST_Y((s.vertex).geom) AS y
+FROM
+  (SELECT
+     linear_feature_id,
+     blue_line_key,
+     downstream_route_measure,
+     length_metre,
+     ST_DumpPoints(ST_LineMerge(geom)) AS vertex
+   FROM whse_basemapping.fwa_stream_networks_sp
+   WHERE (%(groups)s::text[] IS NULL
+          OR watershed_group_code = ANY(%(groups)s::text[]))
+   AND localcode_ltree IS NOT NULL
+   AND NOT wscode_ltree <@ '999') AS s
+ORDER BY s.linear_feature_id, (s.vertex).path
@@ -0,0 +1,48 @@
+-- refresh blue line extents for the blue lines with segments in the
+-- specified watershed groups (see create_fwa_blue_lines.sql)
+
+DELETE FROM whse_basemapping.fwa_blue_lines
+WHERE watershed_group_code = ANY(%(groups)s)
+OR blue_line_key IN
+  (SELECT blue_line_key
+   FROM whse_basemapping.fwa_stream_networks_sp
+   WHERE watershed_group_code = ANY(%(groups)s));
+
+WITH blue_lines AS
+(
+  SELECT DISTINCT blue_line_key
+  FROM whse_basemapping.fwa_stream_networks_sp
+  WHERE watershed_group_code = ANY(%(groups)s)
+)
+
+INSERT INTO whse_basemapping.fwa_blue_lines
+SELECT
+  e.blue_line_key,
+  e.downstream_route_measure,
+  e.upstream_route_measure,
+  e.length_metre,
+  o.linear_feature_id,
+  o.wscode_ltree,
+  o.localcode_ltree,
+  o.watershed_group_code
+FROM
+  (SELECT
+     s.blue_line_key,
+     min(s.downstream_route_measure) AS downstream_route_measure,
+     max(s.upstream_route_measure) AS upstream_route_measure,
+     max(s.downstream_route_measure + s.length_metre)
+       FILTER (WHERE s.edge_type != 6010) AS length_metre
+   FROM whse_basemapping.fwa_stream_networks_sp s
+   INNER JOIN blue_lines b ON s.blue_line_key = b.blue_line_key
+   GROUP BY s.blue_line_key) AS e
+INNER JOIN
+  (SELECT DISTINCT ON (s.blue_line_key)
+     s.blue_line_key,
+     s.linear_feature_id,
+     s.wscode_ltree,
+     s.localcode_ltree,
+     s.watershed_group_code
+   FROM whse_basemapping.fwa_stream_networks_sp s
+   INNER JOIN blue_lines b ON s.blue_line_key = b.blue_line_key
+   ORDER BY s.blue_line_key, s.downstream_route_measure) AS o
+ON e.blue_line_key = o.blue_line_key;
@@ -0,0 +1,23 @@
+-- refresh named streams for the specified watershed groups
+-- (see create_fwa_named_streams.sql)
+
+DELETE FROM whse_basemapping.fwa_named_streams
+WHERE watershed_group_code = ANY(%(groups)s);
+
+INSERT INTO whse_basemapping.fwa_named_streams
+  (gnis_name, stream_order, watershed_group_code, geom)
+SELECT
+  str.gnis_name,
+  str.stream_order,
+  str.watershed_group_code,
+  ST_Multi(ST_Force2D(ST_Simplify(ST_Union(str.geom), 25))) AS geom
+  FROM whse_basemapping.fwa_stream_networks_sp str
+  LEFT OUTER JOIN whse_basemapping.fwa_lakes_poly lk
+  ON str.waterbody_key = lk.waterbody_key
+  LEFT OUTER JOIN whse_basemapping.fwa_manmade_waterbodies_poly mmwb
+  ON str.waterbody_key = mmwb.waterbody_key
+  WHERE gnis_name IS NOT NULL
+  AND lk.waterbody_key IS NULL
+  AND mmwb.waterbody_key IS NULL
+  AND str.watershed_group_code = ANY(%(groups)s)
+  GROUP BY str.gnis_name, str.stream_order, str.watershed_group_code;
@@ -0,0 +1,69 @@
+-- refresh the waterbody lookup for waterbodies in the specified watershed
+-- groups (see create_fwa_waterbodies.sql)
+-- Remove keys present in the groups and keys no longer in any source,
+-- then add the keys back from the groups.
+
+DELETE FROM whse_basemapping.fwa_waterbodies wb
+WHERE wb.waterbody_key IN (
+    SELECT waterbody_key FROM whse_basemapping.fwa_lakes_poly
+    WHERE watershed_group_code = ANY(%(groups)s)
+  UNION
+    SELECT waterbody_key FROM whse_basemapping.fwa_wetlands_poly
+    WHERE watershed_group_code = ANY(%(groups)s)
+  UNION
+    SELECT waterbody_key FROM whse_basemapping.fwa_rivers_poly
+    WHERE watershed_group_code = ANY(%(groups)s)
+  UNION
+    SELECT waterbody_key FROM whse_basemapping.fwa_manmade_waterbodies_poly
+    WHERE watershed_group_code = ANY(%(groups)s)
+  UNION
+    SELECT waterbody_key FROM whse_basemapping.fwa_glaciers_poly
+    WHERE watershed_group_code = ANY(%(groups)s)
+)
+OR NOT EXISTS (
+    SELECT waterbody_key FROM whse_basemapping.fwa_lakes_poly
+    WHERE waterbody_key = wb.waterbody_key
+  UNION ALL
+    SELECT waterbody_key FROM whse_basemapping.fwa_wetlands_poly
+    WHERE waterbody_key = wb.waterbody_key
+  UNION ALL
+    SELECT waterbody_key FROM whse_basemapping.fwa_rivers_poly
+    WHERE waterbody_key = wb.waterbody_key
+  UNION ALL
+    SELECT waterbody_key FROM whse_basemapping.fwa_manmade_waterbodies_poly
+    WHERE waterbody_key = wb.waterbody_key
+  UNION ALL
+    SELECT waterbody_key FROM whse_basemapping.fwa_glaciers_poly
+    WHERE waterbody_key = wb.waterbody_key
+);
+
+INSERT INTO whse_basemapping.fwa_waterbodies (waterbody_key, waterbody_type)
+  SELECT DISTINCT waterbody_key, waterbody_type
+  FROM whse_basemapping.fwa_lakes_poly
+  WHERE waterbody_key IS NOT NULL
+  AND waterbody_key IN (SELECT waterbody_key FROM whse_basemapping.fwa_lakes_poly
+                        WHERE watershed_group_code = ANY(%(groups)s))
+UNION ALL
+  SELECT DISTINCT waterbody_key, waterbody_type
+  FROM whse_basemapping.fwa_wetlands_poly
+  WHERE waterbody_key IS NOT NULL
+  AND waterbody_key IN (SELECT waterbody_key FROM whse_basemapping.fwa_wetlands_poly
+                        WHERE watershed_group_code = ANY(%(groups)s))
+UNION ALL
+  SELECT DISTINCT waterbody_key, waterbody_type
+  FROM whse_basemapping.fwa_rivers_poly
+  WHERE waterbody_key IS NOT NULL
+  AND waterbody_key IN (SELECT waterbody_key FROM whse_basemapping.fwa_rivers_poly
+                        WHERE watershed_group_code = ANY(%(groups)s))
+UNION ALL
+  SELECT DISTINCT waterbody_key, waterbody_type
+  FROM whse_basemapping.fwa_manmade_waterbodies_poly
+  WHERE waterbody_key IS NOT NULL
+  AND waterbody_key IN (SELECT waterbody_key FROM whse_basemapping.fwa_manmade_waterbodies_poly
+                        WHERE watershed_group_code = ANY(%(groups)s))
+UNION ALL
+  SELECT DISTINCT waterbody_key, waterbody_type
+  FROM whse_basemapping.fwa_glaciers_poly
+  WHERE waterbody_key IS NOT NULL
+  AND waterbody_key IN (SELECT waterbody_key FROM whse_basemapping.fwa_glaciers_poly
+                        WHERE watershed_group_code = ANY(%(groups)s));
@@ -0,0 +1,13 @@
+-- refresh subdivided watershed groups for the specified groups
+-- (see create_fwa_watershed_groups_subdivided.sql)
+
+DELETE FROM whse_basemapping.fwa_watershed_groups_subdivided
+WHERE watershed_group_code = ANY(%(groups)s);
+
+INSERT INTO whse_basemapping.fwa_watershed_groups_subdivided
+(watershed_group_code, geom)
+SELECT
+  watershed_group_code,
+  ST_Subdivide(ST_Force2D(geom)) as geom
+FROM whse_basemapping.fwa_watershed_groups_poly
+WHERE watershed_group_code = ANY(%(groups)s);
@@ -0,0 +1,33 @@
+-- Return a signature of table $table (and its partitions) that changes
+-- whenever rows are inserted, updated or deleted, or the table is truncated,
+-- rewritten or recreated. Used to invalidate data cached outside of the
+-- database (eg network snapshots, fwakit.network) or derived from the table
+-- (fwa_geomupstream_cached).
+
+-- Statistics counters are cumulative and are not reset by changes to the
+-- table, a statistics reset only invalidates the cache unnecessarily.
+-- Counters are updated asynchronously (after the transaction ends), so the
+-- signature also includes the row count and the most recent transaction to
+-- write a row (xmin) - this requires a scan of the table.
+
+WITH stats AS
+(
+  SELECT string_agg(concat_ws(':', c.oid, c.relfilenode,
+                              s.n_tup_ins, s.n_tup_upd, s.n_tup_del),
+                    ',' ORDER BY c.oid) AS counters
+  FROM pg_class c
+  LEFT OUTER JOIN pg_stat_user_tables s ON c.oid = s.relid
+  WHERE c.oid = %(table)s::regclass
+  OR c.oid IN (SELECT inhrelid
+               FROM pg_inherits
+               WHERE inhparent = %(table)s::regclass)
+),
+
+content AS
+(
+  SELECT count(*) AS n_rows, max(xmin::text::bigint) AS max_xmin
+  FROM $table
+)
+
+SELECT md5(concat_ws(';', stats.counters, content.n_rows, content.max_xmin))
+FROM stats, content
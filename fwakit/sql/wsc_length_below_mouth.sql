@@ -0,0 +1,47 @@
+-- For every watershed code in the stream network, return the length of
+-- stream on the parent watershed code that is below the mouth of the code
+-- (segments on the parent with a lower local code), sorted by code.
+
+-- Codes and parent segments are sorted together by position on the parent,
+-- so all lengths come from a single running sum.
+
+WITH codes AS
+(
+  SELECT DISTINCT wscode_ltree AS code
+  FROM whse_basemapping.fwa_stream_networks_sp
+  WHERE wscode_ltree IS NOT NULL
+),
+
+positions AS
+(
+  -- segments, positioned by local code on their watershed code
+  SELECT
+    wscode_ltree AS parent,
+    localcode_ltree AS position,
+    1 AS kind,
+    length_metre,
+    NULL::ltree AS code
+  FROM whse_basemapping.fwa_stream_networks_sp
+  WHERE wscode_ltree IS NOT NULL
+  AND localcode_ltree IS NOT NULL AND localcode_ltree != ''
+  UNION ALL
+  -- mouths of codes, positioned by code on the parent code
+  -- (ordered ahead of segments with local code equal to the code)
+  SELECT
+    subpath(code, 0, nlevel(code) - 1) AS parent,
+    code AS position,
+    0 AS kind,
+    0 AS length_metre,
+    code
+  FROM codes
+)
+
+SELECT code, length_below
+FROM
+  (SELECT
+     code,
+     SUM(length_metre) OVER (PARTITION BY parent
+                             ORDER BY position, kind) AS length_below
+   FROM positions) AS sums
+WHERE code IS NOT NULL
+ORDER BY code;
@@ -6,28 +6,38 @@ try:
     from urllib.parse import urlparse
 except ImportError:
      from urlparse import urlparse
-try:
-    from urllib.request import urlopen
-except ImportError:
-    from urllib2 import urlopen
 
 
 import datetime as dt
+import ftplib
+import hashlib
+import io
+import json
 import logging as lg
 import os
 import pkg_resources
+import subprocess
 import sys
-import tempfile
+import time
 import unicodedata
 import zipfile
 
+import numpy as np
 import requests
 
 import pgdata
 
+from . import pgcopy
 from . import settings
 
-CHUNK_SIZE = 1024
+CHUNK_SIZE = 1024 * 1024
+
+# download connect and read timeouts (seconds) - a stalled server raises an
+# error rather than hanging the download
+TIMEOUT = (30, 300)
+
+# rows fetched at a time from server side cursors (stream_query)
+FETCH_SIZE = 10000
 
 
 class QueryDict(object):
@@ -231,44 +241,221 @@ def make_sure_path_exists(path):
     return path
 
 
-def download_and_unzip(url, unzip_dir):
-    """Download and unzip a zipped folder from web or ftp
+def file_sha256(path):
+    """Return sha256 hex digest of a file
+    """
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def ftp_connect(parsed_url):
+    """Return a connection to ftp server of provided (parsed) url
+    """
+    # ftplib has a single timeout, for connecting and for each read
+    ftp = ftplib.FTP(timeout=TIMEOUT[1])
+    ftp.connect(parsed_url.hostname, parsed_url.port or 21)
+    ftp.login(parsed_url.username or 'anonymous', parsed_url.password or '')
+    ftp.voidcmd('TYPE I')
+    return ftp
+
+
+def remote_info(url):
+    """
+    Return size and modification time (and etag if available) of file at url,
+    for checking if a cached copy is current
     """
-    fp = tempfile.NamedTemporaryFile('wb',
-                                     dir=tempfile.gettempdir(),
-                                     suffix=".zip",
-                                     delete=False)
     parsed_url = urlparse(url)
-    # http
     if parsed_url.scheme == "http" or parsed_url.scheme == 'https':
-        res = requests.get(url, stream=True)
-
+        res = requests.head(url, allow_redirects=True, timeout=TIMEOUT)
         if not res.ok:
-            raise IOError
+            raise IOError('{u}: {s}'.format(u=url, s=res.status_code))
+        return {'size': res.headers.get('Content-Length'),
+                'modified': res.headers.get('Last-Modified'),
+                'etag': res.headers.get('ETag')}
+    elif parsed_url.scheme == "ftp":
+        ftp = ftp_connect(parsed_url)
+        info = {'size': str(ftp.size(parsed_url.path)),
+                'modified': ftp.sendcmd('MDTM ' + parsed_url.path),
+                'etag': None}
+        ftp.quit()
+        return info
+    else:
+        raise ValueError('Unsupported url: ' + url)
 
-        for chunk in res.iter_content(CHUNK_SIZE):
-            fp.write(chunk)
 
+def download_file(url, out_file):
+    """
+    Download url to out_file. If out_file exists, the download is resumed
+    from the end of the file (with a range request or ftp REST)
+    """
+    parsed_url = urlparse(url)
+    offset = 0
+    if os.path.exists(out_file):
+        offset = os.path.getsize(out_file)
+    # http
+    if parsed_url.scheme == "http" or parsed_url.scheme == 'https':
+        headers = {}
+        if offset:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        res = requests.get(url, stream=True, headers=headers,
+                           timeout=TIMEOUT)
+        # range not satisfiable - the file is already complete
+        if res.status_code == 416:
+            return out_file
+        if not res.ok:
+            raise IOError('{u}: {s}'.format(u=url, s=res.status_code))
+        # start from scratch if the server does not support ranges
+        if res.status_code == 206:
+            mode = 'ab'
+        else:
+            mode = 'wb'
+        with open(out_file, mode) as fp:
+            for chunk in res.iter_content(CHUNK_SIZE):
+                fp.write(chunk)
     # ftp
     elif parsed_url.scheme == "ftp":
-        download = urlopen(url)
-        file_size_dl = 0
-        block_sz = 8192
-        while True:
-            buffer = download.read(block_sz)
-            if not buffer:
-                break
-            file_size_dl += len(buffer)
-            fp.write(buffer)
-    # unzipping won't work if file isn't closed
-    fp.close()
-    # unzip the file to target folder, delete zip archive
+        ftp = ftp_connect(parsed_url)
+        with open(out_file, 'ab') as fp:
+            ftp.retrbinary('RETR ' + parsed_url.path, fp.write, CHUNK_SIZE,
+                           rest=offset or None)
+        ftp.quit()
+    else:
+        raise ValueError('Unsupported url: ' + url)
+    return out_file
+
+
+def cache_archive(url, cache_dir):
+    """
+    Download file at url to cache_dir, returning path to cached file and its
+    sha256 digest.
+
+    Files are stored by content (<sha256>.zip), with a <filename>.json
+    record of the url, the remote size/modification time and the digest.
+    If the remote file is unchanged since it was cached, nothing is
+    downloaded. Interrupted downloads are resumed on the next request (as
+    long as the remote file has not changed in the meantime).
+    """
+    cache_dir = make_sure_path_exists(cache_dir)
+    filename = os.path.split(urlparse(url).path)[1]
+    record_file = os.path.join(cache_dir, filename + '.json')
+    partial_file = os.path.join(cache_dir, filename + '.part')
+    info = remote_info(url)
+
+    record = None
+    if os.path.exists(record_file):
+        with open(record_file) as f:
+            record = json.load(f)
+        cached_file = os.path.join(cache_dir, record['sha256'] + '.zip')
+        if (record['url'] == url and record['remote'] == info and
+                os.path.exists(cached_file)):
+            log('{f}: unchanged, using cached {d}'.format(f=filename,
+                                                          d=record['sha256']))
+            return (cached_file, record['sha256'])
+
+    # only resume a partial download of the same remote file
+    partial_record = partial_file + '.json'
+    if os.path.exists(partial_file):
+        resume = False
+        if os.path.exists(partial_record):
+            with open(partial_record) as f:
+                resume = json.load(f) == {'url': url, 'remote': info}
+        if not resume:
+            os.unlink(partial_file)
+    with open(partial_record, 'w') as f:
+        json.dump({'url': url, 'remote': info}, f)
+
+    log('{f}: downloading'.format(f=filename))
+    download_file(url, partial_file)
+    if info['size'] and os.path.getsize(partial_file) != int(info['size']):
+        raise IOError('{f}: incomplete download, retry to resume'.format(
+            f=filename))
+
+    # move download to its place in the cache
+    digest = file_sha256(partial_file)
+    cached_file = os.path.join(cache_dir, digest + '.zip')
+    if os.path.exists(cached_file):
+        os.unlink(partial_file)
+    else:
+        os.rename(partial_file, cached_file)
+    os.unlink(partial_record)
+    # remove the superseded version of the file
+    if record and record['sha256'] != digest:
+        superseded = os.path.join(cache_dir, record['sha256'] + '.zip')
+        if os.path.exists(superseded):
+            os.unlink(superseded)
+    with open(record_file, 'w') as f:
+        json.dump({'url': url, 'remote': info, 'sha256': digest}, f)
+    return (cached_file, digest)
+
+
+def find_archive(filename, dl_path, cache_dir=None):
+    """
+    Return path to archive filename - either in dl_path or (if downloaded with
+    fwakit) in the cache. Returns None if the archive is not present.
+    """
+    if os.path.exists(os.path.join(dl_path, filename)):
+        return os.path.join(dl_path, filename)
+    if not cache_dir:
+        cache_dir = os.path.join(dl_path, 'cache')
+    record_file = os.path.join(cache_dir, filename + '.json')
+    if os.path.exists(record_file):
+        with open(record_file) as f:
+            record = json.load(f)
+        cached_file = os.path.join(cache_dir, record['sha256'] + '.zip')
+        if os.path.exists(cached_file):
+            return cached_file
+    return None
+
+
+def source_path(source_file, dl_path, zipped=False, cache_dir=None):
+    """
+    Return path for reading a source .gdb (with ogr) from dl_path.
+    If zipped, read the .gdb from within the archive via GDAL's /vsizip/
+    virtual file system - the archive does not need to be extracted.
+    Returns None if the source is not present.
+    """
+    gdb = os.path.splitext(source_file)[0]
+    if not zipped:
+        path = os.path.join(dl_path, gdb)
+        if os.path.exists(path):
+            return path
+        return None
+    archive = find_archive(source_file, dl_path, cache_dir=cache_dir)
+    if archive:
+        return '/vsizip/' + os.path.abspath(archive) + '/' + gdb
+    return None
+
+
+def download_and_unzip(url, unzip_dir, cache_dir=None):
+    """
+    Download and unzip a zipped folder from web or ftp.
+    Archives are cached (by default in unzip_dir/cache) and are only
+    downloaded/unzipped if they have changed since the last request.
+    """
+    if not cache_dir:
+        cache_dir = os.path.join(unzip_dir, 'cache')
+    parsed_url = urlparse(url)
+    filename = os.path.split(parsed_url.path)[1]
+    cached_file, digest = cache_archive(url, cache_dir)
+    # unzip the file to target folder, noting the digest of what was unzipped
     unzip_dir = make_sure_path_exists(unzip_dir)
-    zipped_file = zipfile.ZipFile(fp.name, 'r')
-    zipped_file.extractall(unzip_dir)
-    zipped_file.close()
-    os.unlink(fp.name)
-    return os.path.join(unzip_dir, os.path.split(parsed_url.path)[1])
+    marker = os.path.join(unzip_dir, '.' + filename + '.sha256')
+    unzipped = None
+    if os.path.exists(marker):
+        with open(marker) as f:
+            unzipped = f.read().strip()
+    if unzipped == digest:
+        log('{f}: unchanged, not unzipping'.format(f=filename))
+    else:
+        zipped_file = zipfile.ZipFile(cached_file, 'r')
+        zipped_file.extractall(unzip_dir)
+        zipped_file.close()
+        with open(marker, 'w') as f:
+            f.write(digest)
+    return os.path.join(unzip_dir, filename)
 
 
 def get_shortcuts():
@@ -289,6 +476,173 @@ def connect(db_url=None):
     return pgdata.connect(db_url)
 
 
+def get_db_url(db):
+    """Return the SQLAlchemy db url (including password) of a connection
+    """
+    url = db.engine.url
+    # sqlalchemy >= 1.4 masks the password when the url is a str
+    if hasattr(url, "render_as_string"):
+        return url.render_as_string(hide_password=False)
+    return str(url)
+
+
+def pg_connection_string(db_url):
+    """Convert a SQLAlchemy db url to an OGR PostgreSQL connection string
+    """
+    u = urlparse(db_url)
+    params = ["dbname=" + u.path[1:]]
+    if u.hostname:
+        params.append("host=" + u.hostname)
+    if u.port:
+        params.append("port=" + str(u.port))
+    if u.username:
+        params.append("user=" + u.username)
+    if u.password:
+        params.append("password=" + u.password)
+    return "PG:" + " ".join(params)
+
+
+def ogr2pg_append(in_file, in_layer, out_table, db_url=None, dim=3):
+    """
+    Append a layer to an existing table with ogr2ogr.
+    (pgdata's ogr2pg always overwrites the output, appending lets several
+    processes write to the same table without loading to staging tables)
+    """
+    if not db_url:
+        db_url = os.environ['FWA_DB']
+    command = ["ogr2ogr",
+               "--config", "PG_USE_COPY", "YES",
+               "-f", "PostgreSQL",
+               pg_connection_string(db_url),
+               "-append",
+               "-t_srs", "EPSG:3005",
+               "-dim", str(dim),
+               "-nlt", "PROMOTE_TO_MULTI",
+               "-nln", out_table,
+               in_file,
+               in_layer]
+    subprocess.check_call(command)
+
+
+def load_group(group, in_file, out_table, db_url=None, dim=3, engine='ogr'):
+    """
+    Append the layer for specified watershed group to out_table (with ogr2ogr
+    or binary COPY), returning the group and the time taken (seconds)
+    """
+    start_time = time.time()
+    if engine == 'copy':
+        db = pgdata.connect(db_url or os.environ['FWA_DB'], multiprocessing=True)
+        pgcopy.copy_layer(in_file, group, out_table, db, dim=dim, unlogged=False)
+    else:
+        ogr2pg_append(in_file, group, out_table, db_url=db_url, dim=dim)
+    elapsed = time.time() - start_time
+    log('{t}: loaded {g} in {s:.1f}s'.format(t=out_table, g=group, s=elapsed))
+    return (group, elapsed)
+
+
+def copy_text(value):
+    """Return value as a field of COPY text format (None as NULL)
+    """
+    if value is None:
+        return u"\\N"
+    return (u"{}".format(value).replace(u"\\", u"\\\\")
+                               .replace(u"\t", u"\\t")
+                               .replace(u"\n", u"\\n")
+                               .replace(u"\r", u"\\r"))
+
+
+def copy_rows(rows, table, columns, db, chunk_size=100000):
+    """
+    Append rows (tuples of values) to existing table with COPY (text
+    format), in chunks of chunk_size rows
+    """
+    copy_sql = "COPY {t} ({c}) FROM STDIN".format(t=table, c=", ".join(columns))
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+        buf = io.StringIO()
+        for i, row in enumerate(rows, 1):
+            buf.write(u"\t".join([copy_text(v) for v in row]) + u"\n")
+            if i % chunk_size == 0:
+                buf.seek(0)
+                cursor.copy_expert(copy_sql, buf)
+                buf = io.StringIO()
+        buf.seek(0)
+        cursor.copy_expert(copy_sql, buf)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def stream_query(sql, params=None, db=None, fetch_size=FETCH_SIZE,
+                 output="dict", dtype=None):
+    """
+    Generate results of sql from a named (server side) cursor, fetching
+    fetch_size rows at a time, so the full result is never held in memory.
+
+    output - "dict": yield each row as a dict
+             "numpy": yield a NumPy structured array of each fetch (with
+                      dtype if provided, otherwise the types are inferred
+                      from the values)
+             "arrow": yield a pyarrow RecordBatch of each fetch
+    """
+    if output not in ("dict", "numpy", "arrow"):
+        raise ValueError("Invalid output: %r" % output)
+    if not db:
+        db = connect()
+    conn = db.engine.raw_connection()
+    try:
+        cursor = conn.cursor(name="fwakit_stream")
+        cursor.execute(sql, params)
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                break
+            names = [c[0] for c in cursor.description]
+            if output == "dict":
+                for row in rows:
+                    yield dict(zip(names, row))
+            elif output == "numpy":
+                yield rows_to_numpy(rows, names, dtype)
+            else:
+                yield rows_to_arrow(rows, names)
+        cursor.close()
+    finally:
+        conn.close()
+
+
+def stream_table(table, db=None, fetch_size=FETCH_SIZE, output="dict"):
+    """Generate rows of table (as dicts, by default), see stream_query
+    """
+    return stream_query("SELECT * FROM {}".format(table), db=db,
+                        fetch_size=fetch_size, output=output)
+
+
+def rows_to_numpy(rows, names, dtype=None):
+    """Return rows (tuples of values) as a NumPy structured array
+    """
+    if dtype is not None:
+        return np.array([tuple(row) for row in rows], dtype=dtype)
+    columns = [np.array(c) for c in zip(*rows)]
+    result = np.empty(len(rows), dtype=[(name, column.dtype) for name, column
+                                        in zip(names, columns)])
+    for name, column in zip(names, columns):
+        result[name] = column
+    return result
+
+
+def rows_to_arrow(rows, names):
+    """Return rows (tuples of values) as a pyarrow RecordBatch
+    """
+    try:
+        import pyarrow
+    except ImportError:
+        raise ImportError("Arrow output requires pyarrow "
+                          "(pip install fwakit[arrow])")
+    return pyarrow.RecordBatch.from_arrays(
+        [pyarrow.array(c) for c in zip(*rows)], names=names)
+
+
 def load_queries():
     """ Load queries from module /sql folder to dict
     """
@@ -312,3 +666,35 @@ def execute_parallel_wsg(sql, wsg, db_url=None, n_subs=1):
     db.execute("SET max_parallel_workers_per_gather = 0")
     #db.execute(sql, wsg)
     db.execute(sql, (wsg,) * n_subs)
+
+
+def execute_parallel(sql, params, db_url=None):
+    """
+    Execute sql with supplied parameters using a non-pooled, non-parallel
+    conn, returning the parameters and the time taken (seconds)
+    """
+    if not db_url:
+        db_url = os.environ['FWA_DB']
+    start_time = time.time()
+    db = pgdata.connect(db_url, multiprocessing=True)
+    # Turn off parallel execution for this session (in the same transaction,
+    # the connection is not pooled), we are handling the parallelization
+    db.execute("SET max_parallel_workers_per_gather = 0;\n" + sql, params)
+    return (params, time.time() - start_time)
+
+
+def create_index_parallel(sql, db_url=None, maintenance_work_mem=None):
+    """
+    Execute CREATE INDEX statement using a non-pooled, non-parallel conn,
+    returning the statement and the time taken (seconds)
+    """
+    if not db_url:
+        db_url = os.environ['FWA_DB']
+    start_time = time.time()
+    db = pgdata.connect(db_url, multiprocessing=True)
+    setup = ["SET max_parallel_maintenance_workers = 0"]
+    if maintenance_work_mem:
+        setup.append("SET maintenance_work_mem = '{}'".format(maintenance_work_mem))
+    # settings only apply to the session, run them in the same transaction
+    db.execute(";\n".join(setup + [sql]))
+    return (sql, time.time() - start_time)
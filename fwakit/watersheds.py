@@ -108,7 +108,8 @@ def points_to_watersheds(ref_table, ref_id, out_table, dissolve=False, db=None):
         db[out_table].create_index_geom()
 
 
-def points_to_prelim_watersheds(ref_table, ref_id, out_table, dissolve=False, db=None):
+def points_to_prelim_watersheds(ref_table, ref_id, out_table, dissolve=False,
+                                intervals=False, db=None):
     log(
         "Creating %s, first order watersheds upstream of locations in %s"
         % (out_table, ref_table)
@@ -123,19 +124,31 @@ def points_to_prelim_watersheds(ref_table, ref_id, out_table, dissolve=False, db
     # Nested subquery performance was not good either, so lets create a temporary
     # table of prelim upstream watersheds (noting lakes and reservoirs) and then do
     # any required additions afterwards
-    sql = """
-        CREATE TEMPORARY TABLE temp_prelim_wsds AS
-        SELECT
-          pt.{pk},
-          wsd.watershed_feature_id,
-          wsd.waterbody_key,
-    -- note components of lakes and reservoirs
-          CASE
-            WHEN l.waterbody_key IS NOT NULL OR wb.waterbody_key IS NOT NULL
-            THEN 'wb'
-          END AS waterbody_ind,
-          ST_Multi(ST_Force2D(wsd.geom)) as geom
-        FROM {ref_table} pt
+
+    # find upstream watersheds with ltree comparisons, or with the interval
+    # columns (see fwa.add_intervals) if requested
+    if intervals:
+        upstream_join = """
+        INNER JOIN {lookup} pt_ws ON pt.wscode_ltree = pt_ws.code
+        INNER JOIN {lookup} pt_local ON pt.localcode_ltree = pt_local.code
+        INNER JOIN whse_basemapping.fwa_watersheds_poly_sp wsd
+        ON
+          -- b is a child of a, always
+          wsd.wscode_left BETWEEN pt_ws.lft AND pt_ws.rgt
+          -- don't include the bottom watershed
+        AND wsd.localcode_left != pt_local.lft
+        AND
+          (
+    -- simple case - wscode and localcode are equivalent
+            pt_ws.lft = pt_local.lft
+    -- tributaries: after the interval of the localcode of the point
+            OR wsd.wscode_left > pt_local.rgt
+    -- side channels: same watershed code, with larger localcode
+            OR (wsd.wscode_left = pt_ws.lft AND
+                wsd.localcode_left >= pt_local.lft)
+          )""".format(lookup=fwa.INTERVAL_LOOKUP)
+    else:
+        upstream_join = """
         INNER JOIN whse_basemapping.fwa_watersheds_poly_sp wsd
         ON
           -- b is a child of a, always
@@ -162,13 +175,26 @@ def points_to_prelim_watersheds(ref_table, ref_id, out_table, dissolve=False, db
                      AND wsd.localcode_ltree >= pt.localcode_ltree)
                 )
               THEN TRUE
-          END
+          END"""
+    sql = """
+        CREATE TEMPORARY TABLE temp_prelim_wsds AS
+        SELECT
+          pt.{pk},
+          wsd.watershed_feature_id,
+          wsd.waterbody_key,
+    -- note components of lakes and reservoirs
+          CASE
+            WHEN l.waterbody_key IS NOT NULL OR wb.waterbody_key IS NOT NULL
+            THEN 'wb'
+          END AS waterbody_ind,
+          ST_Multi(ST_Force2D(wsd.geom)) as geom
+        FROM {ref_table} pt{upstream_join}
         LEFT OUTER JOIN whse_basemapping.fwa_lakes_poly l
         ON wsd.waterbody_key = l.waterbody_key
         LEFT OUTER JOIN whse_basemapping.fwa_manmade_waterbodies_poly wb
         ON wsd.waterbody_key = wb.waterbody_key
     """.format(
-        ref_table=ref_table, pk=ref_id
+        ref_table=ref_table, pk=ref_id, upstream_join=upstream_join
     )
     db.execute(sql)
     # The above prelim query selects all watershed polygons with watershed codes
@@ -342,7 +368,7 @@ def add_local_watersheds(ref_table, ref_id, prelim_wsd_table, db=None):
         ref_id=ref_id, ref_table=ref_table
     )
     db.execute(sql)
-    for fwa_point_event in db[ref_table]:
+    for fwa_point_event in fwa.util.stream_table(ref_table, db=db):
         ref_id_value = fwa_point_event[ref_id]
         refine_method = get_refine_method(fwa_point_event)
 
@@ -611,7 +637,7 @@ def add_ex_bc(point_table, ref_table, ref_id, out_table, db=None):
         db = fwa.util.connect()
 
     # first, process points already loaded to reference table (in BC)
-    for fwa_point_event in db[ref_table]:
+    for fwa_point_event in fwa.util.stream_table(ref_table, db=db):
         ref_id_value = fwa_point_event[ref_id]
 
         # Do areas outside of BC contribute to the point (not including Alaska)
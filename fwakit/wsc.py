@@ -0,0 +1,171 @@
+"""
+Watershed codes as fixed width integer arrays, for bulk comparison with NumPy
+  - a code is encoded as LEVELS integers, one per level (the first level is
+    3 digits, the rest 6), padded with zeros. Missing codes are -1.
+  - padded codes sort in the same order as the ltree codes, and a code is
+    within another (ltree <@) when it matches the levels of the other up to
+    the other's depth
+  - predicates compare arrays along the last axis and broadcast, so they
+    classify aligned pairs of codes or, with matrix(), all pairs of two sets
+
+upstream() matches the SQL function fwa_upstreamwsc.
+
+eg:
+
+    wscode = wsc.encode(fwa_watershed_codes)
+    localcode = wsc.encode(local_watershed_codes)
+    wsc.upstream(wscode[a], localcode[a], wscode[b], localcode[b])
+    wsc.matrix(wsc.upstream, wscode, localcode)
+"""
+
+from __future__ import absolute_import
+
+import re
+
+import numpy as np
+
+
+LEVELS = 21
+
+# width of padded text code, eg 100-190442-244975-...
+CODE_WIDTH = 3 + (LEVELS - 1) * 7
+
+DTYPE = np.int32
+
+
+def encode(codes):
+    """
+    Return (n, LEVELS) array of watershed codes, provided as padded codes
+    (100-190442-000000-...) or trimmed/ltree codes (100-190442, 100.190442).
+    None or empty codes are encoded as -1.
+    """
+    codes = list(codes)
+    n = len(codes)
+    result = np.zeros((n, LEVELS), dtype=DTYPE)
+    # fast path for codes in the padded form used in the source data
+    if n and all([c is not None and len(c) == CODE_WIDTH for c in codes]):
+        chars = np.frombuffer(
+            "".join(codes).encode("ascii"), dtype=np.uint8).reshape(
+                n, CODE_WIDTH).astype(DTYPE) - ord("0")
+        result[:, 0] = chars[:, :3].dot([100, 10, 1])
+        levels = chars[:, 3:].reshape(n, LEVELS - 1, 7)[:, :, 1:]
+        result[:, 1:] = levels.dot([100000, 10000, 1000, 100, 10, 1])
+        return result
+    for i, code in enumerate(codes):
+        if not code:
+            result[i] = -1
+            continue
+        levels = [int(level) for level in re.split(r"[-.]", code)]
+        result[i, :len(levels)] = levels
+    return result
+
+
+def decode(codes):
+    """Return trimmed text codes (100-190442) for code arrays
+    """
+    result = []
+    for code in np.atleast_2d(codes):
+        if code[0] < 0:
+            result.append(None)
+            continue
+        levels = ["{:03d}".format(code[0])]
+        levels.extend(["{:06d}".format(level)
+                       for level in code[1:depth(code)]])
+        result.append("-".join(levels))
+    return result
+
+
+def depth(codes):
+    """Return number of levels in codes, ignoring trailing zeros
+    """
+    codes = np.asarray(codes)
+    nonzero = codes[..., ::-1] != 0
+    return np.where(nonzero.any(axis=-1),
+                    codes.shape[-1] - np.argmax(nonzero, axis=-1), 0)
+
+
+def missing(codes):
+    """Return True where codes are missing
+    """
+    return np.asarray(codes)[..., 0] < 0
+
+
+def equal(a, b):
+    """Return True where codes a and b are equal
+    """
+    return (np.asarray(a) == np.asarray(b)).all(axis=-1)
+
+
+def within(b, a):
+    """Return True where code b is code a or a descendant of a (ltree b <@ a)
+    """
+    a = np.asarray(a)
+    b = np.asarray(b)
+    levels = np.arange(a.shape[-1])
+    return ((a == b) | (levels >= depth(a)[..., None])).all(axis=-1)
+
+
+def greater(b, a):
+    """Return True where code b sorts after code a (ltree b > a)
+    """
+    a, b = np.broadcast_arrays(np.asarray(a), np.asarray(b))
+    diff = a != b
+    first = np.argmax(diff, axis=-1)[..., None]
+    return (diff.any(axis=-1) &
+            (np.take_along_axis(b, first, axis=-1) >
+             np.take_along_axis(a, first, axis=-1))[..., 0])
+
+
+def upstream(wscode_a, localcode_a, wscode_b, localcode_b):
+    """
+    Return True where codes b are upstream of (or equivalent to) codes a,
+    as fwa_upstreamwsc. False where any of the codes are missing.
+    """
+    wscode_a = np.asarray(wscode_a)
+    localcode_a = np.asarray(localcode_a)
+    wscode_b = np.asarray(wscode_b)
+    localcode_b = np.asarray(localcode_b)
+    simple = equal(wscode_a, localcode_a)
+    # tributaries, watershed code of b is above local code of a
+    tributary = (greater(wscode_b, localcode_a) &
+                 ~within(wscode_b, localcode_a))
+    # side channels, higher up on the same stream
+    side_channel = (equal(wscode_b, wscode_a) &
+                    ~greater(localcode_a, localcode_b))
+    result = within(wscode_b, wscode_a) & (simple | tributary | side_channel)
+    return result & ~(missing(wscode_a) | missing(localcode_a) |
+                      missing(wscode_b) | missing(localcode_b))
+
+
+def downstream(wscode_a, localcode_a, wscode_b, localcode_b):
+    """Return True where codes b are downstream of (or equivalent to) codes a
+    """
+    return upstream(wscode_b, localcode_b, wscode_a, localcode_a)
+
+
+def equivalent(wscode_a, localcode_a, wscode_b, localcode_b):
+    """Return True where watershed and local codes of a and b are both equal
+    """
+    return (equal(wscode_a, wscode_b) & equal(localcode_a, localcode_b) &
+            ~missing(wscode_a) & ~missing(localcode_a))
+
+
+def matrix(predicate, wscode_a, localcode_a, wscode_b=None, localcode_b=None,
+           chunk_size=1000):
+    """
+    Return (n, m) matrix of predicate for all pairs of n codes a and m codes
+    b (all pairs within a if b is not provided), eg matrix(upstream, ...)[i, j]
+    is True where b[j] is upstream of a[i]. Rows are processed chunk_size at
+    a time to limit memory use.
+    """
+    if wscode_b is None:
+        wscode_b, localcode_b = wscode_a, localcode_a
+    wscode_b = np.asarray(wscode_b)[None, :, :]
+    localcode_b = np.asarray(localcode_b)[None, :, :]
+    result = np.zeros((len(wscode_a), wscode_b.shape[1]), dtype=bool)
+    for start in range(0, len(wscode_a), chunk_size):
+        rows = slice(start, start + chunk_size)
+        result[rows] = predicate(np.asarray(wscode_a[rows])[:, None, :],
+                                 np.asarray(localcode_a[rows])[:, None, :],
+                                 wscode_b, localcode_b)
+    return result
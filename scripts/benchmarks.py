@@ -0,0 +1,319 @@
+# Benchmarks comparing alternative fwakit implementations on the same data
+# Run against a loaded FWA database (FWA_DB), eg:
+#   python scripts/benchmarks.py load -f fwakit_downloads/FWA_STREAM_NETWORKS_SP.gdb -l SALM
+
+from __future__ import absolute_import
+import time
+
+import click
+
+import fwakit as fwa
+from fwakit import pgcopy
+from fwakit import reference as offline
+
+
+# fwa_upstreamwsc as it was before being made inlinable, for comparison
+UPSTREAMWSC_NOINLINE = """
+CREATE OR REPLACE FUNCTION public.benchmark_upstreamwsc(
+    wscode_ltree_a ltree,
+    localcode_ltree_a ltree,
+    wscode_ltree_b ltree,
+    localcode_ltree_b ltree
+)
+RETURNS boolean AS $$
+SELECT true
+WHERE
+    (wscode_ltree_a = localcode_ltree_a AND
+    wscode_ltree_b <@ wscode_ltree_a)
+  OR
+    (
+      wscode_ltree_a != localcode_ltree_a
+      AND
+      wscode_ltree_b <@ wscode_ltree_a
+      AND
+      (
+          (wscode_ltree_b > localcode_ltree_a AND NOT
+           wscode_ltree_b <@ localcode_ltree_a)
+          OR
+          (wscode_ltree_b = wscode_ltree_a AND
+          localcode_ltree_b >= localcode_ltree_a)
+      )
+  )
+$$
+language 'sql' immutable parallel safe
+"""
+
+# count of streams upstream of a random sample of stream segments
+UPSTREAM_JOIN = """
+SELECT a.linear_feature_id, count(*)
+FROM (SELECT linear_feature_id, wscode_ltree, localcode_ltree
+      FROM whse_basemapping.fwa_stream_networks_sp
+      WHERE wscode_ltree IS NOT NULL
+      ORDER BY md5(linear_feature_id::text)
+      LIMIT %s) a
+INNER JOIN whse_basemapping.fwa_stream_networks_sp b
+ON {function}(a.wscode_ltree, a.localcode_ltree,
+              b.wscode_ltree, b.localcode_ltree)
+GROUP BY a.linear_feature_id
+"""
+
+# count of streams upstream of a random sample of stream segments, using
+# integer array codes
+UPSTREAM_JOIN_ARRAY = """
+SELECT a.linear_feature_id, count(*)
+FROM (SELECT linear_feature_id, wscode_array, localcode_array
+      FROM whse_basemapping.fwa_stream_networks_sp
+      WHERE wscode_ltree IS NOT NULL
+      ORDER BY md5(linear_feature_id::text)
+      LIMIT %s) a
+INNER JOIN whse_basemapping.fwa_stream_networks_sp b
+ON fwa_upstreamwsc_array(a.wscode_array, a.localcode_array,
+                         b.wscode_array, b.localcode_array)
+GROUP BY a.linear_feature_id
+"""
+
+# length function at midpoints of a random sample of stream segments
+SAMPLE_LENGTHS = """
+SELECT linear_feature_id,
+       round({function}(blue_line_key,
+                        downstream_route_measure + (length_metre / 2))::numeric, 2)
+FROM whse_basemapping.fwa_stream_networks_sp
+WHERE localcode_ltree IS NOT NULL
+ORDER BY md5(linear_feature_id::text)
+LIMIT %s
+"""
+
+# total size of the values in a column
+COLUMN_SIZE = "SELECT SUM(pg_column_size({c})) FROM {t}"
+
+# candidate streams for each point, as reference_points.sql selected them
+# before the search was bounded by the threshold, and as it does now
+CANDIDATES_KNN = """
+SELECT pt.{point_id}, nn.linear_feature_id, nn.distance_to_stream
+FROM {point_table} pt
+CROSS JOIN LATERAL
+  (SELECT str.linear_feature_id,
+          ST_Distance(str.geom, pt.geom) as distance_to_stream
+   FROM whse_basemapping.fwa_stream_networks_sp AS str
+   WHERE str.localcode_ltree IS NOT NULL
+   AND NOT str.wscode_ltree <@ '999'
+   ORDER BY str.geom <-> pt.geom
+   LIMIT 100) as nn
+WHERE nn.distance_to_stream < %(threshold)s
+"""
+
+CANDIDATES_DWITHIN = """
+SELECT pt.{point_id}, nn.linear_feature_id, nn.distance_to_stream
+FROM {point_table} pt
+CROSS JOIN LATERAL
+  (SELECT *
+   FROM
+    (SELECT str.linear_feature_id,
+            ST_Distance(str.geom, pt.geom) as distance_to_stream
+     FROM whse_basemapping.fwa_stream_networks_sp AS str
+     WHERE ST_DWithin(str.geom, pt.geom, %(threshold)s)
+     AND str.localcode_ltree IS NOT NULL
+     AND NOT str.wscode_ltree <@ '999'
+     OFFSET 0) AS within
+   ORDER BY distance_to_stream
+   LIMIT 100) as nn
+WHERE nn.distance_to_stream < %(threshold)s
+"""
+
+def report(name, elapsed, n):
+    click.echo('{name}: {s:.2f}s ({r:.0f} per second)'.format(
+        name=name, s=elapsed, r=n / elapsed if elapsed else 0))
+
+
+@click.group()
+def cli():
+    pass
+
+
+@cli.command()
+@click.option('--in_file', '-f', required=True, help='Source file (eg .gdb)')
+@click.option('--in_layer', '-l', required=True, help='Layer to load')
+@click.option('--db_url', '-db', envvar='FWA_DB', help='Database to load to')
+def load(in_file, in_layer, db_url):
+    """Compare ogr2ogr loader with binary COPY loader
+
+    ogr2pg writes a logged table and builds a spatial index on it, the
+    COPY loader is timed with the same logging and indexing for comparison.
+    Loading with COPY to an unlogged table (as load does for groups that
+    are combined or attached after loading) is reported separately.
+    """
+    db = fwa.util.connect(db_url)
+    tables = ['public.benchmark_ogr', 'public.benchmark_copy',
+              'public.benchmark_copy_unlogged']
+    for table in tables:
+        db[table].drop()
+
+    start_time = time.time()
+    db.ogr2pg(in_file, in_layer=in_layer, out_layer='benchmark_ogr',
+              schema='public', dim=3)
+    elapsed = time.time() - start_time
+    n = db.query_one('SELECT count(*) FROM public.benchmark_ogr')[0]
+    report('ogr2pg (logged, spatial index)', elapsed, n)
+
+    start_time = time.time()
+    n = pgcopy.copy_layer(in_file, in_layer, 'public.benchmark_copy', db,
+                          dim=3, unlogged=False)
+    db.execute('CREATE INDEX ON public.benchmark_copy USING gist (geom)')
+    report('copy (logged, spatial index)', time.time() - start_time, n)
+
+    start_time = time.time()
+    n = pgcopy.copy_layer(in_file, in_layer, 'public.benchmark_copy_unlogged',
+                          db, dim=3)
+    report('copy (unlogged, no index)', time.time() - start_time, n)
+
+    for table in tables:
+        db[table].drop()
+
+
+@cli.command()
+@click.option('--db_url', '-db', envvar='FWA_DB', help='Database to query')
+@click.option('--n_points', '-n', default=100, help='Number of points to join')
+def upstreamwsc(db_url, n_points):
+    """Compare inlinable fwa_upstreamwsc with the previous version
+
+    Joins a sample of stream segments to all streams upstream
+    """
+    db = fwa.util.connect(db_url)
+    db.execute(fwa.queries['fwa_upstreamwsc'])
+    db.execute(UPSTREAMWSC_NOINLINE)
+    results = {}
+    for function in ['public.benchmark_upstreamwsc', 'fwa_upstreamwsc']:
+        start_time = time.time()
+        results[function] = sorted(db.query(
+            UPSTREAM_JOIN.format(function=function), (n_points,)).fetchall())
+        report(function, time.time() - start_time, n_points)
+    if results['public.benchmark_upstreamwsc'] != results['fwa_upstreamwsc']:
+        click.echo('Results differ')
+    db.execute('DROP FUNCTION public.benchmark_upstreamwsc(ltree, ltree, ltree, ltree)')
+
+
+@cli.command()
+@click.option('--db_url', '-db', envvar='FWA_DB', help='Database to query')
+@click.option('--n_points', '-n', default=100,
+              help='Number of locations to query')
+def wsc_array(db_url, n_points):
+    """Compare integer array watershed codes with ltree
+
+    Reports size of the code columns, time to build and size of their indexes
+    (btree and gist for ltree, btree for arrays) and the time taken by the
+    upstream join and length functions using each. Streams must have
+    integer array codes (fwakit wsc_arrays).
+    """
+    db = fwa.util.connect(db_url)
+    table = 'whse_basemapping.fwa_stream_networks_sp'
+    if 'wscode_array' not in db[table].columns:
+        raise click.ClickException('Streams have no integer array codes, '
+                                   'run fwakit wsc_arrays first')
+    for function in ['fwa_upstreamwsc', 'fwa_upstreamwsc_array',
+                     'fwa_lengthupstream', 'fwa_lengthupstream_array',
+                     'fwa_lengthdownstream', 'fwa_lengthdownstream_array']:
+        db.execute(fwa.queries[function])
+
+    # size of values and indexes, index build times
+    columns = [('wscode_ltree', ['btree', 'gist']),
+               ('localcode_ltree', ['btree', 'gist']),
+               ('wscode_array', ['btree']),
+               ('localcode_array', ['btree'])]
+    for column, index_types in columns:
+        size = db.query_one(COLUMN_SIZE.format(c=column, t=table))[0]
+        click.echo('{c}: {mb:.1f}MB'.format(c=column, mb=size / 1048576.0))
+        for index_type in index_types:
+            index = 'whse_basemapping.benchmark_{c}_{i}'.format(c=column,
+                                                                 i=index_type)
+            db.execute('DROP INDEX IF EXISTS {i}'.format(i=index))
+            start_time = time.time()
+            db.execute('CREATE INDEX {n} ON {t} USING {it} ({c})'.format(
+                n=index.split('.')[1], t=table, it=index_type, c=column))
+            elapsed = time.time() - start_time
+            # partitioned tables have an index on each partition
+            size = db.query_one("""SELECT COALESCE(SUM(pg_relation_size(i.oid)), 0)
+                                   FROM pg_class i
+                                   WHERE i.oid = to_regclass(%s)
+                                   OR i.oid IN (SELECT inhrelid FROM pg_inherits
+                                                WHERE inhparent = to_regclass(%s))
+                                """, (index, index))[0]
+            click.echo('  {it} index: built in {s:.2f}s, {mb:.1f}MB'.format(
+                it=index_type, s=elapsed, mb=size / 1048576.0))
+            db.execute('DROP INDEX {i}'.format(i=index))
+
+    # query latency
+    results = {}
+    for name, sql in [('ltree upstream join', UPSTREAM_JOIN.format(
+                           function='fwa_upstreamwsc')),
+                      ('array upstream join', UPSTREAM_JOIN_ARRAY)]:
+        start_time = time.time()
+        results[name] = sorted(db.query(sql, (n_points,)).fetchall())
+        report(name, time.time() - start_time, n_points)
+    if results['ltree upstream join'] != results['array upstream join']:
+        click.echo('Upstream join results differ')
+    for function in ['fwa_lengthupstream', 'fwa_lengthdownstream']:
+        for suffix in ['', '_array']:
+            start_time = time.time()
+            results[function + suffix] = sorted(db.query(
+                SAMPLE_LENGTHS.format(function=function + suffix),
+                (n_points,)).fetchall())
+            report(function + suffix, time.time() - start_time, n_points)
+        if results[function] != results[function + '_array']:
+            click.echo(function + ' results differ')
+
+
+@cli.command()
+@click.option('--db_url', '-db', envvar='FWA_DB', help='Database to query')
+@click.option('--in_file', '-f', default='tests/data/pscis.shp',
+              help='Points to load (if point table does not exist)')
+@click.option('--point_table', '-t', default='whse_fish.pscis',
+              help='Point table to reference')
+@click.option('--point_id', '-id', default='pt_id', help='Point id column')
+@click.option('--thresholds', '-th', default='10,100,300',
+              help='Comma separated list of distances to test (m)')
+def reference(db_url, in_file, point_table, point_id, thresholds):
+    """
+    Compare KNN and threshold bounded stream search for reference_points,
+    and referencing in memory with fwakit.reference
+    """
+    db = fwa.util.connect(db_url)
+    if point_table not in db.tables:
+        schema, table = db.parse_table_name(point_table)
+        db.execute('CREATE SCHEMA IF NOT EXISTS ' + schema)
+        db.ogr2pg(in_file, out_layer=table, schema=schema)
+    n = db.query_one('SELECT count(*) FROM ' + point_table)[0]
+    start_time = time.time()
+    streams = offline.StreamIndex.from_db(db=db)
+    click.echo('StreamIndex.from_db: {s:.2f}s'.format(s=time.time() - start_time))
+    x, y = zip(*db.query('SELECT ST_X(geom), ST_Y(geom) FROM ' +
+                         point_table).fetchall())
+    for threshold in [float(t) for t in thresholds.split(',')]:
+        results = {}
+        for name, sql in [('knn', CANDIDATES_KNN),
+                          ('dwithin', CANDIDATES_DWITHIN)]:
+            start_time = time.time()
+            results[name] = sorted(db.query(
+                sql.format(point_table=point_table, point_id=point_id),
+                {'threshold': threshold}).fetchall())
+            report('{t:.0f}m {n}'.format(t=threshold, n=name),
+                   time.time() - start_time, n)
+        if results['knn'] != results['dwithin']:
+            click.echo('{t:.0f}m: candidates differ'.format(t=threshold))
+        start_time = time.time()
+        fwa.reference_points(point_table, point_id,
+                             'public.benchmark_reference', threshold,
+                             closest=True, db=db)
+        report('{t:.0f}m reference_points (closest)'.format(t=threshold),
+               time.time() - start_time, n)
+        start_time = time.time()
+        events = streams.snap(x, y, threshold, closest=True)
+        report('{t:.0f}m StreamIndex.snap (closest)'.format(t=threshold),
+               time.time() - start_time, n)
+        if len(events) != db.query_one(
+                'SELECT count(*) FROM public.benchmark_reference')[0]:
+            click.echo('{t:.0f}m: StreamIndex matches differ'.format(t=threshold))
+    db['public.benchmark_reference'].drop()
+
+
+if __name__ == '__main__':
+    cli()
@@ -41,7 +41,8 @@ setup(name='fwakit',
       zip_safe=False,
       install_requires=read('requirements.txt').splitlines(),
       extras_require={
-        'test': ['pytest', 'coverage']},
+        'test': ['pytest', 'coverage'],
+        'arrow': ['pyarrow']},
       entry_points="""
       [console_scripts]
       fwakit=fwakit.cli:cli
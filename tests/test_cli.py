@@ -59,6 +59,17 @@ def test_load_simple():
     assert SIMPLE_LAYER in db.tables_in_schema('whse_basemapping')
 
 
+def test_load_simple_zipped():
+    runner = CliRunner()
+    db = fwa.util.connect(DB_URL)
+    db['whse_basemapping.' + SIMPLE_LAYER].drop()
+    runner.invoke(cli, ['load', '-l', SIMPLE_LAYER,
+                                '-p', DL_PATH,
+                                '-db', DB_URL,
+                                '--zipped'])
+    assert SIMPLE_LAYER in db.tables_in_schema('whse_basemapping')
+
+
 def test_load_streams():
     runner = CliRunner()
     runner.invoke(cli, ['load', '-l', 'fwa_stream_networks_sp',
@@ -69,6 +80,81 @@ def test_load_streams():
     assert 'fwa_stream_networks_sp' in db.tables_in_schema('whse_basemapping')
 
 
+def test_load_streams_partitioned():
+    runner = CliRunner()
+    runner.invoke(cli, ['load', '-l', 'fwa_stream_networks_sp',
+                                '-p', DL_PATH,
+                                '-db', DB_URL,
+                                '-g', GROUP,
+                                '--partition'])
+    db = fwa.util.connect(DB_URL)
+    table = 'whse_basemapping.fwa_stream_networks_sp'
+    assert fwa.is_partitioned(table, db=db)
+    assert fwa.list_partitions(table, db=db) == [(table + '_salm', GROUP)]
+
+
+def test_reload_cleaned_partition():
+    runner = CliRunner()
+    db = fwa.util.connect(DB_URL)
+    table = 'whse_basemapping.fwa_stream_networks_sp'
+    result = runner.invoke(cli, ['clean', '-l', GROUPED_LAYER, '-db', DB_URL])
+    assert result.exit_code == 0
+    n = db.query('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+    # intervals are added to the parent only, reloads must add them
+    result = runner.invoke(cli, ['intervals', '-db', DB_URL])
+    assert result.exit_code == 0
+    # reload the group into the cleaned table, twice
+    for i in range(2):
+        result = runner.invoke(cli, ['load', '-l', GROUPED_LAYER,
+                                             '-p', DL_PATH,
+                                             '-db', DB_URL,
+                                             '-g', GROUP,
+                                             '--partition'])
+        assert result.exit_code == 0
+        assert fwa.list_partitions(table, db=db) == [(table + '_salm', GROUP)]
+        assert 'wscode_ltree' in db[table].columns
+        assert db.query('SELECT COUNT(*) FROM ' + table).fetchone()[0] == n
+        r = db.query("""SELECT COUNT(*) FROM {t}
+                        WHERE wscode_ltree IS NOT NULL
+                        AND wscode_left IS NULL""".format(t=table))
+        assert r.fetchone()[0] == 0
+
+
+def test_load_streams_parallel():
+    # the test data holds a single group, list it twice so that the second
+    # is appended by the worker pool
+    runner = CliRunner()
+    db = fwa.util.connect(DB_URL)
+    table = 'whse_basemapping.fwa_stream_networks_sp'
+    sql = """SELECT watershed_group_code, COUNT(*) FROM {t}
+             GROUP BY watershed_group_code
+             ORDER BY watershed_group_code""".format(t=table)
+    counts = []
+    for jobs in ['1', '2']:
+        result = runner.invoke(cli, ['load', '-l', 'fwa_stream_networks_sp',
+                                             '-p', DL_PATH,
+                                             '-db', DB_URL,
+                                             '-g', GROUP + ',' + GROUP,
+                                             '-j', jobs])
+        assert result.exit_code == 0
+        assert 'fwa_stream_networks_sp_salm' not in db.tables_in_schema('whse_basemapping')
+        counts.append(db.query(sql).fetchall())
+    assert counts[0] == counts[1]
+    assert [c[0] for c in counts[1]] == [GROUP]
+
+
+def test_load_streams_copy():
+    runner = CliRunner()
+    runner.invoke(cli, ['load', '-l', 'fwa_stream_networks_sp',
+                                '-p', DL_PATH,
+                                '-db', DB_URL,
+                                '-g', GROUP,
+                                '--engine', 'copy'])
+    db = fwa.util.connect(DB_URL)
+    assert 'fwa_stream_networks_sp' in db.tables_in_schema('whse_basemapping')
+    assert 'linear_feature_id' in db['whse_basemapping.fwa_stream_networks_sp'].columns
+
+
 def test_load_watersheds():
     runner = CliRunner()
     runner.invoke(cli, ['load', '-l', 'fwa_watersheds_poly_sp',
@@ -91,3 +177,48 @@ def test_clean():
     assert 'objectid' not in db['whse_basemapping.fwa_watersheds_poly_sp'].columns
     assert 'wscode_ltree' in db['whse_basemapping.fwa_watersheds_poly_sp'].columns
     assert 'fwa_watershed_groups_subdivided' in db.tables_in_schema('whse_basemapping')
+    r = db.query("""SELECT b.upstream_route_measure = s.upstream_route_measure
+                    FROM whse_basemapping.fwa_blue_lines b
+                    INNER JOIN (SELECT blue_line_key,
+                                       max(upstream_route_measure) AS upstream_route_measure
+                                FROM whse_basemapping.fwa_stream_networks_sp
+                                WHERE blue_line_key = 354141556
+                                GROUP BY blue_line_key) s
+                    ON b.blue_line_key = s.blue_line_key""").fetchone()
+    assert r[0] is True
+
+
+def test_populate_gradient():
+    runner = CliRunner()
+    db = fwa.util.connect(DB_URL)
+    db.execute('UPDATE whse_basemapping.fwa_stream_networks_sp SET gradient = NULL')
+    runner.invoke(cli, ['populate_gradient', '-db', DB_URL, '-j', '2', '-b', '100000'])
+    r = db.query("""SELECT COUNT(*)
+                    FROM whse_basemapping.fwa_stream_networks_sp
+                    WHERE gradient IS NOT NULL""").fetchone()
+    assert r[0] > 0
+
+
+def test_sync():
+    runner = CliRunner()
+    db = fwa.util.connect(DB_URL)
+    table = 'whse_basemapping.fwa_stream_networks_sp'
+    n = db.query('SELECT COUNT(*) FROM '+table).fetchone()[0]
+    # remove a feature and modify another, sync should restore both
+    ids = [r[0] for r in db.query("""SELECT linear_feature_id FROM {t}
+                                     ORDER BY linear_feature_id
+                                     LIMIT 2""".format(t=table))]
+    db.execute('DELETE FROM {t} WHERE linear_feature_id = %s'.format(t=table),
+               (ids[0],))
+    db.execute("""UPDATE {t} SET gnis_name = 'Sync Test Creek'
+                  WHERE linear_feature_id = %s""".format(t=table), (ids[1],))
+    result = runner.invoke(cli, ['sync', '-l', GROUPED_LAYER,
+                                         '-p', DL_PATH,
+                                         '-db', DB_URL,
+                                         '-g', GROUP])
+    assert '1 inserted, 1 updated, 0 deleted' in result.output
+    assert db.query('SELECT COUNT(*) FROM '+table).fetchone()[0] == n
+    r = db.query("""SELECT COUNT(*) FROM {t}
+                    WHERE gnis_name = 'Sync Test Creek'""".format(t=table))
+    assert r.fetchone()[0] == 0
+    assert 'fwa_stream_networks_sp_sync' not in db.tables_in_schema('whse_basemapping')
@@ -1,6 +1,9 @@
 import os
 
+from click.testing import CliRunner
+
 import fwakit as fwa
+from fwakit.cli import cli
 
 DB_URL = os.environ['FWA_DB_TEST']
 # test downstream distance at various locations
@@ -99,3 +102,172 @@ def test_instr_diffblueline():
     r = db.query(instr_query,
                  (blkey_a, measure_a, blkey_b, measure_b)).fetchone()
     assert round(r[0], 2) == 6109.81
+
+
+def test_upstr_intervals():
+    db = fwa.util.connect(DB_URL)
+    fwa.add_intervals(db=db)
+    db.execute(fwa.queries['fwa_lengthupstream_interval'])
+    for blkey, measure in [(354141556, 0), (354141556, 1400), (354148866, 2800)]:
+        r = db.query(upstr_query, (blkey, measure)).fetchone()
+        r_interval = db.query("SELECT fwa_lengthupstream_interval(%s, %s)",
+                              (blkey, measure)).fetchone()
+        assert round(r[0], 2) == round(r_interval[0], 2)
+
+
+def test_lengths_wsc_arrays():
+    db = fwa.util.connect(DB_URL)
+    fwa.add_wsc_arrays('whse_basemapping.fwa_stream_networks_sp', db=db)
+    db.execute(fwa.queries['fwa_lengthupstream_array'])
+    db.execute(fwa.queries['fwa_lengthdownstream_array'])
+    for blkey, measure in [(354141556, 1400), (354148866, 2800),
+                           (354132117, 1900), (354133856, 100)]:
+        for query, function in [(upstr_query, 'fwa_lengthupstream_array'),
+                                (dnstr_query, 'fwa_lengthdownstream_array')]:
+            r = db.query(query, (blkey, measure)).fetchone()
+            r_array = db.query("SELECT {f}(%s, %s)".format(f=function),
+                               (blkey, measure)).fetchone()
+            assert round(r[0], 2) == round(r_array[0], 2)
+
+
+def test_upstr_precomputed():
+    db = fwa.util.connect(DB_URL)
+    fwa.build_length_upstream(db=db)
+    expected = [(354141556, 0, 3689.59),
+                (354141556, 1400, 2289.59),
+                (354148866, 2800, 19910.22)]
+    for blkey, measure, length in expected:
+        r = db.query("SELECT fwa_lengthupstream_lookup(%s, %s)",
+                     (blkey, measure)).fetchone()
+        assert round(r[0], 2) == length
+        # the summing function is unchanged
+        r = db.query(upstr_query, (blkey, measure)).fetchone()
+        assert round(r[0], 2) == length
+
+
+def test_dnstr_precomputed():
+    db = fwa.util.connect(DB_URL)
+    fwa.build_length_downstream(db=db)
+    expected = [(354153694, 0, 0),
+                (354153694, 2500, 2500),
+                (354132117, 1900, 6313.67),
+                (354133856, 100, 92881.36)]
+    for blkey, measure, length in expected:
+        r = db.query("SELECT fwa_lengthdownstream_lookup(%s, %s)",
+                     (blkey, measure)).fetchone()
+        assert round(r[0], 2) == length
+    assert fwa.validate_length_downstream(50, db=db) == []
+
+
+def test_instr_precomputed():
+    db = fwa.util.connect(DB_URL)
+    r = db.query("SELECT fwa_lengthinstream_lookup(%s, %s, %s, %s)",
+                 (354148866, 10, 354148866, 1000)).fetchone()
+    assert round(r[0], 2) == 990
+    # points are not upstream of one another
+    r = db.query("SELECT fwa_lengthinstream_lookup(%s, %s, %s, %s)",
+                 (354148866, 1000, 354148866, 10)).fetchone()
+    assert r[0] is None
+
+
+def test_events_lengths():
+    db = fwa.util.connect(DB_URL)
+    db.execute('DROP TABLE IF EXISTS public.fwakit_events_test')
+    db.execute("""CREATE TABLE public.fwakit_events_test AS
+                  SELECT * FROM (VALUES (1, 354141556, 1400::float),
+                                        (2, 354148866, 2800::float),
+                                        (3, 354132117, 1900::float))
+                  AS e (event_id, blue_line_key, downstream_route_measure)""")
+    fwa.length_upstream_events('public.fwakit_events_test', 'event_id',
+                               'public.fwakit_events_test_up', db_url=DB_URL)
+    fwa.length_downstream_events('public.fwakit_events_test', 'event_id',
+                                 'public.fwakit_events_test_dn', jobs=2,
+                                 db=db)
+    for event_id, blkey, measure in db.query(
+            'SELECT * FROM public.fwakit_events_test'):
+        up = db.query("""SELECT length_upstream FROM public.fwakit_events_test_up
+                         WHERE event_id = %s""", (event_id,)).fetchone()[0]
+        dn = db.query("""SELECT length_downstream FROM public.fwakit_events_test_dn
+                         WHERE event_id = %s""", (event_id,)).fetchone()[0]
+        assert round(up, 2) == round(
+            db.query(upstr_query, (blkey, measure)).fetchone()[0], 2)
+        assert round(dn, 2) == round(
+            db.query(dnstr_query, (blkey, measure)).fetchone()[0], 2)
+    for table in ['fwakit_events_test', 'fwakit_events_test_up',
+                  'fwakit_events_test_dn']:
+        db['public.' + table].drop()
+
+
+def test_stream_profiles():
+    db = fwa.util.connect(DB_URL)
+    db.execute(fwa.queries['fwa_elevation'])
+    locations = [(354141556, 0), (354141556, 1400), (354148866, 2800)]
+    expected = [db.query("SELECT fwa_elevation(%s, %s)", loc).fetchone()[0]
+                for loc in locations]
+    fwa.build_stream_profiles(db=db)
+    for location, elevation in zip(locations, expected):
+        r = db.query("SELECT fwa_elevation(%s, %s)", location).fetchone()
+        assert abs(r[0] - elevation) <= 0.05
+    r = db.query("SELECT fwa_slopewindow(%s, %s, %s)",
+                 (354141556, 1400, 100)).fetchone()
+    assert r[0] is not None
+    # rebuild a group, leaving vertices stored under other groups in place
+    n = db.query_one('SELECT COUNT(*) FROM ' + fwa.STREAM_PROFILE_TABLE)[0]
+    fwa.build_stream_profiles(['SALM'], db=db)
+    assert db.query_one('SELECT COUNT(*) FROM ' + fwa.STREAM_PROFILE_TABLE)[0] == n
+    # drop the profiles, restoring the geometry version of the function
+    fwa.clear_stream_profiles(db=db)
+    assert fwa.STREAM_PROFILE_TABLE not in db.tables
+    for location, elevation in zip(locations, expected):
+        r = db.query("SELECT fwa_elevation(%s, %s)", location).fetchone()
+        assert r[0] == elevation
+
+
+def test_geomupstream_cached():
+    db = fwa.util.connect(DB_URL)
+    db.execute(fwa.queries['fwa_geomupstream'])
+    fwa.create_geomupstream_cache(db=db)
+    fwa.clear_geomupstream_cache(db=db)
+    blkey, measure = 354141556, 1400
+    expected = db.query("SELECT ST_Length(fwa_geomupstream(%s, %s))",
+                        (blkey, measure)).fetchone()[0]
+    # fill the cache (execute, to commit the entries), then read from it
+    db.execute("SELECT fwa_geomupstream_cached(%s, %s)", (blkey, measure))
+    db.execute("SELECT fwa_geomupstream_cached(%s, %s, 25)", (blkey, measure))
+    r = db.query("SELECT ST_Length(fwa_geomupstream_cached(%s, %s))",
+                 (blkey, measure)).fetchone()
+    assert round(r[0], 2) == round(expected, 2)
+    r = db.query("SELECT array_agg(tolerance ORDER BY tolerance) FROM " +
+                 fwa.GEOMUPSTREAM_CACHE).fetchone()
+    assert r[0] == [0, 25]
+    r = db.query("""SELECT cached_bytes = (SELECT SUM(size_bytes) FROM {t})
+                    FROM {s}""".format(t=fwa.GEOMUPSTREAM_CACHE,
+                                       s=fwa.GEOMUPSTREAM_CACHE_SETTINGS))
+    assert r.fetchone()[0] is True
+    assert fwa.validate_geomupstream_cache(db=db) is False
+    # re-running the command keeps the cache while the streams are unchanged
+    runner = CliRunner()
+    result = runner.invoke(cli, ['geomupstream_cache', '-db', DB_URL])
+    assert result.exit_code == 0
+    r = db.query("SELECT count(*) FROM " + fwa.GEOMUPSTREAM_CACHE).fetchone()
+    assert r[0] == 2
+    # and clears it once they have changed
+    db.execute("UPDATE {t} SET stream_signature = 'stale'".format(
+        t=fwa.GEOMUPSTREAM_CACHE_SETTINGS))
+    result = runner.invoke(cli, ['geomupstream_cache', '-db', DB_URL])
+    assert result.exit_code == 0
+    assert 'streams have changed, cleared' in result.output
+    r = db.query("SELECT count(*) FROM " + fwa.GEOMUPSTREAM_CACHE).fetchone()
+    assert r[0] == 0
+    db.execute("SELECT fwa_geomupstream_cached(%s, %s)", (blkey, measure))
+    fwa.clear_geomupstream_cache(db=db)
+    r = db.query("SELECT count(*) FROM " + fwa.GEOMUPSTREAM_CACHE).fetchone()
+    assert r[0] == 0
+    # entries past the size limit are removed
+    fwa.create_geomupstream_cache(max_size_mb=0, db=db)
+    db.execute("SELECT fwa_geomupstream_cached(%s, %s)", (blkey, measure))
+    r = db.query("SELECT count(*) FROM " + fwa.GEOMUPSTREAM_CACHE).fetchone()
+    assert r[0] == 0
+    r = db.query("SELECT cached_bytes FROM " + fwa.GEOMUPSTREAM_CACHE_SETTINGS)
+    assert r.fetchone()[0] == 0
+    fwa.create_geomupstream_cache(db=db)
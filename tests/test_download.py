@@ -0,0 +1,109 @@
+from __future__ import absolute_import
+import json
+import os
+import threading
+import zipfile
+try:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+import pytest
+
+import fwakit as fwa
+
+
+TEST_FILE = 'TEST.gdb.zip'
+
+
+class RangeRequestHandler(SimpleHTTPRequestHandler):
+    """Serve files from root, supporting range requests, noting each GET
+    """
+    root = None
+    gets = []
+
+    def translate_path(self, path):
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        byte_range = self.headers.get('Range')
+        RangeRequestHandler.gets.append(byte_range)
+        with open(self.translate_path(self.path), 'rb') as f:
+            data = f.read()
+        if byte_range:
+            start = int(byte_range.split('=')[1].split('-')[0])
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(
+                start, len(data) - 1, len(data)))
+            data = data[start:]
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def server(tmpdir):
+    root = tmpdir.mkdir('remote')
+    with zipfile.ZipFile(str(root.join(TEST_FILE)), 'w') as z:
+        z.writestr('TEST.gdb/data', os.urandom(100000))
+    RangeRequestHandler.root = str(root)
+    RangeRequestHandler.gets = []
+    httpd = HTTPServer(('127.0.0.1', 0), RangeRequestHandler)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:{}/'.format(httpd.server_address[1]), str(root)
+    httpd.shutdown()
+
+
+def test_download_and_unzip(server, tmpdir):
+    url, root = server
+    dl_path = str(tmpdir.join('dl'))
+    fwa.util.download_and_unzip(url + TEST_FILE, dl_path)
+    assert os.path.exists(os.path.join(dl_path, 'TEST.gdb', 'data'))
+    digest = fwa.util.file_sha256(os.path.join(root, TEST_FILE))
+    assert os.path.exists(os.path.join(dl_path, 'cache', digest + '.zip'))
+    assert len(RangeRequestHandler.gets) == 1
+
+
+def test_download_cached(server, tmpdir):
+    url, root = server
+    dl_path = str(tmpdir.join('dl'))
+    fwa.util.download_and_unzip(url + TEST_FILE, dl_path)
+    fwa.util.download_and_unzip(url + TEST_FILE, dl_path)
+    # unchanged archive is not fetched again
+    assert len(RangeRequestHandler.gets) == 1
+
+
+def test_download_resume(server, tmpdir):
+    url, root = server
+    cache_path = str(tmpdir.mkdir('cache'))
+    # start the download, writing only part of the file
+    info = fwa.util.remote_info(url + TEST_FILE)
+    with open(os.path.join(root, TEST_FILE), 'rb') as f:
+        data = f.read()
+    with open(os.path.join(cache_path, TEST_FILE + '.part'), 'wb') as f:
+        f.write(data[:5000])
+    with open(os.path.join(cache_path, TEST_FILE + '.part.json'), 'w') as f:
+        f.write(json.dumps({'url': url + TEST_FILE, 'remote': info}))
+    cached_file, digest = fwa.util.cache_archive(url + TEST_FILE, cache_path)
+    assert RangeRequestHandler.gets == ['bytes=5000-']
+    assert digest == fwa.util.file_sha256(os.path.join(root, TEST_FILE))
+    assert fwa.util.file_sha256(cached_file) == digest
+
+
+def test_source_path_zipped(server, tmpdir):
+    url, root = server
+    dl_path = str(tmpdir.join('dl'))
+    fwa.util.cache_archive(url + TEST_FILE, os.path.join(dl_path, 'cache'))
+    digest = fwa.util.file_sha256(os.path.join(root, TEST_FILE))
+    path = fwa.util.source_path(TEST_FILE, dl_path, zipped=True)
+    assert path == '/vsizip/{}/TEST.gdb'.format(
+        os.path.abspath(os.path.join(dl_path, 'cache', digest + '.zip')))
+    assert fwa.util.source_path(TEST_FILE, dl_path) is None
@@ -29,6 +29,33 @@ def test_reference_points():
     assert r.fetchone()[0] == 228
 
 
+def test_reference_points_chunked():
+    db = fwa.util.connect(DB_URL)
+    fwa.reference_points('whse_fish.pscis',
+                         'pt_id',
+                         'whse_fish.pscis_events_chunked',
+                         300,
+                         jobs=2,
+                         tile_size=10000,
+                         db=db)
+    r = db.query('SELECT COUNT(*) FROM whse_fish.pscis_events_chunked')
+    assert r.fetchone()[0] == 228
+    # closest match only, selected in the same pass
+    fwa.reference_points('whse_fish.pscis',
+                         'pt_id',
+                         'whse_fish.pscis_events_chunked',
+                         300,
+                         closest=True,
+                         tile_size=10000,
+                         db=db)
+    r = db.query('SELECT COUNT(*), COUNT(DISTINCT pt_id) FROM whse_fish.pscis_events_chunked')
+    n, n_points = r.fetchone()
+    assert n == n_points
+    r = db.query('SELECT COUNT(DISTINCT pt_id) FROM whse_fish.pscis_events_1')
+    assert r.fetchone()[0] == n
+    db['whse_fish.pscis_events_chunked'].drop()
+
+
 def test_get_closest_points():
     # more of a guide than a test
     db = fwa.util.connect(DB_URL)
@@ -50,6 +77,21 @@ def test_get_closest_points():
     assert r.fetchone()[0] == 97
 
 
+def test_get_events_stream():
+    db = fwa.util.connect(DB_URL)
+    events = list(fwa.get_events('whse_fish.pscis_events_1', 'pt_id',
+                                 db=db, fetch_size=50))
+    assert len(events) == 228
+    assert events[0]['pt_id'] <= events[-1]['pt_id']
+    batches = list(fwa.get_events('whse_fish.pscis_events_1', 'pt_id',
+                                  db=db, fetch_size=100, output='numpy'))
+    assert [len(b) for b in batches] == [100, 100, 28]
+    assert batches[0].dtype.names == ('pt_id', 'blue_line_key',
+                                      'downstream_route_measure',
+                                      'fwa_watershed_code',
+                                      'local_watershed_code')
+
+
 def test_fwa_lengthupstream():
     db = fwa.util.connect(DB_URL)
     sql = """WITH pts AS
@@ -13,6 +13,63 @@ def test_trim_ws_code():
     assert '920-123456' == fwa.trim_ws_code('920-123456-000000')
 
 
+def test_rewrite_sql():
+    sql = fwa.rewrite_sql(['ogc_fid', 'linear_feature_id', 'watershed_key_id',
+                           'fwa_watershed_code', 'gradient', 'geom'])
+    assert 'ogc_fid' not in sql
+    assert 'linear_feature_id::bigint AS linear_feature_id' in sql
+    assert 'watershed_key_id::integer AS watershed_key_id' in sql
+    assert "fwa_wsc2ltree(NULLIF(fwa_watershed_code, '<Null>')) AS wscode_ltree" in sql
+    assert 'AS gradient' in sql
+    assert sql.endswith('FROM {t}')
+
+
+def test_rewrite_sql_wsc_arrays():
+    columns = ['fwa_watershed_code', 'local_watershed_code', 'wscode_array']
+    assert 'wscode_array' not in fwa.rewrite_sql(columns)
+    sql = fwa.rewrite_sql(columns, wsc_arrays=True)
+    assert "fwa_wsc2array(NULLIF(fwa_watershed_code, '<Null>')) AS wscode_array" in sql
+    assert "AS localcode_array" in sql
+
+
+def test_index_sql():
+    table = 'whse_basemapping.fwa_stream_networks_sp'
+    assert fwa.index_sql(table, 'blue_line_key') == (
+        'CREATE INDEX IF NOT EXISTS ix_fwa_stream_networks_sp_blue_line_key '
+        'ON whse_basemapping.fwa_stream_networks_sp USING btree (blue_line_key)')
+    assert fwa.index_sql(table, 'wscode_ltree', 'gist').startswith(
+        'CREATE INDEX IF NOT EXISTS ix_fwa_stream_networks_sp_wscode_ltree_gist')
+    assert fwa.index_sql(table, 'fwa_watershed_code', opclass='text_pattern_ops').endswith(
+        '(fwa_watershed_code text_pattern_ops)')
+
+
+def test_wsc_intervals():
+    codes = ['100', '100.100000', '100.100000.000100', '100.190442',
+             '100.190442.000200', '100.190442.999000', '200']
+    intervals = {c: (l, r) for c, l, r in fwa.wsc_intervals(codes)}
+    assert intervals['100'] == (1, 6)
+    assert intervals['100.100000'] == (2, 3)
+    assert intervals['100.100000.000100'] == (3, 3)
+    assert intervals['100.190442'] == (4, 6)
+    assert intervals['200'] == (7, 7)
+
+
+def test_accumulate_downstream():
+    codes = [('100', 0), ('100.100000', 50), ('100.100000.000100', 10),
+             ('100.190442', 90), ('200', 0)]
+    totals = dict(fwa.accumulate_downstream(codes))
+    assert totals['100.100000'] == 50
+    assert totals['100.100000.000100'] == 60
+    assert totals['100.190442'] == 90
+    assert totals['200'] == 0
+
+
+def test_copy_text():
+    assert fwa.util.copy_text(None) == '\\N'
+    assert fwa.util.copy_text(1.5) == '1.5'
+    assert fwa.util.copy_text('a\tb\nc\\d') == 'a\\tb\\nc\\\\d'
+
+
 def test_queries():
     assert fwa.queries['test'] == 'SELECT test'
 
@@ -64,6 +121,64 @@ def test_upstreamwsc_wsds_equal_codes():
                  """).fetchone()
     assert r[0] == 23
 
+
+def test_upstreamwsc_inlined():
+    db = fwa.util.connect(DB_URL)
+    db.execute(fwa.queries['fwa_upstreamwsc'])
+    plan = db.query("""EXPLAIN VERBOSE
+                       SELECT COUNT(*)
+                       FROM whse_basemapping.fwa_watersheds_poly_sp wsd
+                       WHERE FWA_UpstreamWSC('920.705877'::ltree,
+                                             '920.705877'::ltree,
+                                             wsd.wscode_ltree,
+                                             wsd.localcode_ltree)
+                    """).fetchall()
+    plan = ' '.join([r[0] for r in plan])
+    assert 'fwa_upstreamwsc' not in plan.lower()
+    assert '<@' in plan
+
+
+def test_upstreamwsc_array():
+    db = fwa.util.connect(DB_URL)
+    fwa.add_wsc_arrays('whse_basemapping.fwa_watersheds_poly_sp', db=db)
+    db.execute(fwa.queries['fwa_upstreamwsc_array'])
+    for wscode, localcode, count in [('920-722273', '920-722273-097248', 3261),
+                                     ('920-705877', '920-705877', 23)]:
+        r = db.query("""SELECT COUNT(*)
+                        FROM whse_basemapping.fwa_watersheds_poly_sp wsd
+                        WHERE FWA_UpstreamWSC_Array(fwa_wsc2array(%s),
+                                                    fwa_wsc2array(%s),
+                                                    wsd.wscode_array,
+                                                    wsd.localcode_array)
+                     """, (wscode, localcode)).fetchone()
+        assert r[0] == count
+
+
+def test_downstreamwsc_array():
+    db = fwa.util.connect(DB_URL)
+    db.execute(fwa.queries['fwa_downstreamwsc_array'])
+    r = db.query("""SELECT fwa_downstreamwsc_array('{920,722273}',
+                                                   '{920,722273,97248}',
+                                                   '{920}', '{920}'),
+                           fwa_downstreamwsc_array('{920}', '{920}',
+                                                   '{920,722273}',
+                                                   '{920,722273,97248}')
+                 """).fetchone()
+    assert r[0] is True
+    assert r[1] is False
+
+
+def test_table_signature():
+    db = fwa.util.connect(DB_URL)
+    table = 'whse_basemapping.fwa_stream_networks_sp'
+    signature = fwa.table_signature(table, db=db)
+    assert fwa.table_signature(table, db=db) == signature
+    # an update changes the signature straight away, before statistics do
+    db.execute("""UPDATE {t} SET gnis_name = gnis_name
+                  WHERE linear_feature_id = (SELECT min(linear_feature_id)
+                                             FROM {t})""".format(t=table))
+    assert fwa.table_signature(table, db=db) != signature
+
 #def test_tearDown():
 #    db = fwa.util.connect(DB_URL)
 #    db.drop_schema('whse_basemapping', cascade=True)
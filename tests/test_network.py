@@ -0,0 +1,117 @@
+from __future__ import absolute_import
+
+import struct
+
+import numpy as np
+
+from fwakit import network
+from fwakit import wsc
+
+
+# main stem (blue line 1) with a tributary (2) joining its lowest segment,
+# and a tributary (3) joining the top segment of 2
+SEGMENTS = {'linear_feature_id': [12, 30, 21, 10, 11, 20],
+            'blue_line_key': [1, 3, 2, 1, 1, 2],
+            'downstream_route_measure': [200, 0, 50, 0, 100, 0],
+            'length_metre': [100, 10, 50, 100, 100, 50],
+            'downstream_id': [11, 21, 20, -1, 10, 10]}
+
+CODES = {1: '100', 2: '100-000050', 3: '100-000050-000025'}
+SEGMENTS['fwa_watershed_code'] = [CODES[k] for k in SEGMENTS['blue_line_key']]
+SEGMENTS['local_watershed_code'] = SEGMENTS['fwa_watershed_code']
+
+
+def build():
+    return network.Network.from_records(*[SEGMENTS[f] for f in network.FIELDS])
+
+
+def test_preorder():
+    net = build()
+    assert list(net.linear_feature_id) == [10, 20, 21, 30, 11, 12]
+    assert list(net.parent) == [-1, 0, 1, 2, 0, 4]
+    assert list(net.size) == [6, 3, 2, 1, 2, 1]
+
+
+def test_locate():
+    net = build()
+    nodes = net.locate([1, 1, 2, 3, 9], [150, 0, 75, 5, 1])
+    assert list(net.linear_feature_id[nodes[:4]]) == [11, 10, 21, 30]
+    assert nodes[4] == -1
+
+
+def test_lengths():
+    net = build()
+    blkeys = [1, 1, 2, 3]
+    measures = np.array([150, 0, 75, 5])
+    nodes = net.locate(blkeys, measures)
+    assert list(net.length_upstream(nodes, measures)) == [150, 410, 35, 5]
+    assert list(net.length_downstream(nodes, measures)) == [150, 0, 175, 205]
+
+
+def test_instream():
+    net = build()
+    a = net.locate([1], [50])
+    b = net.locate([3], [5])
+    assert net.is_upstream(a, b)[0]
+    assert not net.is_upstream(b, a)[0]
+    assert net.length_instream(a, [50], b, [5])[0] == 155
+    assert np.isnan(net.length_instream(b, [5], a, [50])[0])
+
+
+def test_traversal():
+    net = build()
+    top = net.locate([3], [5])[0]
+    assert list(net.linear_feature_id[net.downstream(top)]) == [21, 20, 10]
+    assert list(net.linear_feature_id[net.upstream(1)]) == [20, 21, 30]
+    assert list(net.linear_feature_id[net.children_of(0)]) == [20, 11]
+
+
+def test_from_csv(tmpdir):
+    csv_file = str(tmpdir.join('network.csv'))
+    with open(csv_file, 'w') as f:
+        f.write(','.join(network.FIELDS) + '\n')
+        for row in zip(*[SEGMENTS[k] for k in network.FIELDS]):
+            f.write(','.join([str(v) for v in row]) + '\n')
+    net = network.Network.from_csv(csv_file)
+    assert list(net.linear_feature_id) == [10, 20, 21, 30, 11, 12]
+    assert net.wscode is None
+    with open(csv_file, 'w') as f:
+        fields = network.FIELDS + network.CODE_FIELDS
+        f.write(','.join(fields) + '\n')
+        for row in zip(*[SEGMENTS[k] for k in fields]):
+            f.write(','.join([str(v) for v in row]) + '\n')
+    net = network.Network.from_csv(csv_file)
+    assert wsc.decode(net.wscode) == [CODES[k] for k in net.blue_line_key]
+
+
+def test_codes():
+    net = network.Network.from_records(
+        *[SEGMENTS[f] for f in network.FIELDS + network.CODE_FIELDS])
+    upstream = wsc.upstream(net.wscode[1], net.localcode[1],
+                            net.wscode, net.localcode)
+    assert list(upstream) == list(net.is_upstream(1, np.arange(len(net))))
+
+
+def test_snapshot(tmpdir):
+    path = str(tmpdir.join('network.snap'))
+    built = network.Network.from_records(
+        *[SEGMENTS[f] for f in network.FIELDS + network.CODE_FIELDS])
+    network.write_snapshot(built, path, signature='abc')
+    header, start = network.read_snapshot_header(path)
+    assert header['signature'] == 'abc'
+    assert start % network.ALIGN == 0
+    net = network.open_snapshot(path)
+    for name in network.Network.ARRAYS:
+        assert np.array_equal(getattr(net, name), getattr(built, name))
+    assert not net.linear_feature_id.flags.writeable
+    nodes = net.locate([1, 3], [150, 5])
+    assert list(net.length_downstream(nodes, [150, 5])) == [150, 205]
+
+
+def test_snapshot_version(tmpdir):
+    path = str(tmpdir.join('network.snap'))
+    network.write_snapshot(build(), path)
+    with open(path, 'r+b') as f:
+        f.seek(len(network.SNAPSHOT_MAGIC))
+        f.write(struct.pack('<I', network.SNAPSHOT_VERSION + 1))
+    assert network.read_snapshot_header(path) is None
@@ -0,0 +1,38 @@
+import struct
+
+from shapely.geometry import LineString
+
+from fwakit import pgcopy
+
+
+def test_pg_type():
+    assert pgcopy.pg_type('int:9') == 'integer'
+    assert pgcopy.pg_type('int:18') == 'bigint'
+    assert pgcopy.pg_type('int') == 'bigint'
+    assert pgcopy.pg_type('int32') == 'integer'
+    assert pgcopy.pg_type('float:24.15') == 'double precision'
+    assert pgcopy.pg_type('str:10') == 'character varying(10)'
+
+
+def test_geometry_type():
+    assert pgcopy.geometry_type('3D LineString') == 'geometry(MultiLineStringZ, 3005)'
+    assert pgcopy.geometry_type('Polygon', dim=2) == 'geometry(MultiPolygon, 3005)'
+
+
+def test_encode_rows():
+    buf = pgcopy.encode_rows([[1, None, u'SALM']],
+                             ['integer', 'double precision', 'character varying'])
+    data = buf.read()
+    assert data.startswith(pgcopy.COPY_HEADER)
+    assert data.endswith(pgcopy.COPY_TRAILER)
+    row = data[len(pgcopy.COPY_HEADER):-len(pgcopy.COPY_TRAILER)]
+    assert row == (struct.pack('>h', 3) +
+                   struct.pack('>i', 4) + struct.pack('>i', 1) +
+                   struct.pack('>i', -1) +
+                   struct.pack('>i', 4) + b'SALM')
+
+
+def test_promote():
+    geom = pgcopy.promote(LineString([(0, 0), (1, 1)]), dim=3)
+    assert geom.geom_type == 'MultiLineString'
+    assert geom.has_z
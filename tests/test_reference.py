@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from fwakit import reference
+
+
+# blue line 1 runs east from (0, 0) to (200, 0) as two segments, blue line 2
+# (length_metre longer than its planar length) runs north from (100, 0)
+VERTICES = {'linear_feature_id': [10, 10, 10, 11, 11, 20, 20],
+            'blue_line_key': [1, 1, 1, 1, 1, 2, 2],
+            'downstream_route_measure': [0, 0, 0, 100, 100, 0, 0],
+            'length_metre': [100, 100, 100, 100, 100, 110, 110],
+            'part': [1, 1, 1, 1, 1, 1, 1],
+            'x': [0, 50, 100, 100, 200, 100, 100],
+            'y': [0, 0, 0, 0, 0, 0, 100]}
+
+X = [25, 150, 1000]
+Y = [10, 60, 1000]
+
+
+def build(cell_size=reference.CELL_SIZE):
+    return reference.StreamIndex(*[VERTICES[f] for f in reference.FIELDS],
+                                 cell_size=cell_size)
+
+
+def test_index():
+    streams = build()
+    assert len(streams) == 4
+    assert list(streams.linear_feature_id) == [10, 11, 20]
+    assert list(streams.offset) == [0, 50, 0, 0]
+    assert list(streams.line_length) == [100, 100, 100]
+
+
+def test_snap():
+    events = build().snap(X, Y, threshold=100)
+    assert list(events['point']) == [0, 0, 1, 1]
+    assert list(events['linear_feature_id']) == [10, 20, 20, 11]
+    assert np.allclose(events['downstream_route_measure'], [25, 11, 66, 150])
+    assert np.allclose(events['distance_to_stream'], [10, 75, 50, 60])
+
+
+def test_snap_closest():
+    events = build().snap(X, Y, threshold=100, closest=True)
+    assert list(events['point']) == [0, 1]
+    assert list(events['linear_feature_id']) == [10, 20]
+    assert list(build().snap(X, Y, threshold=20)['point']) == [0]
+
+
+def test_snap_batches():
+    expected = build().snap(X, Y, threshold=100)
+    for streams in [build(cell_size=10), build(cell_size=1000)]:
+        assert np.array_equal(streams.snap(X, Y, threshold=100, batch_size=1),
+                              expected)
+
+
+def test_from_csv(tmpdir):
+    path = str(tmpdir.join('streams.csv'))
+    with open(path, 'w') as f:
+        f.write(','.join(reference.FIELDS) + '\n')
+        for row in zip(*[VERTICES[name] for name in reference.FIELDS]):
+            f.write(','.join(str(v) for v in row) + '\n')
+    streams = reference.StreamIndex.from_csv(path)
+    assert np.array_equal(streams.snap(X, Y), build().snap(X, Y))
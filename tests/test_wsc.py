@@ -0,0 +1,64 @@
+from __future__ import absolute_import
+
+import numpy as np
+
+from fwakit import wsc
+
+
+MAINSTEM = '100-190442'
+
+
+def pad(code):
+    levels = code.split('-')
+    return '-'.join(levels + ['000000'] * (wsc.LEVELS - len(levels)))
+
+
+def test_encode():
+    padded = wsc.encode([pad(MAINSTEM + '-000100'), pad('920')])
+    trimmed = wsc.encode([MAINSTEM + '-000100', '920'])
+    assert np.array_equal(padded, trimmed)
+    assert list(padded[0, :4]) == [100, 190442, 100, 0]
+    assert list(wsc.depth(padded)) == [3, 1]
+    assert wsc.encode(['100.190442', None])[1, 0] == -1
+    assert wsc.decode(padded) == [MAINSTEM + '-000100', '920']
+
+
+def test_order():
+    codes = wsc.encode(['100', MAINSTEM, MAINSTEM + '-000100', '100-190443'])
+    assert list(wsc.greater(codes[1:], codes[:-1])) == [True, True, True]
+    assert list(wsc.within(codes, codes[1])) == [False, True, True, False]
+
+
+def test_upstream():
+    # a on the mainstem, at local code 500000
+    wscode_a = wsc.encode([MAINSTEM])
+    localcode_a = wsc.encode([MAINSTEM + '-500000'])
+    b = [(MAINSTEM + '-600000', MAINSTEM + '-600000', True),   # tributary above
+         (MAINSTEM + '-400000', MAINSTEM + '-400000', False),  # tributary below
+         (MAINSTEM, MAINSTEM + '-700000', True),              # mainstem above
+         (MAINSTEM, MAINSTEM + '-500000', True),              # same location
+         (MAINSTEM, MAINSTEM + '-300000', False),             # mainstem below
+         ('100', '100-190442', False)]                        # receiving stream
+    wscode_b = wsc.encode([r[0] for r in b])
+    localcode_b = wsc.encode([r[1] for r in b])
+    result = wsc.upstream(wscode_a, localcode_a, wscode_b, localcode_b)
+    assert list(result) == [r[2] for r in b]
+    result = wsc.downstream(wscode_b, localcode_b, wscode_a, localcode_a)
+    assert list(result) == [r[2] for r in b]
+    # where watershed and local codes are equal, everything within is upstream
+    assert wsc.upstream(wscode_a, wscode_a, wscode_b, localcode_b).tolist() == [
+        True, True, True, True, True, False]
+
+
+def test_matrix():
+    wscode = wsc.encode(['100', MAINSTEM, MAINSTEM + '-600000', None])
+    localcode = wsc.encode(['100-190441', MAINSTEM + '-500000',
+                            MAINSTEM + '-600000', MAINSTEM])
+    m = wsc.matrix(wsc.upstream, wscode, localcode, chunk_size=3)
+    assert m.tolist() == [[True, True, True, False],
+                          [False, True, True, False],
+                          [False, False, True, False],
+                          [False, False, False, False]]
+    assert np.array_equal(wsc.matrix(wsc.downstream, wscode, localcode), m.T)
+    assert np.array_equal(wsc.matrix(wsc.equivalent, wscode, localcode),
+                          np.diag([True, True, True, False]))